@@ -0,0 +1,120 @@
+"""Load test: concurrent chat streams held by a single ASGI process.
+
+Usage: python benchmarks/bench_async_streams.py [--streams 50 100 200 400]
+
+Needs migrations (`python manage.py makemigrations`). Creates a test database,
+one chat per stream and drives `chat.views.agenerate_stream` for all of them
+concurrently on one event loop, against a local stub OpenAI-compatible server
+that streams 40 chunks 25 ms apart (~1 s per answer).
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+import django
+
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import setup_test_environment
+
+from chat.models import Chat, Message
+from chat.views import agenerate_stream
+from services.llm_clients import client_registry
+from services.models import LanguageModel, ModelAPI, RequestConfiguration, UserAPIKey
+from stub_openai_server import StubOpenAIServer
+
+
+def create_chats(base_url, count):
+    user, _ = User.objects.get_or_create(username="bench")
+    api, _ = ModelAPI.objects.get_or_create(
+        identifier="stub", defaults={"name": "Stub", "base_url": base_url}
+    )
+    language_model, _ = LanguageModel.objects.get_or_create(name="stub", api=api)
+    if not UserAPIKey.objects.filter(user=user, api=api).exists():
+        UserAPIKey.objects.create(user=user, api=api, key="stub-key")
+    request_config = RequestConfiguration.objects.get_for(language_model)
+    chat_ids = []
+    for i in range(count):
+        chat = Chat.objects.create(
+            user=user, topic=f"Chat {i}", request_config=request_config
+        )
+        Message.objects.create(chat=chat, text="Explain streams", sender="user")
+        Message.objects.create(chat=chat, text="", sender="waiting")
+        chat_ids.append(chat.id)
+    return chat_ids
+
+
+async def consume(chat_id, first_chunk_times):
+    request = RequestFactory().get(f"/chat/agenerate_stream/{chat_id}?mode=delta")
+    start = time.perf_counter()
+    response = await agenerate_stream(request, str(chat_id))
+    first = True
+    async for _ in response.streaming_content:
+        if first:
+            first_chunk_times.append(time.perf_counter() - start)
+            first = False
+
+
+async def run_streams(chat_ids):
+    first_chunk_times = []
+    peak_threads = threading.active_count()
+
+    async def watch_threads():
+        nonlocal peak_threads
+        while True:
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.05)
+
+    watcher = asyncio.create_task(watch_threads())
+    start = time.perf_counter()
+    await asyncio.gather(*(consume(chat_id, first_chunk_times) for chat_id in chat_ids))
+    elapsed = time.perf_counter() - start
+    watcher.cancel()
+    first_chunk_times.sort()
+    return elapsed, first_chunk_times, peak_threads
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, nargs="+", default=[50, 100, 200, 400])
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    server = StubOpenAIServer()
+    base_url = server.start()
+    try:
+        print(
+            f"{'streams':>8} {'wall':>8} {'streams/s':>10} "
+            f"{'p50 first':>10} {'p95 first':>10} {'threads':>8}"
+        )
+        for count in args.streams:
+            chat_ids = create_chats(base_url, count)
+            client_registry.clear()
+            elapsed, first, threads = asyncio.run(run_streams(chat_ids))
+            print(
+                f"{count:>8} {elapsed:>7.2f}s {count / elapsed:>10.1f} "
+                f"{first[len(first) // 2] * 1000:>8.0f}ms "
+                f"{first[int(len(first) * 0.95)] * 1000:>8.0f}ms {threads:>8}"
+            )
+    finally:
+        server.stop()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
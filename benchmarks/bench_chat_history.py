@@ -0,0 +1,117 @@
+"""Benchmark: building the API messages of a 2,000-message chat.
+
+Usage: python benchmarks/bench_chat_history.py [--messages 2000] [--budget 16000]
+
+Needs migrations (`python manage.py makemigrations`) and the tiktoken encoding of
+gpt-4o-mini. Creates a test database with one chat, a file uploaded every 20
+messages, and compares the previous history (every message, one context file
+query per message) with `chat.views.get_chat_messages`, before and after the
+token counts are cached on the messages.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+import django
+
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.test.utils import setup_test_environment
+
+from chat.models import Chat, Message
+from chat.views import get_chat_messages
+from documents.models import ContextFile
+from services.tokenizer import count_tokens
+
+
+def create_chat(count):
+    user, _ = User.objects.get_or_create(username="bench")
+    chat = Chat.objects.create(user=user, topic="Long chat")
+    messages = Message.objects.bulk_create(
+        [
+            Message(
+                chat=chat,
+                request_config=chat.request_config,
+                text=f"Message {i}: " + "Explain the next step of the proof. " * 8,
+                sender="user" if i % 2 else "assistant",
+            )
+            for i in range(count)
+        ]
+    )
+    for message in messages[::20]:
+        context_file = ContextFile.objects.create(
+            user=user, file=f"uploads/notes-{message.id}.pdf"
+        )
+        message.context_files.add(context_file)
+    return Chat.objects.select_related("request_config__language_model").get(id=chat.id)
+
+
+def previous_chat_messages(chat):
+    """The history as built before, every message and a query per message."""
+    messages = [{"role": "system", "content": chat.request_config.system_prompt}]
+    for msg in chat.message_set.all().order_by("created_at"):
+        messages.append({"role": msg.sender, "content": msg.text})
+        for context_file in msg.context_files.all():
+            messages.append(
+                {"role": "system", "content": f"File {context_file.file.name}"}
+            )
+    return messages
+
+
+def budgeted_chat_messages(chat):
+    chat_history = chat.message_set.prefetch_related("context_files").order_by(
+        "created_at"
+    )
+    return get_chat_messages(chat, chat_history)
+
+
+def measure(name, build, chat):
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        messages = build(chat)
+        elapsed = time.perf_counter() - start
+    tokens = sum(
+        count_tokens(message["content"], chat.request_config.language_model.name)
+        for message in messages
+    )
+    print(
+        f"{name:<24} {len(queries):>8} {elapsed * 1000:>8.1f}ms "
+        f"{len(messages):>9} {tokens:>9}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--budget", type=int, default=16000)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        chat = create_chat(args.messages)
+        print(
+            f"{'history':<24} {'queries':>8} {'time':>10} {'messages':>9} {'tokens':>9}"
+        )
+        measure("previous (unbounded)", previous_chat_messages, chat)
+        with override_settings(CHAT_HISTORY_TOKEN_BUDGET=args.budget):
+            measure("budgeted, cold counts", budgeted_chat_messages, chat)
+            measure("budgeted, cached counts", budgeted_chat_messages, chat)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
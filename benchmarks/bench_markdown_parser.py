@@ -0,0 +1,77 @@
+"""Compare building the markdown pipeline per call with the cached parsers.
+
+Usage: python benchmarks/bench_markdown_parser.py [--number 300]
+
+"per call" rebuilds the mistune pipeline and Pygments lexer/formatter on every
+render, which is what `get_markdown` did before the parser cache.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+import django
+
+django.setup()
+
+import mistune
+from pygments import highlight
+from pygments.formatters import html
+from pygments.lexers import get_lexer_by_name
+from services.llm_handler import (
+    MARKDOWN_PROFILES,
+    HighlightRenderer,
+    get_markdown,
+)
+
+SAMPLES = {
+    "chat": "Sure! Here is **the answer** to your question.",
+    "document": "[Page 3]:\n"
+    + "\n\n".join(
+        f"Paragraph {i} of a page with *emphasis* and a [link](https://example.com)."
+        for i in range(20)
+    ),
+    "summary": ".. toc::\n\n---\n\n# Summary\n\n## Part\n\n```python\nprint('hi')\n```\n",
+}
+
+
+class PerCallHighlightRenderer(HighlightRenderer):
+    def block_code(self, code, info=None):
+        if info:
+            return highlight(
+                code, get_lexer_by_name(info, stripall=True), html.HtmlFormatter()
+            )
+        return super().block_code(code, info)
+
+
+def render_per_call(text, profile):
+    markdown = mistune.create_markdown(
+        renderer=PerCallHighlightRenderer(), plugins=MARKDOWN_PROFILES[profile]()
+    )
+    return markdown(text)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=300)
+    args = parser.parse_args()
+
+    print(f"{'profile':<10} {'per call':>12} {'cached':>12} {'speedup':>8}")
+    for profile, text in SAMPLES.items():
+        get_markdown(text, profile)  # warm up the cached parser
+        per_call = timeit.timeit(
+            lambda: render_per_call(text, profile), number=args.number
+        )
+        cached = timeit.timeit(lambda: get_markdown(text, profile), number=args.number)
+        print(
+            f"{profile:<10} {per_call / args.number * 1e6:9.1f} us "
+            f"{cached / args.number * 1e6:9.1f} us {per_call / cached:7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Wall-clock scaling of PDF extraction with the number of pool workers.
+
+Usage: python benchmarks/bench_pdf_extraction.py [--pdfs 4] [--pages 200]
+       [--workers 1 2 4 8] [--pages-per-shard 25]
+
+Generates a corpus of multi-hundred-page PDFs (headings, paragraphs and a
+table every few pages), then extracts all of them at once through
+`documents.extraction.PDFExtraction`, as concurrent `documents.process_file`
+jobs do: each one starts the extraction of its file in the shared pool from
+`handle_file_processing`. "serial" is the previous implementation: one
+`pymupdf4llm.to_markdown` call per file.
+Scaling is bounded by the number of cores of the machine.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+import django
+
+django.setup()
+
+import fitz
+import pymupdf4llm
+from django.test.utils import override_settings
+from documents.extraction import PDFExtraction, shutdown_extraction_pool
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do".split()
+
+
+def make_pdf(page_count: int, seed: int) -> bytes:
+    doc = fitz.open()
+    for number in range(page_count):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Chapter {seed}.{number}", fontsize=18)
+        y = 110
+        for line in range(35):
+            words = [WORDS[(seed + number + line + i) % len(WORDS)] for i in range(12)]
+            page.insert_text((72, y), " ".join(words), fontsize=10)
+            y += 15
+        if number % 5 == 0:
+            for row in range(4):
+                for column in range(3):
+                    x, top = 72 + column * 150, y + row * 18
+                    page.draw_rect(fitz.Rect(x, top, x + 150, top + 18))
+                    page.insert_text((x + 4, top + 13), f"r{row}c{column}", fontsize=9)
+    return doc.tobytes()
+
+
+def extract_serial(corpus):
+    for file_bytes in corpus:
+        doc = fitz.open(stream=file_bytes, filetype="pdf")
+        pymupdf4llm.to_markdown(doc, page_chunks=True, show_progress=False)
+
+
+def extract_pool(corpus, workers, pages_per_shard):
+    with override_settings(PDF_EXTRACTION_WORKERS=workers):
+        # start the worker processes outside of the measurement
+        PDFExtraction(make_pdf(workers, 0), pages_per_shard=1).result()
+        start = time.perf_counter()
+        extractions = [PDFExtraction(b, pages_per_shard) for b in corpus]
+        for extraction in extractions:
+            extraction.result()
+        elapsed = time.perf_counter() - start
+        shutdown_extraction_pool()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdfs", type=int, default=4)
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--pages-per-shard", type=int, default=25)
+    args = parser.parse_args()
+
+    corpus = [make_pdf(args.pages, seed) for seed in range(args.pdfs)]
+    total_pages = args.pdfs * args.pages
+    print(f"{args.pdfs} PDFs x {args.pages} pages, {os.cpu_count()} cores")
+
+    start = time.perf_counter()
+    extract_serial(corpus)
+    serial = time.perf_counter() - start
+    print(f"{'workers':>8} {'wall':>9} {'pages/s':>9} {'speedup':>8}")
+    print(f"{'serial':>8} {serial:>8.2f}s {total_pages / serial:>9.1f} {1:>7.1f}x")
+    for workers in args.workers:
+        elapsed = extract_pool(corpus, workers, args.pages_per_shard)
+        print(
+            f"{workers:>8} {elapsed:>8.2f}s {total_pages / elapsed:>9.1f} "
+            f"{serial / elapsed:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
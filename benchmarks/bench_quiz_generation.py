@@ -0,0 +1,147 @@
+"""Time to complete a 50-question quiz against a local stub LLM.
+
+Usage: python benchmarks/bench_quiz_generation.py [--questions 50]
+
+Needs migrations (`python manage.py makemigrations`). The stub answers every
+request with `create_question` tool calls after 0.2 s plus 40 ms per question
+(the time a model spends writing them), and repeats one question of every ten
+to exercise the deduplication. "single request" asks for the whole quiz in one
+call, like the previous implementation did before re-asking for the rest.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+import django
+
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment
+
+from content.models import Quiz
+from content.signals import generate_quiz_questions
+from documents.models import ContextFile
+from services.models import LanguageModel, ModelAPI, RequestConfiguration, UserAPIKey
+from stub_openai_server import StubOpenAIServer
+
+SCENARIOS = [
+    (
+        "single request",
+        {"QUIZ_QUESTIONS_PER_REQUEST": 50, "QUIZ_MAX_CONCURRENT_REQUESTS": 1},
+    ),
+    (
+        "10 per request",
+        {"QUIZ_QUESTIONS_PER_REQUEST": 10, "QUIZ_MAX_CONCURRENT_REQUESTS": 5},
+    ),
+    (
+        "5 per request",
+        {"QUIZ_QUESTIONS_PER_REQUEST": 5, "QUIZ_MAX_CONCURRENT_REQUESTS": 10},
+    ),
+]
+
+
+class QuizStubServer(StubOpenAIServer):
+    def __init__(self):
+        super().__init__()
+        self.questions = 0
+
+    def requested_questions(self, body) -> int:
+        prompt = body["messages"][0]["content"]
+        return int(re.search(r"Create (\d+) questions", prompt).group(1))
+
+    def completion_delay(self, body):
+        return 0.2 + 0.04 * self.requested_questions(body)
+
+    def completion(self, body):
+        tool_calls = []
+        for i in range(self.requested_questions(body)):
+            self.questions += 1
+            number = self.questions - 1 if self.questions % 10 == 0 else self.questions
+            arguments = {
+                "quizz_id": "stub",
+                "question_text": f"Which statement about topic {number} is true?",
+                "options": [f"Option {j}" for j in range(4)],
+                "correct_option_index": 0,
+                "explanations": [f"Explanation {j}" for j in range(4)],
+            }
+            tool_calls.append(
+                {
+                    "id": f"call_{self.questions}",
+                    "type": "function",
+                    "function": {
+                        "name": "create_question",
+                        "arguments": json.dumps(arguments),
+                    },
+                }
+            )
+        return {"role": "assistant", "content": None, "tool_calls": tool_calls}
+
+
+def create_quiz(base_url, number_of_questions):
+    user, _ = User.objects.get_or_create(username="bench")
+    api, _ = ModelAPI.objects.get_or_create(
+        identifier="stub", defaults={"name": "Stub", "base_url": base_url}
+    )
+    language_model, _ = LanguageModel.objects.get_or_create(name="stub", api=api)
+    if not UserAPIKey.objects.filter(user=user, api=api).exists():
+        UserAPIKey.objects.create(user=user, api=api, key="stub-key")
+    request_config = RequestConfiguration.objects.get_for(language_model)
+    context_file = ContextFile.objects.create(
+        user=user,
+        filename="textbook.pdf",
+        markdown_json=[
+            {"metadata": {"page": page}, "text": f"Page {page}. " + "Some text. " * 300}
+            for page in range(1, 201)
+        ],
+    )
+    quiz = Quiz.objects.create(
+        user=user,
+        topic="Benchmark",
+        number_of_questions=number_of_questions,
+        request_config=request_config,
+    )
+    return quiz, [context_file]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--questions", type=int, default=50)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    server = QuizStubServer()
+    base_url = server.start()
+    try:
+        print(f"{'scenario':<16} {'wall':>8} {'requests':>9} {'questions':>10}")
+        for name, overrides in SCENARIOS:
+            quiz, context_files = create_quiz(base_url, args.questions)
+            requests = server.requests
+            with override_settings(**overrides):
+                start = time.perf_counter()
+                generate_quiz_questions(quiz, context_files)
+                elapsed = time.perf_counter() - start
+            print(
+                f"{name:<16} {elapsed:>7.2f}s {server.requests - requests:>9} "
+                f"{quiz.question_set.count():>10}"
+            )
+    finally:
+        server.stop()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Replay a recorded chat stream through the markdown renderers.
+
+Usage: python benchmarks/bench_streaming_markdown.py [--chunks 4000] [--skip-full]
+
+Prints the CPU time per chunk for every block of 500 chunks, once for the
+incremental renderer used by `process_chunk` and once for re-rendering the
+whole accumulated text (the behaviour before `StreamingMarkdown`).
+"""
+
+import argparse
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+
+import django
+
+django.setup()
+
+from services.llm_handler import StreamingMarkdown, get_markdown, process_chunk
+
+BLOCKS = [
+    "## Section {i}\n\n",
+    "This is paragraph {i} with **bold**, *italic* and `inline code` explaining "
+    "the concept in a few sentences so that it spans multiple chunks.\n\n",
+    "- first point of list {i}\n- second point\n- third point\n\n",
+    "```python\ndef function_{i}(x):\n    return x * {i}\n\n\nprint(function_{i}(2))\n```\n\n",
+    "| a | b |\n|---|---|\n| {i} | {i} |\n\n",
+]
+
+
+def recorded_stream(chunks: int, chunk_size: int = 6):
+    """Yield fake streaming chunks shaped like openai `ChatCompletionChunk`s."""
+    text = ""
+    i = 0
+    while len(text) < chunks * chunk_size:
+        text += BLOCKS[i % len(BLOCKS)].format(i=i)
+        i += 1
+    for start in range(0, chunks * chunk_size, chunk_size):
+        delta = SimpleNamespace(content=text[start : start + chunk_size], tool_calls=None)
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+def replay_incremental(stream, html_delta):
+    renderer = StreamingMarkdown()
+    raw_text, tool_calls = "", {}
+    for chunk in stream:
+        start = time.process_time()
+        raw_text, _, tool_calls = process_chunk(
+            chunk, raw_text, tool_calls, renderer, html_delta
+        )
+        yield time.process_time() - start
+
+
+def replay_full(stream):
+    raw_text = ""
+    for chunk in stream:
+        start = time.process_time()
+        raw_text += chunk.choices[0].delta.content
+        get_markdown(raw_text, "chat")
+        yield time.process_time() - start
+
+
+def report(name, timings, bucket=500):
+    print(f"\n{name}")
+    total = 0.0
+    for i in range(0, len(timings), bucket):
+        part = timings[i : i + bucket]
+        total += sum(part)
+        print(
+            f"  chunks {i:>5}-{i + len(part) - 1:<5} "
+            f"{sum(part) / len(part) * 1000:8.3f} ms/chunk"
+        )
+    print(f"  total {total:.2f} s CPU")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=4000)
+    parser.add_argument("--skip-full", action="store_true")
+    args = parser.parse_args()
+
+    report(
+        "incremental (html deltas)",
+        list(replay_incremental(recorded_stream(args.chunks), html_delta=True)),
+    )
+    report(
+        "incremental (full document)",
+        list(replay_incremental(recorded_stream(args.chunks), html_delta=False)),
+    )
+    if not args.skip_full:
+        report("re-render everything", list(replay_full(recorded_stream(args.chunks))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Minimal OpenAI-compatible chat completions server for benchmarks.
+
+Streams `chunks` content deltas `delay` seconds apart (server-sent events) or
+returns a single completion. Subclass and override `completion` or
+`stream_deltas` to script other answers (e.g. tool calls).
+"""
+
+import asyncio
+import json
+import threading
+import time
+
+
+class StubOpenAIServer:
+    def __init__(self, chunks: int = 40, delay: float = 0.025, host="127.0.0.1"):
+        self.chunks = chunks
+        self.delay = delay
+        self.host = host
+        self.port = None
+        self.requests = 0
+        self._loop = None
+        self._server = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1/"
+
+    def completion(self, body: dict) -> dict:
+        """Return the chat completion message for a non-streaming request."""
+        return {"role": "assistant", "content": "Stub answer."}
+
+    def stream_deltas(self, body: dict):
+        """Yield the deltas of a streaming request."""
+        for i in range(self.chunks):
+            yield {"content": f"token{i} " if i % 10 else f"\n\nPart {i}. "}
+
+    def completion_delay(self, body: dict) -> float:
+        """Seconds to wait before answering a non-streaming request."""
+        return 0
+
+    def usage(self) -> dict:
+        return {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20}
+
+    def _chunk(self, body, delta=None, usage=None):
+        return {
+            "id": "stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": (
+                [{"index": 0, "delta": delta, "finish_reason": None}]
+                if delta is not None
+                else []
+            ),
+            "usage": usage,
+        }
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            headers = dict(
+                line.split(": ", 1)
+                for line in head.decode().split("\r\n")[1:]
+                if ": " in line
+            )
+            length = int(headers.get("Content-Length", headers.get("content-length")))
+            body = json.loads(await reader.readexactly(length))
+            self.requests += 1
+
+            if body.get("stream"):
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                    b"Connection: close\r\n\r\n"
+                )
+                for delta in self.stream_deltas(body):
+                    chunk = self._chunk(body, delta=delta)
+                    writer.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    await writer.drain()
+                    await asyncio.sleep(self.delay)
+                chunk = self._chunk(body, usage=self.usage())
+                writer.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode())
+            else:
+                await asyncio.sleep(self.completion_delay(body))
+                payload = json.dumps(
+                    {
+                        "id": "stub",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": body.get("model", "stub"),
+                        "choices": [
+                            {
+                                "index": 0,
+                                "finish_reason": "stop",
+                                "message": self.completion(body),
+                            }
+                        ],
+                        "usage": self.usage(),
+                    }
+                ).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n".encode()
+                    + b"Connection: close\r\n\r\n"
+                    + payload
+                )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def start(self) -> str:
+        """Serve from a background thread, returns the base url."""
+        started = threading.Event()
+
+        async def serve():
+            self._server = await asyncio.start_server(
+                self._handle, self.host, 0, backlog=1024
+            )
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            async with self._server:
+                await self._server.serve_forever()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(serve())
+            except asyncio.CancelledError:
+                pass
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        return self.base_url
+
+    def stop(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._server.close)
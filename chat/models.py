@@ -1,8 +1,10 @@
+import os
 import uuid
 from django.db import models
 from django.contrib.auth.models import User
 from documents.models import ContextFile
 from services.llm_handler import call_api
+from services.tokenizer import count_tokens, get_encoder
 from services.models import (
     RequestConfiguration,
     PayloadSent,
@@ -10,6 +12,9 @@ from services.models import (
     get_default_request_config,
 )
 
+# tokens added by the API for the role and separators of every message
+MESSAGE_TOKEN_OVERHEAD = 4
+
 
 class BaseContentModel(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -30,6 +35,8 @@ class Chat(BaseContentModel):
         on_delete=models.CASCADE,
         default=get_default_request_config,
     )
+    # tokens of the last request of the chat, its current use of the context window
+    context_tokens = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.topic
@@ -40,11 +47,8 @@ class Chat(BaseContentModel):
         response = call_api(
             model=self.request_config.language_model, messages=payload, user=self.user
         )
-        request_config_copy = self.request_config
-        request_config_copy.pk = None
-        request_config_copy.save()
         payload_sent = PayloadSent.objects.create(
-            request_config=request_config_copy,
+            request_config=self.request_config,
             payload=payload,
             user=self.user,
             response=response.model_dump(),
@@ -64,28 +68,20 @@ class Chat(BaseContentModel):
         return self.message_set.filter(sender="assistant").count()
 
     def get_chat_token_count(self):
-        last_message = self.get_last_message()
-        payload_sent = PayloadSent.objects.filter(
-            request_config=last_message.request_config
-        )
-        payload_sent = payload_sent.latest("created_at")
-        token_usage = TokenUsage.objects.get(payload_sent=payload_sent)
+        return self.context_tokens
 
-        return token_usage.total_tokens
+    def update_context_tokens(self, token_usage: TokenUsage):
+        """Store the tokens of the request that produced `token_usage`."""
+        self.context_tokens = token_usage.total_tokens or 0
+        Chat.objects.filter(pk=self.pk).update(context_tokens=self.context_tokens)
 
     def get_context_window_percentage(self):
-        token_count = self.get_chat_token_count()
-        percentage = (
-            token_count / self.request_config.language_model.context_window
-        ) * 100
-        return f"{percentage:.2f} %"
+        return f"{self.get_context_window_percentage_float():.2f} %"
 
     def get_context_window_percentage_float(self):
-        token_count = self.get_chat_token_count()
-        percentage = (
-            token_count / self.request_config.language_model.context_window
-        ) * 100
-        return percentage
+        # no query with the language model of the request config selected
+        context_window = self.request_config.language_model.context_window
+        return self.context_tokens / context_window * 100
 
     def get_last_message_sender(self):
         return self.get_last_message().sender
@@ -95,25 +91,53 @@ class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
     request_config = models.ForeignKey(
         RequestConfiguration, on_delete=models.CASCADE
-    )  # this one copies the current chat's request config
+    )  # the chat's request config when the message was sent
     context_files = models.ManyToManyField(ContextFile, blank=True)
     text = models.TextField()
     markdown = models.TextField(blank=True, null=True)
     sender = models.CharField(max_length=100)
     created_at = models.DateTimeField(auto_now_add=True)
+    # tokens of the API messages of this message, cached by `update_token_count`
+    token_count = models.PositiveIntegerField(null=True, blank=True)
+    token_encoding = models.CharField(max_length=50, blank=True)
 
     class Meta:
         ordering = ["-created_at"]
+        # pages of a chat are read backwards from a (created_at, id) cursor
+        indexes = [models.Index(fields=["chat", "created_at", "id"])]
 
     def __str__(self):
         return self.text
 
+    def get_api_messages(self) -> list[dict]:
+        """The API messages of this message, followed by its uploaded files."""
+        messages = [{"role": self.sender, "content": self.text}]
+        for context_file in self.context_files.all():
+            messages.append(
+                {
+                    "role": "system",
+                    "content": f"The user has uploaded a file: **{os.path.basename(context_file.file.name)}** with context_file_id: {context_file.id}",
+                }
+            )
+        return messages
+
+    def update_token_count(self, model_name: str) -> bool:
+        """Count the tokens of `get_api_messages` unless cached for this encoding.
+
+        Returns True if the message was counted and has to be saved.
+        """
+        encoding = get_encoder(model_name).name
+        if self.token_count is not None and self.token_encoding == encoding:
+            return False
+        self.token_count = sum(
+            count_tokens(message["content"], model_name) + MESSAGE_TOKEN_OVERHEAD
+            for message in self.get_api_messages()
+        )
+        self.token_encoding = encoding
+        return True
+
     def save(self, *args, **kwargs):
-        try:
-            request_config = self.request_config
-        except:
-            request_config = self.chat.request_config
-            request_config.pk = None
-            request_config.save()
-            self.request_config = request_config
+        if self.request_config_id is None:
+            # configurations are immutable, the one of the chat is shared
+            self.request_config = self.chat.request_config
         super().save(*args, **kwargs)
@@ -1,9 +1,28 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.contrib.auth.models import User
 from .models import Chat, Message
-from unittest.mock import patch, MagicMock
-from services.models import LanguageModel, ModelAPI
-from chat.views import yield_chat_response_stream
+from unittest.mock import AsyncMock, patch, MagicMock
+from asgiref.sync import async_to_sync
+from services.models import (
+    LanguageModel,
+    ModelAPI,
+    RequestConfiguration,
+    TokenUsage,
+    clear_default_request_config,
+    get_default_request_config,
+)
+from chat.views import (
+    ayield_chat_response_stream,
+    finalize_stream,
+    get_chat_messages,
+    get_message_page,
+    yield_chat_response_stream,
+)
+from documents.models import ContextFile
+from services.tests import byte_encoding, patch_encodings
 
 
 class ChatModelTests(TestCase):
@@ -87,6 +106,11 @@ class ChatModelTests(TestCase):
         self.assertEqual(last_message.text, "First message")
 
 
+async def aiterate(items):
+    for item in items:
+        yield item
+
+
 class YieldChatResponseStreamTest(TestCase):
     def setUp(self):
         self.user = User.objects.create_user(username="testuser", password="12345")
@@ -120,6 +144,7 @@ class YieldChatResponseStreamTest(TestCase):
     ):
         mock_response = MagicMock()
         mock_call_api.return_value = mock_response
+        mock_store_payload_and_usage.return_value = TokenUsage(total_tokens=20)
         mock_process_response.return_value = iter(
             [
                 (
@@ -187,6 +212,7 @@ class YieldChatResponseStreamTest(TestCase):
     ):
         mock_response = MagicMock()
         mock_call_api.return_value = mock_response
+        mock_store_payload_and_usage.return_value = TokenUsage(total_tokens=20)
         mock_process_response.side_effect = [
             iter(
                 [
@@ -238,3 +264,336 @@ class YieldChatResponseStreamTest(TestCase):
         mock_finalize_stream.assert_called_once_with(
             self.message_to_populate, "raw_text_generated2", self.messages
         )
+
+    @patch("chat.views.acall_api", new_callable=AsyncMock)
+    @patch("chat.views.aprocess_response")
+    @patch("chat.views.astore_payload_and_usage", new_callable=AsyncMock)
+    @patch("chat.views.handle_tools_calls")
+    @patch("chat.views.finalize_stream")
+    def test_ayield_chat_response_stream_with_tool_calls(
+        self,
+        mock_finalize_stream,
+        mock_handle_tools_calls,
+        mock_store_payload_and_usage,
+        mock_process_response,
+        mock_call_api,
+    ):
+        mock_store_payload_and_usage.return_value = TokenUsage(total_tokens=20)
+        mock_process_response.side_effect = [
+            aiterate(
+                [
+                    (
+                        MagicMock(model_dump=lambda: {"chunk": "chunk1"}),
+                        "generated_text_json1",
+                        [{"tool": "call"}],
+                        "raw_text_generated1",
+                    )
+                ]
+            ),
+            aiterate(
+                [
+                    (
+                        MagicMock(model_dump=lambda: {"chunk": "chunk2"}),
+                        "generated_text_json2",
+                        None,
+                        "raw_text_generated2",
+                    )
+                ]
+            ),
+        ]
+        mock_handle_tools_calls.return_value = "tools_response"
+
+        async def collect():
+            return [
+                event
+                async for event in ayield_chat_response_stream(
+                    message_to_populate=self.message_to_populate,
+                    messages=self.messages,
+                    language_model=self.language_model,
+                    user=self.user,
+                    params=self.params,
+                    tools=self.tools,
+                    tool_functions=self.tool_functions,
+                )
+            ]
+
+        response_chunks = async_to_sync(collect)()
+
+        self.assertEqual(
+            response_chunks,
+            [
+                "data: generated_text_json1\n\n",
+                "data: generated_text_json2\n\n",
+                "event: close\n\n",
+            ],
+        )
+        self.assertEqual(mock_call_api.await_count, 2)
+        self.assertEqual(mock_store_payload_and_usage.await_count, 2)
+        mock_handle_tools_calls.assert_called_once_with(
+            [{"tool": "call"}], self.tool_functions
+        )
+        mock_finalize_stream.assert_called_once_with(
+            self.message_to_populate, "raw_text_generated2", self.messages
+        )
+
+
+@override_settings(CHAT_HISTORY_TOKEN_BUDGET=1000)
+class ChatHistoryTests(TestCase):
+    def setUp(self):
+        encoding = byte_encoding("o200k_base")
+        patch_encodings(self, {"gpt-4o-mini": encoding, "o200k_base": encoding})
+        self.user = User.objects.create_user("testuser")
+        self.chat = Chat.objects.create(user=self.user, topic="Long chat")
+        # 100 tokens of text and 4 of overhead per message
+        for i in range(30):
+            Message.objects.create(
+                chat=self.chat,
+                text=f"{i:02d}" + "x" * 98,
+                sender="user" if i % 2 else "assistant",
+                request_config=self.chat.request_config,
+            )
+        Message.objects.create(
+            chat=self.chat,
+            text="",
+            sender="waiting",
+            request_config=self.chat.request_config,
+        )
+
+    def get_chat_messages(self):
+        chat_history = self.chat.message_set.prefetch_related("context_files").order_by(
+            "created_at"
+        )
+        return get_chat_messages(self.chat, chat_history)
+
+    def test_oldest_messages_are_left_out(self):
+        messages = self.get_chat_messages()
+
+        # 1000 tokens minus the system prompt leave room for 9 messages
+        self.assertEqual(len(messages), 2 + 9)
+        self.assertEqual(messages[0]["content"], "You are a helpful assistant!")
+        self.assertEqual(
+            messages[1]["content"],
+            "21 earlier messages of this chat were left out to fit the context window.",
+        )
+        self.assertTrue(messages[2]["content"].startswith("21"))
+        self.assertTrue(messages[-1]["content"].startswith("29"))
+        self.assertEqual(messages[-1]["role"], "user")
+
+    def test_token_counts_are_cached(self):
+        # the language model, history, files and the counts update
+        with self.assertNumQueries(4):
+            self.get_chat_messages()
+        self.assertEqual(
+            set(
+                self.chat.message_set.exclude(sender="waiting").values_list(
+                    "token_count", "token_encoding"
+                )
+            ),
+            {(104, "o200k_base")},
+        )
+        with self.assertNumQueries(2):
+            self.get_chat_messages()
+
+    def test_uploaded_files_follow_their_message(self):
+        message = self.chat.message_set.get(text__startswith="29")
+        context_file = ContextFile.objects.create(
+            user=self.user, file="uploads/notes.pdf", filename="notes.pdf"
+        )
+        message.context_files.add(context_file)
+
+        messages = self.get_chat_messages()
+        self.assertTrue(messages[-2]["content"].startswith("29"))
+        self.assertIn("**notes.pdf**", messages[-1]["content"])
+        # the file note takes the place of the oldest kept message
+        self.assertEqual(len(messages), 2 + 8 + 1)
+
+
+class ContextTokensTests(TestCase):
+    def setUp(self):
+        encoding = byte_encoding("o200k_base")
+        patch_encodings(self, {"gpt-4o-mini": encoding, "o200k_base": encoding})
+        self.user = User.objects.create_user("testuser", password="password")
+        self.chat = Chat.objects.create(user=self.user, topic="Chat")
+
+    def test_gauge_needs_no_query(self):
+        self.chat.update_context_tokens(TokenUsage(total_tokens=64000))
+        chat = Chat.objects.select_related("request_config__language_model").get(
+            id=self.chat.id
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(chat.get_chat_token_count(), 64000)
+            self.assertEqual(chat.get_context_window_percentage(), "50.00 %")
+            self.assertEqual(chat.get_context_window_percentage_float(), 50)
+
+    def test_answer_is_counted_when_finalized(self):
+        message = Message.objects.create(chat=self.chat, text="", sender="waiting")
+        finalize_stream(message, "The answer.", [])
+        message.refresh_from_db()
+        self.assertEqual(message.sender, "assistant")
+        self.assertEqual(
+            (message.token_count, message.token_encoding), (15, "o200k_base")
+        )
+
+    def test_chat_page_shows_the_stored_context_tokens(self):
+        Message.objects.create(chat=self.chat, text="Hi", sender="user")
+        Message.objects.create(chat=self.chat, text="Hello", sender="assistant")
+        self.chat.update_context_tokens(TokenUsage(total_tokens=1280))
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("chat", kwargs={"chat_id": self.chat.id}))
+        self.assertContains(response, "<strong>Last Token Count:</strong> 1280")
+        self.assertContains(response, "1.00 %")
+
+
+class ChatRequestConfigurationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("testuser", password="password")
+        self.client.force_login(self.user)
+        self.chat = Chat.objects.create(user=self.user, topic="Chat")
+        self.other_chat = Chat.objects.create(user=self.user, topic="Other chat")
+
+    def test_messages_share_the_configuration_of_their_chat(self):
+        # the configuration of the chat once, then an INSERT per message
+        with self.assertNumQueries(1 + 10):
+            for i in range(10):
+                Message.objects.create(chat=self.chat, text=f"{i}", sender="user")
+        self.assertEqual(RequestConfiguration.objects.count(), 1)
+        self.assertEqual(
+            set(self.chat.message_set.values_list("request_config", flat=True)),
+            {self.chat.request_config_id},
+        )
+
+    def test_updated_parameters_only_change_the_chat(self):
+        self.assertEqual(self.chat.request_config, self.other_chat.request_config)
+        self.client.post(
+            reverse("update_params", kwargs={"chat_id": self.chat.id}),
+            {"temperature": 0.3, "top_p": 0.9},
+        )
+        self.client.post(
+            reverse("update_system_prompt", kwargs={"chat_id": self.chat.id}),
+            {"system_prompt": "Answer in French."},
+        )
+
+        self.chat.refresh_from_db()
+        self.other_chat.refresh_from_db()
+        self.assertEqual(
+            self.chat.request_config.params, {"temperature": 0.3, "top_p": 0.9}
+        )
+        self.assertEqual(self.chat.request_config.system_prompt, "Answer in French.")
+        self.assertEqual(
+            self.other_chat.request_config.system_prompt, "You are a helpful assistant!"
+        )
+        self.assertEqual(self.other_chat.request_config.params["temperature"], 1.0)
+
+    def test_new_chats_use_the_cached_default_configuration(self):
+        self.addCleanup(clear_default_request_config)
+        with self.captureOnCommitCallbacks(execute=True):
+            get_default_request_config()
+        with self.assertNumQueries(1):  # the cached row still exists
+            chat = Chat(user=self.user)
+        self.assertEqual(chat.request_config_id, self.chat.request_config_id)
+
+
+class ChatListViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("testuser", password="password")
+        self.client.force_login(self.user)
+        self.chat = Chat.objects.create(user=self.user, topic="Current chat")
+        Message.objects.create(chat=self.chat, text="Hi", sender="user")
+
+    def create_chats(self, count):
+        for i in range(count):
+            chat = Chat.objects.create(user=self.user, topic=f"Chat {i}")
+            Message.objects.create(chat=chat, text="First question", sender="user")
+            Message.objects.create(
+                chat=chat, text=f"Latest answer {i}", sender="assistant"
+            )
+
+    def get_chat_page(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse("chat", kwargs={"chat_id": self.chat.id})
+            )
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_chat_list_queries_do_not_grow_with_the_chats(self):
+        self.create_chats(2)
+        _, few_chats_queries = self.get_chat_page()
+        self.create_chats(20)
+        response, many_chats_queries = self.get_chat_page()
+        self.assertEqual(many_chats_queries, few_chats_queries)
+        self.assertContains(response, "Latest answer 19")
+        self.assertNotContains(response, "First question")
+        # the settings forms are not rendered with the page
+        self.assertNotContains(response, 'id="parameters-')
+
+    def test_chat_settings_fragment(self):
+        response = self.client.get(
+            reverse("chat_settings", kwargs={"chat_id": self.chat.id})
+        )
+        for modal in ["systemPrompt", "parameters", "updateChat", "deleteChat"]:
+            self.assertContains(response, f'id="{modal}-{self.chat.id}"')
+        self.assertContains(
+            response, reverse("update_params", kwargs={"chat_id": self.chat.id})
+        )
+
+    def test_chat_settings_of_other_users_are_not_found(self):
+        other_user = User.objects.create_user("other", password="password")
+        self.client.force_login(other_user)
+        response = self.client.get(
+            reverse("chat_settings", kwargs={"chat_id": self.chat.id})
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CHAT_MESSAGES_PAGE_SIZE=3)
+class MessagePaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("testuser", password="password")
+        self.client.force_login(self.user)
+        self.chat = Chat.objects.create(user=self.user, topic="Long chat")
+        self.messages = [
+            Message.objects.create(chat=self.chat, text=f"Message {i}", sender="user")
+            for i in range(7)
+        ]
+        # messages created in the same instant are ordered by id
+        Message.objects.filter(id__in=[m.id for m in self.messages[2:5]]).update(
+            created_at=self.messages[2].created_at
+        )
+
+    def get_texts(self, page):
+        return [message.text for message in page]
+
+    def test_pages_go_back_to_the_first_message(self):
+        page, has_older = get_message_page(self.chat.id)
+        self.assertEqual(self.get_texts(page), ["Message 4", "Message 5", "Message 6"])
+        self.assertTrue(has_older)
+        page, has_older = get_message_page(self.chat.id, before=page[0])
+        self.assertEqual(self.get_texts(page), ["Message 1", "Message 2", "Message 3"])
+        self.assertTrue(has_older)
+        page, has_older = get_message_page(self.chat.id, before=page[0])
+        self.assertEqual(self.get_texts(page), ["Message 0"])
+        self.assertFalse(has_older)
+
+    def test_chat_page_only_shows_the_latest_messages(self):
+        response = self.client.get(reverse("chat", kwargs={"chat_id": self.chat.id}))
+        self.assertContains(response, "Message 6")
+        self.assertNotContains(response, "Message 3")
+        self.assertContains(
+            response,
+            reverse("older_messages", kwargs={"chat_id": self.chat.id})
+            + f"?before={self.messages[4].id}",
+        )
+
+    def test_older_messages_endpoint(self):
+        url = reverse("older_messages", kwargs={"chat_id": self.chat.id})
+        response = self.client.get(url, {"before": self.messages[1].id})
+        self.assertContains(response, "Message 0")
+        self.assertNotContains(response, "Message 1")
+        self.assertNotContains(response, "older-messages")
+        self.assertEqual(self.client.get(url, {"before": "x"}).status_code, 404)
+
+        other_user = User.objects.create_user("other", password="password")
+        self.client.force_login(other_user)
+        response = self.client.get(url, {"before": self.messages[1].id})
+        self.assertEqual(response.status_code, 404)
@@ -5,13 +5,15 @@ urlpatterns = [
     path("", views.ChatListView.as_view(), name="chat"),
     path("<str:chat_id>", views.ChatListView.as_view(), name="chat"),
     path("update_chat/<str:chat_id>", views.update_chat, name="update_chat"),
+    path("older_messages/<str:chat_id>", views.older_messages, name="older_messages"),
+    path("chat_settings/<str:chat_id>", views.chat_settings, name="chat_settings"),
     path("delete_chat/<str:chat_id>", views.delete_chat, name="delete_chat"),
-    # path("update_params/<str:chat_id>", views.update_params, name="update_params"),
-    # path(
-    #     "update_system_prompt/<str:chat_id>",
-    #     views.update_system_prompt,
-    #     name="update_system_prompt",
-    # ),
+    path("update_params/<str:chat_id>", views.update_params, name="update_params"),
+    path(
+        "update_system_prompt/<str:chat_id>",
+        views.update_system_prompt,
+        name="update_system_prompt",
+    ),
     path("add_file/", views.add_file_to_chat, name="add_file_to_chat"),
     path("add_file/<str:chat_id>/", views.add_file_to_chat, name="add_file_to_chat"),
     path("send_message/<str:chat_id>", views.send_message, name="send_message"),
@@ -19,4 +21,9 @@ urlpatterns = [
     path(
         "generate_stream/<str:chat_id>", views.generate_stream, name="generate_stream"
     ),
+    path(
+        "agenerate_stream/<str:chat_id>",
+        views.agenerate_stream,
+        name="agenerate_stream",
+    ),
 ]
@@ -1,19 +1,26 @@
-import threading
-from django.http import HttpResponseRedirect, StreamingHttpResponse
-from django.shortcuts import redirect, render
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect, render
 from django.views.generic import ListView
-from django.db.models import Prefetch
+from django.db.models import Max, OuterRef, Q, Subquery
+from django.db.models.functions import Substr
 from django.contrib import messages as django_messages
 from chat.tools import CHAT_TOOLS, get_file_text
 from documents.models import ContextFile
 from documents.forms import FileUploadOrSelectForm
 import os
 from django.contrib.auth.models import User
-from documents.signals import process_files
+from documents.signals import enqueue_file_processing
 from services.forms import ParamsForm, SystemPromptForm
 from services.models import LanguageModel, UserAPIKey, get_default_language_model
+from services.tokenizer import count_tokens
 from .models import Chat, Message
 from services.llm_handler import (
+    acall_api,
+    aprocess_response,
+    astore_payload_and_usage,
     call_api,
     get_markdown,
     handle_tools_calls,
@@ -22,6 +29,11 @@ from services.llm_handler import (
 )
 from .forms import DeleteChatForm, MessageForm, UpdateChatForm
 
+# characters of the latest message loaded for the chat list
+SIDEBAR_PREVIEW_LENGTH = 200
+# messages shown in the chat transcript
+VISIBLE_SENDERS = ["user", "assistant", "waiting"]
+
 
 def update_chat(request, chat_id):
     if request.method == "POST":
@@ -36,6 +48,67 @@ def update_chat(request, chat_id):
     return HttpResponseRedirect(request.META.get("HTTP_REFERER"))
 
 
+def chat_settings(request, chat_id):
+    """Render the settings modals of a chat, loaded when one is opened."""
+    chat = get_object_or_404(
+        Chat.objects.select_related("request_config"), pk=chat_id, user=request.user
+    )
+    return render(
+        request,
+        "chat/chat_settings.html",
+        {
+            "chat_id": chat.id,
+            "system_prompt_form": SystemPromptForm(instance=chat.request_config),
+            "params_form": ParamsForm(instance=chat.request_config),
+            "update_chat_form": UpdateChatForm(instance=chat),
+            "delete_chat_form": DeleteChatForm(instance=chat),
+        },
+    )
+
+
+def get_message_page(chat_id, before: Message | None = None) -> tuple[list, bool]:
+    """The latest visible messages of a chat older than `before`, oldest first.
+
+    Keyset pagination on (created_at, id), so a page costs the same whatever
+    its position in the chat. Also returns whether older messages remain.
+    """
+    messages = Message.objects.filter(chat_id=chat_id, sender__in=VISIBLE_SENDERS)
+    if before is not None:
+        messages = messages.filter(
+            Q(created_at__lt=before.created_at)
+            | Q(created_at=before.created_at, id__lt=before.id)
+        )
+    page_size = settings.CHAT_MESSAGES_PAGE_SIZE
+    page = list(
+        messages.select_related("request_config__language_model").order_by(
+            "-created_at", "-id"
+        )[: page_size + 1]
+    )
+    has_older = len(page) > page_size
+    return page[:page_size][::-1], has_older
+
+
+def older_messages(request, chat_id):
+    """Render the page of messages before the `before` message id."""
+    chat = get_object_or_404(Chat.objects.only("id"), pk=chat_id, user=request.user)
+    before_id = request.GET.get("before", "")
+    if not before_id.isdigit():
+        raise Http404("No message to page from.")
+    before = get_object_or_404(
+        Message.objects.only("id", "created_at"), pk=before_id, chat=chat
+    )
+    chat_messages, has_older_messages = get_message_page(chat.id, before)
+    return render(
+        request,
+        "chat/chat_messages.html",
+        {
+            "current_chat": chat,
+            "chat_messages": chat_messages,
+            "has_older_messages": has_older_messages,
+        },
+    )
+
+
 def delete_chat(request, chat_id):
     if request.method == "POST":
         try:
@@ -52,8 +125,13 @@ def finalize_stream(
     """Finalize and save the generated message content."""
     message_to_populate.sender = "assistant"
     message_to_populate.text = text_generated
-    message_to_populate.markdown = get_markdown(text_generated)
-    message_to_populate.save(update_fields=["sender", "text", "markdown"])
+    message_to_populate.markdown = get_markdown(text_generated, "chat")
+    message_to_populate.update_token_count(
+        message_to_populate.request_config.language_model.name
+    )
+    message_to_populate.save(
+        update_fields=["sender", "text", "markdown", "token_count", "token_encoding"]
+    )
     chat = message_to_populate.chat
     messages.append({"role": "assisstang", "content": text_generated})
     if not chat.topic:
@@ -68,6 +146,7 @@ def yield_chat_response_stream(
     params: dict,
     tools: list[dict] = None,
     tool_functions: list[dict] = None,
+    html_delta: bool = False,
 ):
     response = call_api(
         model=language_model,
@@ -81,14 +160,15 @@ def yield_chat_response_stream(
     chunk_responses = []
     # Process the response and yield as data comes in
     for chunk, generated_text_json, tool_calls, raw_text_generated in process_response(
-        response
+        response, html_delta=html_delta
     ):
         chunk_responses.append(chunk.model_dump())
         yield f"data: {generated_text_json}\n\n"
 
-    store_payload_and_usage(
+    token_usage = store_payload_and_usage(
         messages, chunk_responses, message_to_populate.request_config, user
     )
+    message_to_populate.chat.update_context_tokens(token_usage)
 
     if tool_calls:
         tools_response = handle_tools_calls(tool_calls, tool_functions)
@@ -103,31 +183,131 @@ def yield_chat_response_stream(
                 user=user,
                 params=params,
                 tools=None,
+                html_delta=html_delta,
             )
     else:
         yield "event: close\n\n"
         finalize_stream(message_to_populate, raw_text_generated, messages)
 
 
-def generate_stream(request, chat_id):
-    chat = Chat.objects.get(pk=chat_id)
-    msg_to_populate = Message.objects.get(chat=chat, sender="waiting")
-    chat_history = chat.message_set.all().order_by("created_at")
+async def ayield_chat_response_stream(
+    message_to_populate: Message,
+    messages: list[dict],
+    language_model: LanguageModel,
+    user: User,
+    params: dict,
+    tools: list[dict] = None,
+    tool_functions: list[dict] = None,
+    html_delta: bool = False,
+):
+    """Async version of `yield_chat_response_stream` built on AsyncOpenAI."""
+    response = await acall_api(
+        model=language_model,
+        messages=messages,
+        user=user,
+        stream_flag=True,
+        params=params,
+        tools=tools,
+    )
+
+    chunk_responses = []
+    async for (
+        chunk,
+        generated_text_json,
+        tool_calls,
+        raw_text_generated,
+    ) in aprocess_response(response, html_delta=html_delta):
+        chunk_responses.append(chunk.model_dump())
+        yield f"data: {generated_text_json}\n\n"
+
+    token_usage = await astore_payload_and_usage(
+        messages, chunk_responses, message_to_populate.request_config, user
+    )
+    await sync_to_async(message_to_populate.chat.update_context_tokens)(token_usage)
+
+    if tool_calls:
+        tools_response = await sync_to_async(handle_tools_calls)(
+            tool_calls, tool_functions
+        )
+
+        if tools_response:
+            new_message = {"role": "system", "content": tools_response}
+            messages.append(new_message)
+            async for event in ayield_chat_response_stream(
+                message_to_populate=message_to_populate,
+                messages=messages,
+                language_model=language_model,
+                user=user,
+                params=params,
+                tools=None,
+                html_delta=html_delta,
+            ):
+                yield event
+    else:
+        yield "event: close\n\n"
+        await sync_to_async(finalize_stream)(
+            message_to_populate, raw_text_generated, messages
+        )
 
+
+def get_history_token_budget(request_config) -> int:
+    """Tokens of the prompt sent with a message of a chat using `request_config`."""
+    reserve = (
+        request_config.params.get("max_tokens") or settings.CHAT_RESPONSE_TOKEN_RESERVE
+    )
+    budget = request_config.language_model.context_window - reserve
+    if settings.CHAT_HISTORY_TOKEN_BUDGET:
+        budget = min(budget, settings.CHAT_HISTORY_TOKEN_BUDGET)
+    return budget
+
+
+def get_chat_messages(chat: Chat, chat_history) -> list[dict]:
+    """Build the API messages from the system prompt and the chat history.
+
+    `chat_history` is ordered by creation, with prefetched context files. The
+    most recent messages are kept within `get_history_token_budget`, older
+    ones are replaced by a note. Token counts are cached on the messages.
+    """
+    model_name = chat.request_config.language_model.name
     system_prompt = chat.request_config.system_prompt
     system_prompt = {"role": "system", "content": system_prompt}
+    budget = get_history_token_budget(chat.request_config) - count_tokens(
+        system_prompt["content"], model_name
+    )
+    history = [msg for msg in chat_history if msg.sender != "waiting"]
+    counted = [msg for msg in history if msg.update_token_count(model_name)]
+    if counted:
+        Message.objects.bulk_update(counted, ["token_count", "token_encoding"])
+
+    kept = []
+    for msg in reversed(history):
+        # the last message is always sent
+        if kept and msg.token_count > budget:
+            break
+        budget -= msg.token_count
+        kept.append(msg)
     messages = [system_prompt]
-    for msg in chat_history:
-        if msg.sender != "waiting":
-            messages.append({"role": msg.sender, "content": msg.text})
-            if context_files := msg.context_files.all():
-                for context_file in context_files:
-                    messages.append(
-                        {
-                            "role": "system",
-                            "content": f"The user has uploaded a file: **{os.path.basename(context_file.file.name)}** with context_file_id: {context_file.id}",
-                        }
-                    )
+    if omitted := len(history) - len(kept):
+        messages.append(
+            {
+                "role": "system",
+                "content": f"{omitted} earlier messages of this chat were left out to fit the context window.",
+            }
+        )
+    for msg in reversed(kept):
+        messages += msg.get_api_messages()
+    return messages
+
+
+def generate_stream(request, chat_id):
+    chat = Chat.objects.select_related("request_config__language_model__api").get(
+        pk=chat_id
+    )
+    msg_to_populate = Message.objects.get(chat=chat, sender="waiting")
+    chat_history = chat.message_set.prefetch_related("context_files").order_by(
+        "created_at"
+    )
+    messages = get_chat_messages(chat, chat_history)
 
     return StreamingHttpResponse(
         yield_chat_response_stream(
@@ -138,11 +318,72 @@ def generate_stream(request, chat_id):
             params=chat.request_config.params,
             tools=CHAT_TOOLS,
             tool_functions={"get_file_text": get_file_text},
+            html_delta=request.GET.get("mode") == "delta",
+        ),
+        content_type="text/event-stream; charset=utf-8",
+    )
+
+
+async def agenerate_stream(request, chat_id):
+    """ASGI version of `generate_stream`, no thread is held while streaming."""
+    chat = await Chat.objects.select_related(
+        "user", "request_config__language_model__api"
+    ).aget(pk=chat_id)
+    msg_to_populate = await Message.objects.select_related(
+        "chat", "request_config"
+    ).aget(chat=chat, sender="waiting")
+    chat_history = [
+        msg
+        async for msg in chat.message_set.prefetch_related("context_files").order_by(
+            "created_at"
+        )
+    ]
+    messages = await sync_to_async(get_chat_messages)(chat, chat_history)
+
+    return StreamingHttpResponse(
+        ayield_chat_response_stream(
+            message_to_populate=msg_to_populate,
+            messages=messages,
+            language_model=chat.request_config.language_model,
+            user=chat.user,
+            params=chat.request_config.params,
+            tools=CHAT_TOOLS,
+            tool_functions={"get_file_text": get_file_text},
+            html_delta=request.GET.get("mode") == "delta",
         ),
         content_type="text/event-stream; charset=utf-8",
     )
 
 
+def update_params(request, chat_id):
+    if request.method == "POST":
+        chat = Chat.objects.get(pk=chat_id, user=request.user)
+        form = ParamsForm(request.POST, instance=chat.request_config)
+        if form.is_valid():
+            # the configuration may be shared, the chat gets the one with the new values
+            request_config = form.save(commit=False)
+            chat.request_config = chat.request_config.derive(
+                params=request_config.params
+            )
+            chat.save(update_fields=["request_config"])
+            django_messages.success(request, "Parameters updated successfully.")
+    return HttpResponseRedirect(request.META.get("HTTP_REFERER"))
+
+
+def update_system_prompt(request, chat_id):
+    if request.method == "POST":
+        chat = Chat.objects.get(pk=chat_id, user=request.user)
+        form = SystemPromptForm(request.POST, instance=chat.request_config)
+        if form.is_valid():
+            request_config = form.save(commit=False)
+            chat.request_config = chat.request_config.derive(
+                system_prompt=request_config.system_prompt
+            )
+            chat.save(update_fields=["request_config"])
+            django_messages.success(request, "System prompt updated successfully.")
+    return HttpResponseRedirect(request.META.get("HTTP_REFERER"))
+
+
 def send_message(request, chat_id=None):
     if request.method == "POST":
         curr_chat, created = Chat.objects.get_or_create(id=chat_id, user=request.user)
@@ -150,9 +391,9 @@ def send_message(request, chat_id=None):
         if form.is_valid():
             text = request.POST.get("text")
             language_model = form.cleaned_data["language_model"]
-            request_config = curr_chat.request_config
-            request_config.language_model = language_model
-            request_config.save()
+            curr_chat.request_config = curr_chat.request_config.derive(
+                language_model=language_model
+            )
             if not UserAPIKey.objects.filter(
                 user=request.user, api=language_model.api
             ).exists():
@@ -163,7 +404,9 @@ def send_message(request, chat_id=None):
                 return HttpResponseRedirect(request.META.get("HTTP_REFERER"))
 
             curr_chat.save()
-            Message.objects.create(chat=curr_chat, text=text, sender="user")
+            message = Message(chat=curr_chat, text=text, sender="user")
+            message.update_token_count(language_model.name)
+            message.save()
             Message.objects.create(chat=curr_chat, text="", sender="waiting")
     if created:
         return redirect("chat", chat_id=curr_chat.id)
@@ -177,10 +420,7 @@ def process_uploaded_files(uploaded_files, chat: Chat):
             for file in uploaded_files
         ]
     )
-    thread = threading.Thread(
-        target=process_files, args=(new_files, chat.request_config.language_model.name)
-    )
-    thread.start()
+    enqueue_file_processing(new_files, chat.request_config.language_model.name)
     file_names = ", ".join([os.path.basename(file.filename) for file in new_files])
     new_msg = chat.message_set.create(
         text=f"{len(new_files)} files uploaded: {file_names}",
@@ -226,7 +466,7 @@ def add_file_to_chat(request, chat_id=None):
         chat = Chat.objects.create(user=request.user)
 
     if request.method == "POST":
-        form = FileUploadOrSelectForm(request.POST, request.FILES)
+        form = FileUploadOrSelectForm(request.POST, request.FILES, user=request.user)
         if form.is_valid():
             uploaded_files = form.cleaned_data.get("uploaded_files")
             selected_files = form.cleaned_data.get("selected_files")
@@ -258,17 +498,23 @@ class ChatListView(ListView):
         return super().dispatch(request, *args, **kwargs)
 
     def get_queryset(self):
-        # Override get_queryset to filter the chats and prefetch the latest message
+        # the sidebar only needs the topic and a preview of the latest message,
+        # annotated in the same query instead of prefetching every message
         if self.request.user.is_anonymous:
             return Chat.objects.none()
+        latest_messages = Message.objects.filter(chat=OuterRef("pk")).order_by(
+            "-created_at"
+        )
         queryset = (
             Chat.objects.filter(user=self.request.user)
-            .prefetch_related(
-                Prefetch(
-                    "message_set",
-                    queryset=Message.objects.order_by("-created_at"),
-                    to_attr="messages",  # Custom attribute for the prefetched messages
-                )
+            .only("id", "topic", "created_at")
+            .annotate(
+                last_activity=Max("message__created_at"),
+                last_message_text=Subquery(
+                    latest_messages.annotate(
+                        preview=Substr("text", 1, SIDEBAR_PREVIEW_LENGTH)
+                    ).values("preview")[:1]
+                ),
             )
             .order_by("-created_at")
         )
@@ -284,38 +530,38 @@ class ChatListView(ListView):
         chat_id = self.kwargs.get("chat_id")
 
         if chat_id:
-            context["current_chat"] = Chat.objects.get(id=chat_id)
-            context["chat_messages"] = Message.objects.filter(
-                chat_id=chat_id, sender__in=["user", "assistant", "waiting"]
-            ).order_by("created_at")
-            context["context_files"] = ContextFile.objects.filter(
-                message__chat__id=chat_id
-            ).distinct()
+            context["current_chat"] = Chat.objects.select_related(
+                "request_config__language_model"
+            ).get(id=chat_id)
+            (
+                context["chat_messages"],
+                context["has_older_messages"],
+            ) = get_message_page(chat_id)
+            # the html of the files is shown, not their text
+            context["context_files"] = (
+                ContextFile.objects.filter(message__chat__id=chat_id)
+                .defer("full_text", "markdown_json")
+                .distinct()
+            )
             if context["chat_messages"]:
-                last_message = context["chat_messages"].latest("created_at")
+                last_message = context["chat_messages"][-1]
+                context["last_message_sender"] = last_message.sender
                 if last_message.sender == "waiting":
                     context["generate_response"] = True
-
-            language_model = (
-                context["current_chat"].get_last_message().request_config.language_model
-            )
+                language_model = last_message.request_config.language_model
+            else:
+                language_model = context["current_chat"].request_config.language_model
         else:
             language_model = get_default_language_model()
 
-        context["chat_forms"] = [
-            {
-                "chat_id": chat.id,
-                "request_config_id": chat.request_config.id,
-                "system_prompt_form": SystemPromptForm(instance=chat.request_config),
-                "params_form": ParamsForm(instance=chat.request_config),
-                "update_chat_form": UpdateChatForm(instance=chat),
-                "delete_chat_form": DeleteChatForm(instance=chat),
-            }
-            for chat in context["chats"]
-        ]
-
+        # under ASGI the response is streamed without holding a worker thread
+        context["stream_view"] = (
+            "agenerate_stream"
+            if isinstance(self.request, ASGIRequest)
+            else "generate_stream"
+        )
         context["message_form"] = MessageForm(
             initial={"language_model": language_model}
         )
-        context["file_upload_form"] = FileUploadOrSelectForm()
+        context["file_upload_form"] = FileUploadOrSelectForm(user=self.request.user)
         return context
@@ -53,6 +53,7 @@ INSTALLED_APPS = [
     "content.apps.ContentConfig",
     "documents.apps.DocumentsConfig",
     "planning.apps.PlanningConfig",
+    "jobs.apps.JobsConfig",
 ]
 
 MIDDLEWARE = [
@@ -154,6 +155,65 @@ MEDIA_ROOT = os.path.join(BASE_DIR, "mediafiles")
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Keep-alive connection pool of every cached LLM API client
+LLM_CLIENT_POOL_LIMITS = {
+    "max_connections": 1000,
+    "max_keepalive_connections": 100,
+    "keepalive_expiry": 60,
+}
+
+# Decrypted API keys are cached in memory for `ttl` seconds
+LLM_API_KEY_CACHE = {
+    "max_size": 1024,
+    "ttl": 300,
+}
+
+# The default request configuration of new chats is cached in every process (checked
+# to still exist before use), changes made by other processes are seen after this
+# many seconds
+DEFAULT_REQUEST_CONFIG_TTL = 300
+
+# Background jobs run by `manage.py run_workers`
+JOB_WORKERS = 4
+JOB_POLL_INTERVAL = 1  # seconds an idle worker sleeps
+# seconds before a job of a dead worker is picked up again, renewed while it runs
+JOB_LEASE_TIMEOUT = 600
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BACKOFF = 10  # seconds, doubled on every failed attempt
+
+# PDF text extraction runs in a pool of processes, 0 extracts in the calling process
+PDF_EXTRACTION_WORKERS = os.cpu_count()
+PDF_PAGES_PER_SHARD = 25  # pages of one PDF extracted by a single task
+
+# tiktoken encoding used to count tokens of models tiktoken does not know (e.g. pixtral-12b)
+TOKEN_FALLBACK_ENCODING = "o200k_base"
+
+# Quiz questions are requested in batches sent concurrently, each on a section of the files
+QUIZ_QUESTIONS_PER_REQUEST = 10
+QUIZ_MAX_CONCURRENT_REQUESTS = 5
+QUIZ_RETRY_BUDGET = 3  # extra requests allowed for missing or duplicate questions
+QUIZ_DUPLICATE_SIMILARITY = 0.9  # questions at least this similar are duplicates
+
+# Chat history sent with a message, the oldest messages are left out to fit in the
+# context window of the model minus the tokens reserved for the answer
+CHAT_HISTORY_TOKEN_BUDGET = None  # tokens, None to use the whole context window
+CHAT_RESPONSE_TOKEN_RESERVE = 4096  # unless the request sets max_tokens
+
+# Messages shown when a chat is opened, older ones are loaded by pages of this size
+# when scrolling up
+CHAT_MESSAGES_PAGE_SIZE = 30
+
+# Summaries of files larger than a request are built by summarizing chunks of the
+# files concurrently, then summarizing those summaries until they fit in one request
+SUMMARY_CONTEXT_SHARE = 0.5  # part of the context window filled with the text to summarize
+SUMMARY_MAX_CHUNK_TOKENS = 32000
+SUMMARY_MAX_CONCURRENT_REQUESTS = 5
+# The final summary is streamed into Summary.text/html, saved every interval
+SUMMARY_STREAMING = True
+SUMMARY_STREAM_SAVE_INTERVAL = 0.5  # seconds between saves of the partial summary
+SUMMARY_STREAM_POLL_INTERVAL = 0.5  # seconds between reads of the summary stream view
+SUMMARY_STREAM_TIMEOUT = 900  # seconds before the summary stream view gives up
+
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"
 LOGIN_REDIRECT_URL = "home"
@@ -7,3 +7,4 @@ class ContentConfig(AppConfig):
 
     def ready(self):
         import documents.signals
+        import content.signals
@@ -22,7 +22,7 @@ class CreateQuizForm(forms.ModelForm):
 
     files = MultipleFileField(required=False)
     selected_files = forms.ModelMultipleChoiceField(
-        ContextFile.objects.all(), required=False
+        ContextFile.light.none(), required=False
     )
     language_model = forms.ModelChoiceField(
         queryset=LanguageModel.objects.all(), initial=0
@@ -39,8 +39,9 @@ class CreateQuizForm(forms.ModelForm):
             "language_model",
         ]
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, user=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.fields["selected_files"].queryset = ContextFile.light.for_user(user)
         self.helper = FormHelper()
         self.helper.layout = Layout(
             Field("topic"),  # Title field
@@ -134,7 +135,7 @@ class CreateSummaryForm(forms.ModelForm):
 
     files = MultipleFileField(required=False)
     selected_files = forms.ModelMultipleChoiceField(
-        queryset=ContextFile.objects.all(), required=False
+        queryset=ContextFile.light.none(), required=False
     )
     language_model = forms.ModelChoiceField(
         queryset=LanguageModel.objects.all(), initial=0
@@ -144,8 +145,9 @@ class CreateSummaryForm(forms.ModelForm):
         model = Summary
         fields = ["language_model"]
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, user=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.fields["selected_files"].queryset = ContextFile.light.for_user(user)
         self.helper = FormHelper()
         self.helper.layout = Layout(
             # hidden
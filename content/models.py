@@ -12,6 +12,7 @@ class BaseProcessModel(BaseContentModel):
     )  # null necessary for complex models like summaries that need to be created before the request config
     context_files = models.ManyToManyField(ContextFile, blank=True)
     processing_status = models.CharField(max_length=20, default="pending")
+    stage_timings = models.JSONField(default=dict, blank=True)  # seconds per stage
 
     @property
     def total_files(self):
@@ -29,6 +30,25 @@ class BaseProcessModel(BaseContentModel):
             [file.processing_status == "completed" for file in self.context_files.all()]
         )
 
+    def record_stage_timings(self, context_files, started_at, finished_at):
+        """Store how long the instance waited for its files and was generated.
+
+        `waiting` runs from the creation to the start of the generation and
+        includes the `extraction` of the files, processed in parallel.
+        """
+        extraction = max(
+            [file.processing_time for file in context_files if file.processing_time],
+            default=timedelta(0),
+        )
+        self.stage_timings = {
+            "waiting": (started_at - self.created_at).total_seconds(),
+            "extraction": extraction.total_seconds(),
+            "generation": (finished_at - started_at).total_seconds(),
+            "total": (finished_at - self.created_at).total_seconds(),
+        }
+        # the generation saved other fields of the row meanwhile
+        type(self).objects.filter(pk=self.pk).update(stage_timings=self.stage_timings)
+
     @property
     def total_processing_time(self):
         # Aggregate the sum of processing_time across related context_files
@@ -44,6 +64,59 @@ class Summary(BaseProcessModel):
 
     text = models.TextField()
     html = models.TextField(blank=True, null=True)
+    token_usage = models.JSONField(default=dict, blank=True)  # tokens per stage
+
+    def record_token_usage(self, final_usage=None):
+        """Store the tokens sent and received by every stage of the summary.
+
+        The map and reduce stages are added up from the summary chunks,
+        `final_usage` is the usage of the request writing the summary.
+        """
+        token_usage = {}
+        for chunk in self.summarychunk_set.all():
+            stage = token_usage.setdefault(
+                "map" if chunk.level == 0 else "reduce",
+                {
+                    "requests": 0,
+                    "input_tokens": 0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                },
+            )
+            stage["requests"] += 1
+            stage["input_tokens"] += chunk.input_tokens
+            stage["prompt_tokens"] += chunk.prompt_tokens
+            stage["completion_tokens"] += chunk.completion_tokens
+        if final_usage:
+            token_usage["final"] = {"requests": 1, **final_usage}
+        self.token_usage = token_usage
+        Summary.objects.filter(pk=self.pk).update(token_usage=token_usage)
+
+
+class SummaryChunk(models.Model):
+    """Partial summary of a map-reduce summarization, kept until it completes.
+
+    Level 0 summarizes a chunk of the files, every next level summarizes a
+    group of summaries of the level below. A retried generation reuses the
+    chunks whose input did not change.
+    """
+
+    summary = models.ForeignKey(Summary, on_delete=models.CASCADE)
+    level = models.PositiveIntegerField()
+    index = models.PositiveIntegerField()
+    input_hash = models.CharField(max_length=64)
+    text = models.TextField()
+    input_tokens = models.PositiveIntegerField(default=0)
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("summary", "level", "index")
+        ordering = ["level", "index"]
+
+    def __str__(self):
+        return f"{self.summary} ({self.level}.{self.index})"
 
 
 class Quiz(BaseProcessModel):
@@ -1,38 +1,78 @@
+import difflib
+import hashlib
+import math
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.apps import apps
+from django.conf import settings
+from django.db import connections, transaction
 from django.dispatch import Signal, receiver
-from services.llm_handler import call_api, get_markdown, handle_tools_calls
+from documents.models import ContextFile
+from documents.signals import get_processing_jobs, processing_failed
+from jobs.queue import RetryLater, enqueue, task
+from services.llm_handler import (
+    StreamingMarkdown,
+    call_api,
+    get_markdown,
+    get_tool_call_arguments,
+    process_response,
+)
 from services.models import LanguageModel, get_default_request_config
+from services.tokenizer import count_tokens, get_encoder
 from django.contrib.auth.models import User
+from django.utils import timezone
 import logging
-import time
-from .models import Quiz, Question, Option, Summary
+from .models import Quiz, Question, Option, Summary, SummaryChunk
 
 logger = logging.getLogger("django.server")
 quiz_files_processed = Signal()
 summary_files_processed = Signal()
 
 
+def create_questions(quiz: Quiz, questions: list[dict]) -> list[Question]:
+    """Save the create_question tool call arguments `questions` with their options.
+
+    Questions and options are inserted with one `bulk_create` each.
+    """
+    with transaction.atomic():
+        created = Question.objects.bulk_create(
+            [
+                Question(quiz=quiz, question=arguments["question_text"])
+                for arguments in questions
+            ]
+        )
+        Option.objects.bulk_create(
+            [
+                Option(
+                    question=question,
+                    option=option,
+                    is_correct=i == arguments["correct_option_index"],
+                    explanation=explanation,
+                )
+                for question, arguments in zip(created, questions)
+                for i, (option, explanation) in enumerate(
+                    zip(arguments["options"], arguments["explanations"])
+                )
+            ]
+        )
+    logger.warning(
+        f"Created {len(created)} question(s) for Quiz: {quiz.topic} ({quiz.id})"
+    )
+    return created
+
+
 def create_question(
     quizz_id, question_text, options, correct_option_index, explanations
 ):
     quiz = Quiz.objects.get(id=quizz_id)
-    logger.warning(f"Creating question for Quiz: {quiz.topic} ({quiz.id})")
-
-    # Create the question
-    question = Question.objects.create(quiz=quiz, question=question_text)
-    logger.warning(f"Question: {question_text}")
-
-    # Iterate through options and explanations together
-
-    for i, (option, explanation) in enumerate(zip(options, explanations)):
-        is_correct = i == correct_option_index  # Check if the current option is correct
-
-        # Create the option with the associated explanation
-        Option.objects.create(
-            question=question,
-            option=option,
-            is_correct=is_correct,
-            explanation=explanation,
-        )
+    arguments = {
+        "question_text": question_text,
+        "options": options,
+        "correct_option_index": correct_option_index,
+        "explanations": explanations,
+    }
+    return create_questions(quiz, [arguments])[0]
 
 
 QUIZZ_TOOLS = [
@@ -84,92 +124,213 @@ QUIZZ_TOOLS = [
 ]
 
 
-def generate_quizz_content(messages: list[dict], user: User, model: LanguageModel):
-    response = call_api(
-        model=model,
-        messages=messages,
-        user=user,
-        tools=QUIZZ_TOOLS,
-        force_tool=True,
+QUIZ_PROMPT = """Create {count} questions for the quiz with the following parameters!
+    quizz_id: {quiz.id}
+    Difficulty: "{quiz.difficulty}"
+    Options per question: {quiz.options_per_question}
+    Points (score) per question: {quiz.points_per_question}
+    {known_questions}Context for the questions:
+{section}"""
+
+
+def get_context_units(context_files) -> list[str]:
+    """The pages (paragraphs for text files) of `context_files` with their source."""
+    units = []
+    for context_file in context_files:
+        if context_file.markdown_json:
+            units += [
+                f"{context_file.filename}, page {page['metadata']['page']}:\n"
+                f"{page['text']}"
+                for page in context_file.markdown_json
+            ]
+        else:
+            units += [
+                f"{context_file.filename}:\n{paragraph}"
+                for paragraph in (context_file.full_text or "").split("\n\n")
+                if paragraph.strip()
+            ]
+    return units
+
+
+def get_context_sections(context_files, count: int) -> list[str]:
+    """Split the text of `context_files` in up to `count` sections of similar length.
+
+    Sections are made of whole pages (or paragraphs for text files), so fewer
+    sections are returned for short documents.
+    """
+    units = get_context_units(context_files)
+    total_length = sum(len(unit) for unit in units) or 1
+    sections = [[] for _ in range(count)]
+    length = 0
+    for unit in units:
+        sections[min(count - 1, length * count // total_length)].append(unit)
+        length += len(unit)
+    return ["\n---\n".join(section) for section in sections if section] or [""]
+
+
+def split_questions(count: int, requests: int) -> list[int]:
+    """Split `count` questions as evenly as possible over `requests` requests."""
+    return [
+        count // requests + (1 if i < count % requests else 0)
+        for i in range(requests)
+        if count // requests or i < count % requests
+    ]
+
+
+def normalize_question(text: str) -> list[str]:
+    """The lower case words of a question, without punctuation."""
+    return re.sub(r"[^\w\s]", " ", text.lower()).split()
+
+
+def get_numbers(words: list[str]) -> list[str]:
+    return [word for word in words if any(char.isdigit() for char in word)]
+
+
+def is_duplicate(question: list[str], known_questions: list[list[str]]) -> bool:
+    """Whether the words of `question` nearly match those of a known question.
+
+    Questions with other numbers are never duplicates, whatever their length.
+    Other words (e.g. a name) are compared word by word, so changing one makes
+    a new question only if it is a large enough share of the question.
+    """
+    threshold = settings.QUIZ_DUPLICATE_SIMILARITY
+    numbers = get_numbers(question)
+    for known_question in known_questions:
+        if get_numbers(known_question) != numbers:
+            continue
+        matcher = difflib.SequenceMatcher(None, question, known_question)
+        if (
+            matcher.real_quick_ratio() >= threshold
+            and matcher.quick_ratio() >= threshold
+            and matcher.ratio() >= threshold
+        ):
+            return True
+    return False
+
+
+def is_valid_question(arguments: dict) -> bool:
+    options = arguments.get("options")
+    explanations = arguments.get("explanations")
+    correct_option_index = arguments.get("correct_option_index")
+    return (
+        bool(arguments.get("question_text"))
+        and isinstance(options, list)
+        and isinstance(explanations, list)
+        and len(options) == len(explanations) > 1
+        and isinstance(correct_option_index, int)
+        and 0 <= correct_option_index < len(options)
     )
-    tool_functions = {"create_question": create_question}
-    for choice in response.choices:
-        for i, tool_call in enumerate(choice.message.tool_calls):
-            handle_tools_calls({i: tool_call.model_dump()}, tool_functions)
 
 
-def check_question_number(
-    quiz, actual_questions_generated, num_questions_asked, full_text
-):
-    already_generated_questions = [
-        q for q in actual_questions_generated.values_list("question", flat=True)
-    ]
-    if actual_questions_generated.count() < num_questions_asked:
-        logger.error(
-            f"Failed to generate all questions for Quiz: {quiz.topic} ({quiz.id}) ({actual_questions_generated.count()} from {num_questions_asked})."
-        )
-        logger.error(f"Already generated questions: {already_generated_questions}")
-        remaining_questions = num_questions_asked - actual_questions_generated.count()
-        prompt = f"""You generated {actual_questions_generated.count()} questions from the {num_questions_asked} you requested. 
-        
-        Please try again and generate the remaining questions ({remaining_questions})! 
-        You already generated the following questions:
-        {already_generated_questions}
-        
-        quizz_id: {quiz.id}
-        Difficulty: "{quiz.difficulty}"
-        Number of questions: {quiz.number_of_questions}
-        Options per question: {quiz.options_per_question}
-        Points (score) per question: {quiz.points_per_question}
-        Full context for the quizz:
-    {full_text}"""
-        messages = [{"role": "system", "content": prompt}]
-
-        num_questions_asked = quiz.number_of_questions
-        actual_questions_generated = Question.objects.filter(quiz=quiz)
-        generate_quizz_content(messages, quiz.user, quiz.request_config.language_model)
-        check_question_number(
-            quiz,
-            Question.objects.filter(quiz=quiz),
-            quiz.number_of_questions,
-            full_text,
+def request_questions(
+    quiz: Quiz,
+    model: LanguageModel,
+    user: User,
+    section: str,
+    count: int,
+    known: list[str],
+) -> list[dict]:
+    """Ask for `count` questions on `section`, returns the create_question arguments.
+
+    Runs in a thread of the generation pool, never raises so a failed request
+    only costs its questions.
+    """
+    known_questions = (
+        f"Do not repeat these existing questions: {known}\n    " if known else ""
+    )
+    prompt = QUIZ_PROMPT.format(
+        count=count, quiz=quiz, known_questions=known_questions, section=section
+    )
+    questions = []
+    try:
+        response = call_api(
+            model=model,
+            messages=[{"role": "system", "content": prompt}],
+            user=user,
+            tools=QUIZZ_TOOLS,
+            force_tool=True,
         )
-    else:
-        logger.info(
-            f"All questions were successfully generated for Quiz: {quiz.topic} ({quiz.id}) ({actual_questions_generated.count()} from {num_questions_asked})."
+        questions = get_tool_call_arguments(response, "create_question")
+    except Exception as e:
+        logger.error(f"Question request for Quiz {quiz.id} failed: {e}")
+    finally:
+        connections.close_all()  # of this thread
+    return questions
+
+
+def generate_quiz_questions(quiz: Quiz, context_files) -> int:
+    """Generate the missing questions of `quiz`, returns how many were created.
+
+    The questions are requested in batches of QUIZ_QUESTIONS_PER_REQUEST, each
+    on another section of the files, sent concurrently. Invalid and nearly
+    identical questions are dropped, the missing ones are requested again
+    within a budget of QUIZ_RETRY_BUDGET requests.
+    """
+    # loaded here, the requests run in other threads
+    model = LanguageModel.objects.select_related("api").get(
+        id=quiz.request_config.language_model_id
+    )
+    user = quiz.user
+    existing = list(quiz.question_set.values_list("question", flat=True))
+    known = [normalize_question(question) for question in existing]
+    missing = quiz.number_of_questions - len(existing)
+    requests = math.ceil(missing / settings.QUIZ_QUESTIONS_PER_REQUEST)
+    sections = get_context_sections(context_files, max(requests, 1))
+    retry_budget = settings.QUIZ_RETRY_BUDGET
+    accepted = []
+    round_number = 0
+    with ThreadPoolExecutor(settings.QUIZ_MAX_CONCURRENT_REQUESTS) as executor:
+        while missing > 0 and requests > 0:
+            # questions the model should not ask again
+            known_texts = existing + [q["question_text"] for q in accepted]
+            futures = [
+                executor.submit(
+                    request_questions,
+                    quiz,
+                    model,
+                    user,
+                    sections[(i + round_number) % len(sections)],
+                    count,
+                    known_texts,
+                )
+                for i, count in enumerate(split_questions(missing, requests))
+            ]
+            for future in futures:
+                for arguments in future.result():
+                    if missing == 0 or not is_valid_question(arguments):
+                        continue
+                    normalized = normalize_question(arguments["question_text"])
+                    if is_duplicate(normalized, known):
+                        continue
+                    known.append(normalized)
+                    accepted.append(arguments)
+                    missing -= 1
+            round_number += 1
+            requests = min(
+                retry_budget, math.ceil(missing / settings.QUIZ_QUESTIONS_PER_REQUEST)
+            )
+            retry_budget -= requests
+
+    create_questions(quiz, accepted)
+    if missing:
+        logger.error(
+            f"Generated {quiz.number_of_questions - missing} from "
+            f"{quiz.number_of_questions} questions for Quiz: {quiz.topic} ({quiz.id})."
         )
-        quiz.processing_status = "complete"
-        quiz.save()
+    return len(accepted)
 
 
 @receiver(quiz_files_processed)
 def create_quiz(sender, **kwargs):
     context_files = kwargs.get("context_files")
     quiz = kwargs.get("instance")
-    full_text = "\n---\n".join(
-        [
-            f"{context_file.filename}:\n{context_file.full_text}"
-            for context_file in context_files
-        ]
-    )
-    prompt = f"""Create a quiz with the following parameters!
-    quizz_id: {quiz.id}
-    Difficulty: "{quiz.difficulty}"
-    Number of questions: {quiz.number_of_questions}
-    Options per question: {quiz.options_per_question}
-    Points (score) per question: {quiz.points_per_question}
-    Full context for the quizz:
-{full_text}"""
-
-    messages = [{"role": "system", "content": prompt}]
     if not quiz.request_config:
         quiz.request_config = get_default_request_config()
         quiz.save()
-    generate_quizz_content(messages, quiz.user, quiz.request_config.language_model)
+    generate_quiz_questions(quiz, context_files)
 
-    check_question_number(
-        quiz, Question.objects.filter(quiz=quiz), quiz.number_of_questions, full_text
-    )
+    quiz.processing_status = "complete" if quiz.question_set.exists() else "error"
+    quiz.save(update_fields=["processing_status"])
 
 
 def update_summary(summary_id, summary_text, topic):
@@ -177,7 +338,7 @@ def update_summary(summary_id, summary_text, topic):
     summary.text = summary_text
     summary.topic = topic
     summary.html = get_markdown(
-        ".. toc::\n\n---\n\n" + summary_text
+        ".. toc::\n\n---\n\n" + summary_text, "summary"
     )  # add table of contents and line break
     summary.processing_status = "complete"
     summary.save()
@@ -227,45 +388,274 @@ def generate_summary_content(messages: list[dict], summary):
         tools=SUMMARY_TOOLS,
         force_tool=True,
     )
-    tool_functions = {"update_summary": update_summary}
-    for choice in response.choices:
-        for i, tool_call in enumerate(choice.message.tool_calls):
-            handle_tools_calls({i: tool_call.model_dump()}, tool_functions)
+    for arguments in get_tool_call_arguments(response, "update_summary"):
+        update_summary(**arguments)
+    return response
+
+
+def get_summary_topic(summary_text: str, default: str) -> str:
+    """The first heading of `summary_text`, `default` without heading."""
+    match = re.search(r"^#+\s+(.+?)\s*#*$", summary_text, re.MULTILINE)
+    return match.group(1) if match else default
+
+
+def stream_summary_content(messages: list[dict], summary):
+    """Stream the summary into `summary`, returns the last chunk with usage.
+
+    The partial text and html are saved every SUMMARY_STREAM_SAVE_INTERVAL
+    seconds while the summary is `streaming`, read by the summary stream view.
+    """
+    response = call_api(
+        model=summary.request_config.language_model,
+        messages=messages,
+        user=summary.user,
+        stream_flag=True,
+    )
+    summaries = Summary.objects.filter(pk=summary.pk)
+    summaries.update(processing_status="streaming")
+    renderer = StreamingMarkdown("summary")
+    usage_chunk = None
+    summary_text = ""
+    saved_at = time.monotonic()
+    try:
+        for chunk, _, _, summary_text in process_response(
+            response, html_delta=True, renderer=renderer
+        ):
+            if getattr(chunk, "usage", None):
+                usage_chunk = chunk
+            if time.monotonic() - saved_at >= settings.SUMMARY_STREAM_SAVE_INTERVAL:
+                summaries.update(text=summary_text, html=renderer.html)
+                saved_at = time.monotonic()
+    except Exception:
+        summaries.update(processing_status="pending")  # generated again on retry
+        raise
+    update_summary(
+        summary.id, summary_text, get_summary_topic(summary_text, summary.topic)
+    )
+    return usage_chunk
+
+
+SUMMARY_MAP_PROMPT = """Summarize the following part ({number} of {total}) of the context of a summary in markdown format. Keep every important statement with its reference (file and page), copy definitions exactly as they are in the document and respect the markdown hierarchy for titles and enumeration. Write in english!
+    Part of the context:
+{text}"""
+
+SUMMARY_REDUCE_PROMPT = """Merge the following summaries ({number} of {total}) of consecutive parts of a context into a single summary in markdown format. Keep every important statement with its reference, the definitions exactly as they are and the order of the parts. Write in english!
+    Summaries:
+{text}"""
+
+
+def get_chunk_tokens(model: LanguageModel) -> int:
+    """Tokens of text to summarize sent in a single request to `model`."""
+    return min(
+        settings.SUMMARY_MAX_CHUNK_TOKENS,
+        int(model.context_window * settings.SUMMARY_CONTEXT_SHARE),
+    )
+
+
+def get_token_chunks(
+    texts: list[str], max_tokens: int, model_name: str
+) -> list[tuple[str, int]]:
+    """Join consecutive `texts` in chunks of up to `max_tokens` tokens.
+
+    Returns the chunks with their token count, a text longer than
+    `max_tokens` is cut in several chunks.
+    """
+    encoder = get_encoder(model_name)
+    separator = "\n---\n"
+    separator_tokens = count_tokens(separator, model_name)
+    chunks = []
+    current, current_tokens = [], 0
+    for text in texts:
+        tokens = count_tokens(text, model_name)
+        if tokens > max_tokens:
+            encoded = encoder.encode_ordinary(text)
+            pieces = [
+                (
+                    encoder.decode(encoded[i : i + max_tokens]),
+                    len(encoded[i : i + max_tokens]),
+                )
+                for i in range(0, len(encoded), max_tokens)
+            ]
+        else:
+            pieces = [(text, tokens)]
+        for piece, piece_tokens in pieces:
+            if (
+                current
+                and current_tokens + separator_tokens + piece_tokens > max_tokens
+            ):
+                chunks.append((separator.join(current), current_tokens))
+                current, current_tokens = [], 0
+            if current:
+                current_tokens += separator_tokens
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append((separator.join(current), current_tokens))
+    return chunks
+
+
+def get_usage(response) -> dict:
+    usage = getattr(response, "usage", None)
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+    }
+
+
+def summarize_chunk(model: LanguageModel, user: User, prompt: str) -> tuple[str, dict]:
+    """Summarize one chunk, returns the summary and the token usage.
+
+    Runs in a thread of the summary pool.
+    """
+    try:
+        response = call_api(
+            model=model,
+            messages=[{"role": "system", "content": prompt}],
+            user=user,
+        )
+        return response.choices[0].message.content or "", get_usage(response)
+    finally:
+        connections.close_all()  # of this thread
+
+
+def summarize_level(
+    summary: Summary,
+    model: LanguageModel,
+    level: int,
+    chunks: list[tuple[str, int]],
+    prompt_template: str,
+) -> list[str]:
+    """Summarize every chunk of `level` concurrently, returns the summaries in order.
+
+    Every summary is saved as soon as it is received and reused by a later
+    attempt if its input did not change. A failed request raises once the
+    other requests are done.
+    """
+    saved = {
+        chunk.index: chunk for chunk in summary.summarychunk_set.filter(level=level)
+    }
+    texts = [None] * len(chunks)
+    error = None
+    with ThreadPoolExecutor(settings.SUMMARY_MAX_CONCURRENT_REQUESTS) as executor:
+        futures = {}
+        for index, (text, tokens) in enumerate(chunks):
+            input_hash = hashlib.sha256(text.encode()).hexdigest()
+            if index in saved and saved[index].input_hash == input_hash:
+                texts[index] = saved[index].text
+                continue
+            prompt = prompt_template.format(
+                number=index + 1, total=len(chunks), text=text
+            )
+            future = executor.submit(summarize_chunk, model, summary.user, prompt)
+            futures[future] = (index, input_hash, tokens)
+        for future in as_completed(futures):
+            index, input_hash, tokens = futures[future]
+            try:
+                texts[index], usage = future.result()
+            except Exception as e:
+                logger.error(f"Summary {summary.id}: chunk {level}.{index} failed: {e}")
+                error = error or e
+                continue
+            SummaryChunk.objects.update_or_create(
+                summary=summary,
+                level=level,
+                index=index,
+                defaults={
+                    "input_hash": input_hash,
+                    "text": texts[index],
+                    "input_tokens": tokens,
+                    **usage,
+                },
+            )
+    if error:
+        raise error
+    logger.info(
+        f"Summary {summary.id}: level {level} done, {len(futures)} of "
+        f"{len(chunks)} chunks requested"
+    )
+    return texts
+
+
+def map_reduce_context(summary: Summary, model: LanguageModel, units: list[str]) -> str:
+    """Summarize `units` chunk by chunk until the summaries fit in one request.
+
+    The chunks of the files are summarized (map), then groups of summaries
+    are summarized again (reduce) level by level. Returns the context of the
+    final summary.
+    """
+    max_tokens = get_chunk_tokens(model)
+    chunks = get_token_chunks(units, max_tokens, model.name)
+    level = 0
+    texts = summarize_level(summary, model, level, chunks, SUMMARY_MAP_PROMPT)
+    while True:
+        chunks = get_token_chunks(texts, max_tokens, model.name)
+        if len(chunks) == 1:
+            return chunks[0][0]
+        if len(chunks) >= len(texts):
+            raise ValueError(
+                f"Summaries of Summary {summary.id} do not fit in {max_tokens} tokens"
+            )
+        level += 1
+        texts = summarize_level(summary, model, level, chunks, SUMMARY_REDUCE_PROMPT)
 
 
 @receiver(summary_files_processed)
 def create_summary(sender, **kwargs):
     context_files = kwargs.get("context_files")
     summary = kwargs.get("instance")
-    full_text = "\n---\n".join(
-        [
-            f"{context_file.filename}:\n{context_file.full_text}"
-            for context_file in context_files
-        ]
+    if not summary.request_config:
+        summary.request_config = get_default_request_config()
+        summary.save()
+    # loaded here, the chunks are summarized in other threads
+    model = LanguageModel.objects.select_related("api").get(
+        id=summary.request_config.language_model_id
     )
+    units = get_context_units(context_files)
+    if len(get_token_chunks(units, get_chunk_tokens(model), model.name)) > 1:
+        full_text = map_reduce_context(summary, model, units)
+    else:
+        full_text = "\n---\n".join(
+            [
+                f"{context_file.filename}:\n{context_file.full_text}"
+                for context_file in context_files
+            ]
+        )
+    if settings.SUMMARY_STREAMING:
+        instructions = "Answer with the summary only, starting with its title as a level 1 heading!"
+    else:
+        instructions = f"""Be sure to use the correct tool to update the following summary!
+    summary_id: {summary.id}"""
     prompt = f"""Create a summary with the following parameters, the summary should contain all parts of the given context, if you ommited any part, please add a reason. The summary should be in markdown format and for any important statement you add the corresponding reference if provided.
-    Take inspiration from Wikipedia articles. Be sure to use the correct tool to update the following summary!
-    summary_id: {summary.id}
+    Take inspiration from Wikipedia articles. {instructions}
     Full context for the summary:
     {full_text}
 
     The summary should be concise and cover all the important parts of the context, it should be in markdown format and also respect the markdown hierarchy for titles and enumeration. Write in english! If the document includes definitions, copy the definitions exactly as they are in the document."""
 
     messages = [{"role": "system", "content": prompt}]
-    generate_summary_content(messages, summary)
+    if settings.SUMMARY_STREAMING:
+        response = stream_summary_content(messages, summary)
+    else:
+        response = generate_summary_content(messages, summary)
+    summary.record_token_usage(get_usage(response))
+    # the partial summaries are only needed to resume a failed generation
+    summary.summarychunk_set.all().delete()
 
 
 def check_files_ready_signal(context_files, instance):
-    while True:
-        # sleep 5 seconds
-        time.sleep(5)
-        if all(
-            [
-                context_file.processing_status == "complete"
-                for context_file in context_files
-            ]
-        ):
-            break
+    """Send the files processed signal of `instance` once all files are processed.
+
+    Run as a job depending on the processing jobs of the files, so the files
+    are normally processed already. Raises `RetryLater` for files still being
+    processed outside of the job queue.
+    """
+    if processing_failed(context_files):
+        logger.error(f"Files of {instance} ({instance.id}) could not be processed.")
+        instance.processing_status = "error"
+        instance.save(update_fields=["processing_status"])
+        return
+    if any(file.processing_status != "complete" for file in context_files):
+        raise RetryLater(5)
 
     if context_files:
         if isinstance(instance, Quiz):
@@ -280,4 +670,35 @@ def check_files_ready_signal(context_files, instance):
             "context_files": context_files,
             "instance": instance,
         }
+        started_at = timezone.now()
         signal.send(**kwargs)
+        instance.record_stage_timings(context_files, started_at, timezone.now())
+
+
+def generation_failed(model_label: str, instance_id: str, **kwargs):
+    """Mark the instance as failed once its generation job has no retry left.
+
+    A summary is set back to pending while the job retries it, so its open
+    streams would otherwise wait for it until they time out.
+    """
+    apps.get_model(model_label).objects.filter(id=instance_id).update(
+        processing_status="error"
+    )
+
+
+@task("content.generate", on_failure=generation_failed)
+def generate(model_label: str, instance_id: str, context_file_ids: list[int]):
+    instance = apps.get_model(model_label).objects.get(id=instance_id)
+    context_files = list(ContextFile.objects.filter(id__in=context_file_ids))
+    check_files_ready_signal(context_files, instance)
+
+
+def enqueue_generation(context_files, instance):
+    """Queue the generation of `instance`, run when its files are processed."""
+    enqueue(
+        "content.generate",
+        depends_on=get_processing_jobs(context_files),
+        model_label=instance._meta.label_lower,
+        instance_id=str(instance.id),
+        context_file_ids=[context_file.id for context_file in context_files],
+    )
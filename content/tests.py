@@ -1,9 +1,30 @@
+import json
 import os
-from django.test import TestCase
+import re
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+from django.test import TestCase, override_settings
+from django.urls import reverse
 from django.contrib.auth.models import User
 
-from content.signals import create_question
-from .models import Quiz, Question, Option, Summary, ContextFile
+from content.signals import (
+    create_question,
+    create_questions,
+    create_quiz,
+    create_summary,
+    enqueue_generation,
+    get_context_sections,
+    is_duplicate,
+    normalize_question,
+    split_questions,
+)
+from content.views import process_selected_files, process_uploaded_files
+from jobs.models import Job
+from jobs.queue import run_next_job
+from services.tests import byte_encoding, patch_encodings
+from .models import Quiz, Question, Option, Summary, SummaryChunk, ContextFile
 from django.core.files.uploadedfile import SimpleUploadedFile
 
 
@@ -31,6 +52,7 @@ class ContentModelTests(TestCase):
             processing_status="complete",
             file=self.file,
         )
+        self.addCleanup(self.context_file.file.delete, save=False)
         self.quiz = Quiz.objects.create(
             topic="Test Quiz",
             difficulty="medium",
@@ -151,3 +173,412 @@ class CreateQuestionTestCase(TestCase):
             self.assertEqual(option.option, options[i].option)
             self.assertEqual(option.explanation, explanations[i])
             self.assertEqual(option.is_correct, i == correct_option_index)
+
+
+class GenerationSchedulingTests(TestCase):
+    def setUp(self):
+        patch_encodings(self, {"gpt-4o-mini": byte_encoding("o200k_base")})
+        self.user = User.objects.create_user(username="student", password="password")
+        self.quiz = Quiz.objects.create(topic="Quiz", user=self.user)
+
+    def run_jobs(self):
+        while run_next_job("worker"):
+            pass
+
+    @patch("content.signals.quiz_files_processed.send")
+    def test_generation_is_dispatched_when_files_are_extracted(self, send):
+        send.side_effect = lambda **kwargs: time.sleep(0.05)
+        process_uploaded_files(
+            [SimpleUploadedFile(f"part{i}.txt", b"Some notes.") for i in range(2)],
+            self.quiz,
+        )
+        for context_file in self.quiz.context_files.all():
+            self.addCleanup(context_file.file.delete, save=False)
+        generation_job = Job.objects.get(task="content.generate")
+        self.assertEqual(generation_job.status, "blocked")
+
+        self.run_jobs()
+
+        send.assert_called_once()
+        generation_job.refresh_from_db()
+        last_file_done = Job.objects.filter(task="documents.process_file").latest(
+            "finished_at"
+        )
+        self.assertLess(
+            generation_job.started_at - last_file_done.finished_at,
+            timedelta(milliseconds=100),
+        )
+        self.quiz.refresh_from_db()
+        self.assertEqual(
+            set(self.quiz.stage_timings),
+            {"waiting", "extraction", "generation", "total"},
+        )
+        self.assertGreaterEqual(self.quiz.stage_timings["generation"], 0.05)
+        self.assertGreaterEqual(
+            self.quiz.stage_timings["total"], self.quiz.stage_timings["generation"]
+        )
+
+    @patch("content.signals.summary_files_processed.send")
+    def test_processed_files_are_generated_without_waiting(self, send):
+        summary = Summary.objects.create(topic="Summary", user=self.user)
+        context_file = ContextFile.objects.create(
+            user=self.user, processing_status="complete"
+        )
+        process_selected_files([context_file], summary)
+        self.assertEqual(Job.objects.get(task="content.generate").status, "pending")
+
+        self.run_jobs()
+        send.assert_called_once()
+
+
+def tool_call_response(questions: list[str]):
+    """A chat completion calling create_question for every question text."""
+    tool_calls = [
+        SimpleNamespace(
+            function=SimpleNamespace(
+                name="create_question",
+                arguments=json.dumps(
+                    {
+                        "quizz_id": "ignored",
+                        "question_text": question,
+                        "options": ["A", "B"],
+                        "correct_option_index": 0,
+                        "explanations": ["Right", "Wrong"],
+                    }
+                ),
+            )
+        )
+        for question in questions
+    ]
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(tool_calls=tool_calls))]
+    )
+
+
+@override_settings(
+    QUIZ_QUESTIONS_PER_REQUEST=10, QUIZ_MAX_CONCURRENT_REQUESTS=4, QUIZ_RETRY_BUDGET=2
+)
+@patch("content.signals.call_api")
+class QuizGenerationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="student", password="password")
+        self.quiz = Quiz.objects.create(
+            topic="Quiz", user=self.user, number_of_questions=25
+        )
+        self.context_file = ContextFile.objects.create(
+            user=self.user,
+            filename="book.pdf",
+            markdown_json=[
+                {"metadata": {"page": page}, "text": f"Page {page} text."}
+                for page in range(1, 7)
+            ],
+        )
+
+    def generate(self):
+        create_quiz(Quiz, context_files=[self.context_file], instance=self.quiz)
+        self.quiz.refresh_from_db()
+
+    def test_questions_are_requested_in_concurrent_batches(self, call_api):
+        def answer(messages, **kwargs):
+            prompt = messages[0]["content"]
+            count = int(re.search(r"Create (\d+) questions", prompt).group(1))
+            page = re.search(r"page (\d+)", prompt).group(1)
+            return tool_call_response(
+                [f"Question {i} about page {page}?" for i in range(count)]
+            )
+
+        call_api.side_effect = answer
+        self.generate()
+
+        self.assertEqual(call_api.call_count, 3)
+        self.assertEqual(self.quiz.question_set.count(), 25)
+        self.assertEqual(Option.objects.filter(question__quiz=self.quiz).count(), 50)
+        self.assertEqual(self.quiz.processing_status, "complete")
+
+    def test_duplicates_are_dropped_within_retry_budget(self, call_api):
+        call_api.side_effect = lambda **kwargs: tool_call_response(
+            ["What is a cell?", "what is a cell ?", "What is a cell!"]
+        )
+        self.generate()
+
+        # 3 batches and the retry budget of 2 requests
+        self.assertEqual(call_api.call_count, 5)
+        self.assertEqual(
+            list(self.quiz.question_set.values_list("question", flat=True)),
+            ["What is a cell?"],
+        )
+        self.assertEqual(self.quiz.processing_status, "complete")
+
+    def test_failed_requests_leave_the_quiz_in_error(self, call_api):
+        call_api.side_effect = ConnectionError
+        self.generate()
+        self.assertEqual(call_api.call_count, 5)
+        self.assertEqual(self.quiz.processing_status, "error")
+
+    def test_context_sections(self, call_api):
+        sections = get_context_sections([self.context_file], 3)
+        self.assertEqual(len(sections), 3)
+        self.assertIn("book.pdf, page 1:", sections[0])
+        self.assertIn("book.pdf, page 6:", sections[2])
+        self.assertEqual(split_questions(25, 3), [9, 8, 8])
+        self.assertEqual(split_questions(2, 3), [1, 1])
+
+    def test_duplicate_detection(self, call_api):
+        known = [normalize_question("What is the capital of France?")]
+        self.assertTrue(
+            is_duplicate(normalize_question("what is the capital of france"), known)
+        )
+        self.assertFalse(
+            is_duplicate(normalize_question("What is the capital of Spain?"), known)
+        )
+        # a single changed number of a long question is another question
+        question = (
+            "A train leaves the station at 9 am and travels at a constant speed "
+            "of {} km per hour, how far from the station is it at noon?"
+        )
+        known = [normalize_question(question.format(60))]
+        self.assertFalse(is_duplicate(normalize_question(question.format(80)), known))
+        self.assertTrue(is_duplicate(normalize_question(question.format(60)), known))
+
+
+class CreateQuestionsTests(TestCase):
+    def test_questions_are_bulk_inserted(self):
+        user = User.objects.create_user(username="student", password="password")
+        quiz = Quiz.objects.create(topic="Quiz", user=user, number_of_questions=20)
+        questions = [
+            {
+                "question_text": f"Question {i}?",
+                "options": [f"Option {j}" for j in range(4)],
+                "correct_option_index": i % 4,
+                "explanations": [f"Explanation {j}" for j in range(4)],
+            }
+            for i in range(20)
+        ]
+        # savepoint, questions, options, release
+        with self.assertNumQueries(4):
+            create_questions(quiz, questions)
+
+        self.assertEqual(quiz.question_set.count(), 20)
+        question = quiz.question_set.get(question="Question 5?")
+        self.assertEqual(question.option_set.count(), 4)
+        self.assertEqual(question.get_correct_option().option, "Option 1")
+
+
+@override_settings(
+    SUMMARY_MAX_CHUNK_TOKENS=200,
+    SUMMARY_MAX_CONCURRENT_REQUESTS=3,
+    SUMMARY_STREAMING=False,
+)
+@patch("content.signals.call_api")
+class MapReduceSummaryTests(TestCase):
+    def setUp(self):
+        encoding = byte_encoding("o200k_base")
+        patch_encodings(self, {"gpt-4o-mini": encoding, "o200k_base": encoding})
+        self.user = User.objects.create_user(username="student", password="password")
+        self.summary = Summary.objects.create(topic="Summary", user=self.user)
+        # about 80 tokens per page, two pages per chunk
+        self.context_file = ContextFile.objects.create(
+            user=self.user,
+            filename="book.pdf",
+            full_text="Full text.",
+            markdown_json=[
+                {"metadata": {"page": page}, "text": f"Page {page} " + "x" * 50}
+                for page in range(1, 13)
+            ],
+        )
+
+    def answer(self, messages, **kwargs):
+        usage = SimpleNamespace(prompt_tokens=100, completion_tokens=50)
+        if kwargs.get("tools"):
+            arguments = {
+                "summary_id": str(self.summary.id),
+                "summary_text": "# Final summary",
+                "topic": "Book",
+            }
+            tool_call = SimpleNamespace(
+                function=SimpleNamespace(
+                    name="update_summary", arguments=json.dumps(arguments)
+                )
+            )
+            message = SimpleNamespace(tool_calls=[tool_call])
+        else:
+            # long enough that only two summaries fit in a chunk
+            message = SimpleNamespace(content="s" * 90)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+    def generate(self):
+        create_summary(
+            Summary, context_files=[self.context_file], instance=self.summary
+        )
+        self.summary.refresh_from_db()
+
+    def test_large_files_are_summarized_in_levels(self, call_api):
+        call_api.side_effect = self.answer
+        self.generate()
+
+        # 6 chunks, their summaries reduced in 3 then 2 requests, the final summary
+        self.assertEqual(call_api.call_count, 6 + 3 + 2 + 1)
+        self.assertEqual(self.summary.text, "# Final summary")
+        self.assertEqual(self.summary.processing_status, "complete")
+        usage = self.summary.token_usage
+        self.assertEqual(usage["map"]["requests"], 6)
+        self.assertEqual(usage["map"]["completion_tokens"], 300)
+        self.assertEqual(usage["reduce"]["requests"], 5)
+        self.assertEqual(
+            usage["final"],
+            {"requests": 1, "prompt_tokens": 100, "completion_tokens": 50},
+        )
+        self.assertFalse(SummaryChunk.objects.exists())
+
+    def test_failed_generation_resumes_from_saved_chunks(self, call_api):
+        def fail_on_page_5(messages, **kwargs):
+            if "page 5:" in messages[0]["content"]:
+                raise ConnectionError
+            return self.answer(messages, **kwargs)
+
+        call_api.side_effect = fail_on_page_5
+        with self.assertRaises(ConnectionError):
+            self.generate()
+        self.assertEqual(SummaryChunk.objects.filter(level=0).count(), 5)
+
+        call_api.reset_mock()
+        call_api.side_effect = self.answer
+        self.generate()
+        # only the failed chunk is summarized again
+        self.assertEqual(call_api.call_count, 1 + 3 + 2 + 1)
+        self.assertEqual(self.summary.processing_status, "complete")
+
+    def test_small_files_are_summarized_in_one_request(self, call_api):
+        call_api.side_effect = self.answer
+        self.context_file.markdown_json = self.context_file.markdown_json[:2]
+        self.generate()
+
+        self.assertEqual(call_api.call_count, 1)
+        prompt = call_api.call_args.kwargs["messages"][0]["content"]
+        self.assertIn("book.pdf:\nFull text.", prompt)
+        self.assertEqual(list(self.summary.token_usage), ["final"])
+
+
+def stream_chunk(content=None, usage=None):
+    choices = []
+    if content is not None:
+        delta = SimpleNamespace(content=content, tool_calls=None)
+        choices = [SimpleNamespace(delta=delta)]
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+@override_settings(SUMMARY_STREAMING=True, SUMMARY_STREAM_SAVE_INTERVAL=0)
+class SummaryStreamingTests(TestCase):
+    def setUp(self):
+        encoding = byte_encoding("o200k_base")
+        patch_encodings(self, {"gpt-4o-mini": encoding, "o200k_base": encoding})
+        self.user = User.objects.create_user(username="student", password="password")
+        self.client.force_login(self.user)
+        self.summary = Summary.objects.create(topic="", user=self.user, text="")
+        self.context_file = ContextFile.objects.create(
+            user=self.user, filename="book.txt", full_text="Cells are small."
+        )
+
+    @patch("content.signals.call_api")
+    def test_partial_summary_is_saved_while_streaming(self, call_api):
+        partial_texts = []
+
+        def stream():
+            for content in ["# Cells\n\n", "Cells are ", "small."]:
+                yield stream_chunk(content)
+                summary = Summary.objects.get(id=self.summary.id)
+                partial_texts.append((summary.processing_status, summary.text))
+            usage = SimpleNamespace(prompt_tokens=30, completion_tokens=6)
+            yield stream_chunk(usage=usage)
+
+        call_api.return_value = stream()
+        create_summary(
+            Summary, context_files=[self.context_file], instance=self.summary
+        )
+
+        self.assertTrue(call_api.call_args.kwargs["stream_flag"])
+        self.assertEqual(
+            partial_texts,
+            [
+                ("streaming", "# Cells\n\n"),
+                ("streaming", "# Cells\n\nCells are "),
+                ("streaming", "# Cells\n\nCells are small."),
+            ],
+        )
+        self.summary.refresh_from_db()
+        self.assertEqual(self.summary.processing_status, "complete")
+        self.assertEqual(self.summary.topic, "Cells")
+        self.assertIn("Cells are small.", self.summary.html)
+        self.assertEqual(self.summary.token_usage["final"]["completion_tokens"], 6)
+
+    @patch("content.signals.call_api")
+    def test_interrupted_stream_is_generated_again(self, call_api):
+        def stream():
+            yield stream_chunk("# Cells")
+            raise ConnectionError
+
+        call_api.return_value = stream()
+        with self.assertRaises(ConnectionError):
+            create_summary(
+                Summary, context_files=[self.context_file], instance=self.summary
+            )
+        self.summary.refresh_from_db()
+        self.assertEqual(self.summary.processing_status, "pending")
+
+    @patch("content.signals.call_api")
+    def test_summary_fails_when_the_job_has_no_retry_left(self, call_api):
+        def stream():
+            yield stream_chunk("# Cells")
+            raise ConnectionError
+
+        call_api.side_effect = lambda *args, **kwargs: stream()
+        self.context_file.processing_status = "complete"
+        self.context_file.save(update_fields=["processing_status"])
+        enqueue_generation([self.context_file], self.summary)
+        Job.objects.update(max_attempts=1)
+
+        self.assertTrue(run_next_job("worker"))
+
+        self.assertEqual(Job.objects.get().status, "failed")
+        self.summary.refresh_from_db()
+        self.assertEqual(self.summary.processing_status, "error")
+        # an open stream is closed instead of polling until its timeout
+        with patch("content.views.time.sleep") as sleep:
+            response = self.client.get(
+                reverse("summary_stream", kwargs={"summary_id": self.summary.id})
+            )
+            events = b"".join(response.streaming_content).decode()
+        self.assertTrue(events.endswith("event: close\n\n"))
+        sleep.assert_not_called()
+
+    @patch("content.views.time.sleep")
+    def test_stream_view_sends_the_saved_html(self, sleep):
+        Summary.objects.filter(id=self.summary.id).update(
+            processing_status="streaming", html="<h1>Cells</h1>"
+        )
+
+        def generation_done(seconds):
+            Summary.objects.filter(id=self.summary.id).update(
+                processing_status="complete", html="<h1>Cells</h1><p>Done</p>"
+            )
+
+        sleep.side_effect = generation_done
+        response = self.client.get(
+            reverse("summary_stream", kwargs={"summary_id": self.summary.id})
+        )
+        self.assertEqual(response["Content-Type"], "text/event-stream; charset=utf-8")
+        events = b"".join(response.streaming_content).decode()
+        self.assertEqual(
+            events,
+            'data: {"text": "<h1>Cells</h1>"}\n\n'
+            'data: {"text": "<h1>Cells</h1><p>Done</p>"}\n\n'
+            "event: close\n\n",
+        )
+        sleep.assert_called_once()
+
+    def test_details_of_a_generated_summary_do_not_stream(self):
+        Summary.objects.filter(id=self.summary.id).update(processing_status="complete")
+        response = self.client.get(
+            reverse("summary_details", kwargs={"summary_id": self.summary.id})
+        )
+        self.assertNotContains(response, "EventSource")
@@ -18,4 +18,14 @@ urlpatterns = [
         views.summary_details,
         name="summary_details",
     ),
+    path(
+        "summary_stream/<str:summary_id>/",
+        views.summary_stream,
+        name="summary_stream",
+    ),
+    path(
+        "asummary_stream/<str:summary_id>/",
+        views.asummary_stream,
+        name="asummary_stream",
+    ),
 ]
@@ -1,6 +1,11 @@
-import threading
+import asyncio
+import json
+import time
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
 from django.shortcuts import redirect, render
-from documents.signals import process_files
+from documents.signals import enqueue_file_processing
 from services.models import get_default_request_config
 from .models import BaseProcessModel, Question, Quiz, Option, Score, Summary
 from .forms import (
@@ -10,9 +15,7 @@ from .forms import (
     DeleteSummary,
     QuestionForm,
 )
-from .signals import (
-    check_files_ready_signal,
-)
+from .signals import enqueue_generation
 from documents.models import ContextFile
 from django.contrib import messages as django_messages
 import os
@@ -25,11 +28,6 @@ def base(request):
     return render(request, "content/content.html")
 
 
-def signal_files_ready(context_files, instance):
-    process_files(context_files, instance.request_config.language_model.name)
-    check_files_ready_signal(context_files, instance)
-
-
 def process_uploaded_files(uploaded_files, instance: BaseProcessModel):
     new_context_files = []
     for file in uploaded_files:
@@ -44,24 +42,20 @@ def process_uploaded_files(uploaded_files, instance: BaseProcessModel):
         instance.request_config = get_default_request_config()
         instance.save()
 
-    thread = threading.Thread(
-        target=signal_files_ready,
-        args=(new_context_files, instance),
+    enqueue_file_processing(
+        new_context_files, instance.request_config.language_model.name
     )
-    thread.start()
+    enqueue_generation(new_context_files, instance)
 
 
 def process_selected_files(selected_files, instance: BaseProcessModel):
     instance.context_files.set(selected_files)
-    thread = threading.Thread(
-        target=check_files_ready_signal, args=(selected_files, instance)
-    )
-    thread.start()
+    enqueue_generation(selected_files, instance)
 
 
 def create_quiz(request):
     if request.method == "POST":
-        form = CreateQuizForm(request.POST, request.FILES)
+        form = CreateQuizForm(request.POST, request.FILES, user=request.user)
         if form.is_valid():
             user = request.user
             form.instance.user = user
@@ -151,7 +145,7 @@ class QuizListView(SingleTableView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["create_quizz_form"] = CreateQuizForm()
+        context["create_quizz_form"] = CreateQuizForm(user=self.request.user)
         context["delete_forms"] = [
             DeleteQuiz(instance=quiz) for quiz in context["quizzes"]
         ]
@@ -201,7 +195,7 @@ def quiz_details(request, quizz_id, start_time=None):
 
 def create_summary(request):
     if request.method == "POST":
-        form = CreateSummaryForm(request.POST, request.FILES)
+        form = CreateSummaryForm(request.POST, request.FILES, user=request.user)
         if form.is_valid():
             uploaded_files = form.cleaned_data.get("files")
             selected_files = form.cleaned_data.get("selected_files")
@@ -242,7 +236,7 @@ class SummaryListView(SingleTableView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["create_summary_form"] = CreateSummaryForm()
+        context["create_summary_form"] = CreateSummaryForm(user=self.request.user)
         context["delete_forms"] = [
             DeleteSummary(instance=summary) for summary in context["summaries"]
         ]
@@ -251,4 +245,77 @@ class SummaryListView(SingleTableView):
 
 def summary_details(request, summary_id):
     summary = Summary.objects.get(id=summary_id)
-    return render(request, "content/summary_details.html", {"summary": summary})
+    context = {
+        "summary": summary,
+        "generating": summary.processing_status in ["pending", "streaming"],
+        # under ASGI the summary is streamed without holding a worker thread
+        "stream_view": (
+            "asummary_stream" if isinstance(request, ASGIRequest) else "summary_stream"
+        ),
+    }
+    return render(request, "content/summary_details.html", context)
+
+
+SUMMARY_STREAM_FIELDS = ["html", "processing_status"]
+
+
+def get_summary_event(summary: dict | None, sent_html: str | None) -> str | None:
+    """The event sending the html of `summary` if it changed since `sent_html`."""
+    if summary and summary["html"] and summary["html"] != sent_html:
+        return f"data: {json.dumps({'text': summary['html']})}\n\n"
+    return None
+
+
+def is_summary_generated(summary: dict | None) -> bool:
+    return summary is None or summary["processing_status"] not in [
+        "pending",
+        "streaming",
+    ]
+
+
+def yield_summary_stream(summaries):
+    """Send the html of the summary whenever the generation job saved it."""
+    sent_html = None
+    deadline = time.monotonic() + settings.SUMMARY_STREAM_TIMEOUT
+    while True:
+        summary = summaries.values(*SUMMARY_STREAM_FIELDS).first()
+        if event := get_summary_event(summary, sent_html):
+            sent_html = summary["html"]
+            yield event
+        if is_summary_generated(summary) or time.monotonic() > deadline:
+            break
+        time.sleep(settings.SUMMARY_STREAM_POLL_INTERVAL)
+    yield "event: close\n\n"
+
+
+async def ayield_summary_stream(summaries):
+    """Async version of `yield_summary_stream`."""
+    sent_html = None
+    deadline = time.monotonic() + settings.SUMMARY_STREAM_TIMEOUT
+    while True:
+        summary = await summaries.values(*SUMMARY_STREAM_FIELDS).afirst()
+        if event := get_summary_event(summary, sent_html):
+            sent_html = summary["html"]
+            yield event
+        if is_summary_generated(summary) or time.monotonic() > deadline:
+            break
+        await asyncio.sleep(settings.SUMMARY_STREAM_POLL_INTERVAL)
+    yield "event: close\n\n"
+
+
+def summary_stream(request, summary_id):
+    summaries = Summary.objects.filter(id=summary_id, user=request.user)
+    return StreamingHttpResponse(
+        yield_summary_stream(summaries),
+        content_type="text/event-stream; charset=utf-8",
+    )
+
+
+async def asummary_stream(request, summary_id):
+    """ASGI version of `summary_stream`, no thread is held while streaming."""
+    user = await request.auser()
+    summaries = Summary.objects.filter(id=summary_id, user=user)
+    return StreamingHttpResponse(
+        ayield_summary_stream(summaries),
+        content_type="text/event-stream; charset=utf-8",
+    )
@@ -1,6 +1,30 @@
 from django.contrib import admin
 
 
-from .models import ContextFile
+from .models import ContextFile, ExtractionCache
 
 admin.site.register(ContextFile)
+
+
+class ExtractionCacheAdmin(admin.ModelAdmin):
+    list_display = (
+        "content_hash",
+        "extractor_version",
+        "file_size",
+        "hits",
+        "created_at",
+        "last_hit_at",
+    )
+    search_fields = ("content_hash",)
+    list_filter = ("extractor_version",)
+    exclude = ("full_text", "markdown_json", "html")
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = {
+            **(extra_context or {}),
+            "extraction_stats": ExtractionCache.get_stats(),
+        }
+        return super().changelist_view(request, extra_context)
+
+
+admin.site.register(ExtractionCache, ExtractionCacheAdmin)
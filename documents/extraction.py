@@ -0,0 +1,129 @@
+import json
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import fitz
+import pymupdf4llm
+from django.conf import settings
+
+# Only the module level functions run in the worker processes, they must not
+# touch the database or any other Django machinery.
+
+# part of the extraction cache key, bump the revision when the processing changes
+EXTRACTOR_VERSION = f"pymupdf4llm-{pymupdf4llm.version}-2"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_extraction_pool() -> ProcessPoolExecutor | None:
+    """Return the process-wide extraction pool, None to extract in-process."""
+    global _pool
+    if not settings.PDF_EXTRACTION_WORKERS:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # spawn, forking a process running threads and DB connections is unsafe
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.PDF_EXTRACTION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def shutdown_extraction_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def open_pdf(source: bytes | str) -> fitz.Document:
+    """Open a PDF from its content or from its path."""
+    if isinstance(source, bytes):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source, filetype="pdf")
+
+
+def extract_pages(source: bytes | str, pages: list[int], hdr_info) -> list[dict]:
+    """Extract the markdown page chunks of `pages` (0-based) of a PDF.
+
+    The chunks are returned JSON compatible, as they are stored in
+    `ContextFile.markdown_json`.
+    """
+    doc = open_pdf(source)
+    chunks = pymupdf4llm.to_markdown(
+        doc, pages=pages, hdr_info=hdr_info, page_chunks=True, show_progress=False
+    )
+    return json.loads(json.dumps(chunks, ensure_ascii=False, default=str))
+
+
+def get_page_shards(page_count: int, pages_per_shard: int) -> list[list[int]]:
+    return [
+        list(range(start, min(start + pages_per_shard, page_count)))
+        for start in range(0, page_count, pages_per_shard)
+    ]
+
+
+class PDFExtraction:
+    """Extraction of one PDF, split in page ranges run in the extraction pool.
+
+    `source` is the content or, cheaper to send to every worker, the path of
+    the PDF. The shards are submitted on creation, so several files can be
+    extracted at once before the first `result()` call. Without a pool the
+    shards are extracted by `result()`.
+    """
+
+    def __init__(self, source: bytes | str, pages_per_shard: int = None):
+        pages_per_shard = pages_per_shard or settings.PDF_PAGES_PER_SHARD
+        doc = open_pdf(source)
+        self.source = source
+        self.page_count = doc.page_count
+        # identify headers on the whole document so every shard uses the same levels
+        self.hdr_info = pymupdf4llm.IdentifyHeaders(doc)
+        self.shards = get_page_shards(doc.page_count, pages_per_shard)
+        self.futures = self.submit()
+
+    def submit(self) -> list[Future] | None:
+        pool = get_extraction_pool()
+        if pool is None:
+            return None
+        futures = []
+        for pages in self.shards:
+            args = (extract_pages, self.source, pages, self.hdr_info)
+            try:
+                futures.append(pool.submit(*args))
+            except BrokenProcessPool:
+                # a worker died (e.g. killed out of memory), start a new pool
+                shutdown_extraction_pool()
+                pool = get_extraction_pool()
+                futures.append(pool.submit(*args))
+        return futures
+
+    def result(self, on_progress=None) -> list[dict]:
+        """Wait for all shards, returns the page chunks in page order.
+
+        `on_progress(pages_done, page_count)` is called whenever a shard is done,
+        shards may complete in any order.
+        """
+        results = [None] * len(self.shards)
+        pages_done = 0
+        if self.futures is None:
+            completed = (
+                (i, extract_pages(self.source, pages, self.hdr_info))
+                for i, pages in enumerate(self.shards)
+            )
+        else:
+            indexes = {future: i for i, future in enumerate(self.futures)}
+            completed = (
+                (indexes[future], future.result())
+                for future in as_completed(self.futures)
+            )
+        for i, chunks in completed:
+            results[i] = chunks
+            pages_done += len(self.shards[i])
+            if on_progress:
+                on_progress(pages_done, self.page_count)
+        return [chunk for chunks in results for chunk in chunks]
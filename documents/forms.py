@@ -43,11 +43,12 @@ class FileUploadForm(forms.Form):
 class FileUploadOrSelectForm(forms.Form):
     uploaded_files = MultipleFileField(required=False)
     selected_files = forms.ModelMultipleChoiceField(
-        queryset=ContextFile.objects.all(), required=False
+        queryset=ContextFile.light.none(), required=False
     )
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, user=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.fields["selected_files"].queryset = ContextFile.light.for_user(user)
         self.helper = FormHelper()
         self.helper.layout = Layout(
             Field("uploaded_files"),  # File field for upload
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from documents.models import ContextFile
+
+
+class Command(BaseCommand):
+    help = "Stores the page rows of processed files uploaded before pages were stored."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Rebuild the pages of every processed file.",
+        )
+
+    def handle(self, *args, **options):
+        context_files = ContextFile.objects.filter(processing_status="complete")
+        if not options["all"]:
+            context_files = context_files.filter(pages__isnull=True)
+        built = 0
+        for context_file in context_files.iterator():
+            context_file.store_pages()
+            built += 1
+        print(f"Stored the pages of {built} files.")
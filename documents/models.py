@@ -1,9 +1,9 @@
-from django.db import models
+from django.db import models, transaction
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
 import os
 
-from services.llm_handler import get_markdown
+from services.llm_handler import MARKDOWN_RENDERER_VERSION, get_markdown
 
 
 def validate_file_extension(value):
@@ -26,6 +26,22 @@ def user_directory_path(instance, filename):
     return f"{username}/{filename}"
 
 
+# columns holding the whole processed document, megabytes for long files
+TEXT_FIELDS = ["full_text", "markdown_json", "html"]
+
+
+class ContextFileQuerySet(models.QuerySet):
+    def for_user(self, user):
+        return self.filter(user=user)
+
+
+class LightContextFileManager(models.Manager.from_queryset(ContextFileQuerySet)):
+    """Files without their text columns, to list and select them."""
+
+    def get_queryset(self):
+        return super().get_queryset().defer(*TEXT_FIELDS)
+
+
 class ContextFile(models.Model):
     file = models.FileField(
         upload_to=user_directory_path,
@@ -38,42 +54,129 @@ class ContextFile(models.Model):
     processing_time = models.DurationField(blank=True, null=True)
     filename = models.CharField(max_length=100, blank=True, null=True)
     html = models.TextField(blank=True, null=True)
+    content_hash = models.CharField(
+        max_length=64, blank=True, null=True, db_index=True
+    )  # SHA-256 of the file
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
+    objects = ContextFileQuerySet.as_manager()
+    light = LightContextFileManager()
+
     def __str__(self):
         return self.filename
 
     def get_paginated_text(self):
-        total_pages = self.markdown_json[0]["metadata"]["page_count"]
-        text = f"Filename: {self.filename}, Total pages:({total_pages})\n"
-        for page in self.markdown_json:
-            text += f"[Page {page['metadata']['page']}]:\n"
-            text += page["text"]
-        return text
+        pages = list(self.pages.only("page", "text"))
+        parts = [f"Filename: {self.filename}, Total pages:({len(pages)})\n"]
+        for page in pages:
+            parts.append(f"[Page {page.page}]:\n{page.text}")
+        return "".join(parts)
 
     def get_html_content(self):
         return f"{self.filename}:\n{self.html}"
 
     def get_pages(self, start_page, end_page, in_html=False):
-        text = f"Pages {start_page} to {end_page} from {self.filename}:\n"
-        html = get_markdown(text)
-        for page in self.markdown_json:
-            if (
-                page["metadata"]["page"] >= start_page
-                and page["metadata"]["page"] <= end_page
-            ):
-                text += f"[Page {page['metadata']['page']}]:\n{page['text']}"
-                html += get_markdown(
-                    f"[Page {page['metadata']['page']}]:\n{page['text']}"
-                )
+        """The text (or html) of pages `start_page` to `end_page`, read from their rows."""
+        header = f"Pages {start_page} to {end_page} from {self.filename}:\n"
+        pages = self.pages.filter(page__gte=start_page, page__lte=end_page)
         if in_html:
-            return html
-        return text
+            # the text is only loaded for the pages rendered again
+            pages = list(
+                pages.only("id", "context_file", "page", "html", "html_version")
+            )
+            stale = [page for page in pages if not page.has_current_html()]
+            if stale:
+                texts = dict(
+                    ContextFilePage.objects.filter(
+                        id__in=[page.id for page in stale]
+                    ).values_list("id", "text")
+                )
+                for page in stale:
+                    page.text = texts[page.id]
+                    page.update_html()
+                ContextFilePage.objects.bulk_update(stale, ["html", "html_version"])
+            return get_markdown(header, "document") + "".join(
+                page.html for page in pages
+            )
+        return header + "".join(
+            f"[Page {page}]:\n{text}"
+            for page, text in pages.values_list("page", "text")
+        )
 
     def get_full_text(self):
         return f"{self.filename}:\n{self.full_text}"
 
+    def build_pages(self) -> list["ContextFilePage"]:
+        """The rendered, unsaved page rows of the page chunks.
+
+        A text file is a single page.
+        """
+        if self.markdown_json:
+            chunks = [
+                (chunk["metadata"]["page"], chunk["text"], chunk.get("token_amount"))
+                for chunk in self.markdown_json
+            ]
+        else:
+            chunks = [(1, self.full_text or "", self.token_amount)]
+        pages = [
+            ContextFilePage(
+                context_file=self, page=page, text=text, token_amount=token_amount
+            )
+            for page, text, token_amount in chunks
+        ]
+        for page in pages:
+            page.update_html()
+        return pages
+
+    def replace_pages(self, pages: list["ContextFilePage"]):
+        with transaction.atomic():
+            self.pages.all().delete()
+            ContextFilePage.objects.bulk_create(pages)
+
+    def store_pages(self):
+        """Replace the page rows with the page chunks."""
+        self.replace_pages(self.build_pages())
+
+
+class ContextFilePage(models.Model):
+    """A page of a processed file, so page ranges are read without the whole file."""
+
+    context_file = models.ForeignKey(
+        ContextFile, on_delete=models.CASCADE, related_name="pages"
+    )
+    page = models.PositiveIntegerField()  # 1-based, as in the page chunks
+    text = models.TextField()
+    token_amount = models.IntegerField(blank=True, null=True)
+    html = models.TextField(blank=True, null=True)
+    # MARKDOWN_RENDERER_VERSION the html was rendered with
+    html_version = models.CharField(max_length=50, blank=True)
+
+    class Meta:
+        ordering = ["context_file", "page"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["context_file", "page"], name="unique_page_per_file"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.context_file_id}, page {self.page}"
+
+    def has_current_html(self) -> bool:
+        return self.html is not None and self.html_version == MARKDOWN_RENDERER_VERSION
+
+    def update_html(self) -> bool:
+        """Render the page unless its html is of the current renderer version.
+
+        Returns True if the page was rendered and has to be saved.
+        """
+        if self.has_current_html():
+            return False
+        self.html = get_markdown(f"[Page {self.page}]:\n{self.text}", "document")
+        self.html_version = MARKDOWN_RENDERER_VERSION
+        return True
+
 
 class FileReference(models.Model):
     context_file = models.ForeignKey(ContextFile, on_delete=models.CASCADE)
@@ -84,3 +187,43 @@ class FileReference(models.Model):
         return self.context_file.get_pages(
             self.start_page_index, self.end_page_index, in_html
         )
+
+
+class ExtractionCache(models.Model):
+    """Processed content of a file, shared by all ContextFiles with the same content."""
+
+    content_hash = models.CharField(max_length=64)
+    extractor_version = models.CharField(max_length=50)
+    full_text = models.TextField(blank=True, null=True)
+    markdown_json = models.JSONField(blank=True, null=True)
+    html = models.TextField(blank=True, null=True)
+    token_amount = models.IntegerField(blank=True, null=True)
+    token_encoding = models.CharField(max_length=50)  # tiktoken encoding counted with
+    file_size = models.PositiveBigIntegerField(default=0)
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_hit_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name_plural = "extraction cache"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["content_hash", "extractor_version"],
+                name="unique_extraction_per_version",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.content_hash[:12]} ({self.extractor_version})"
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        stats = cls.objects.aggregate(
+            entries=models.Count("id"),
+            total_hits=models.Sum("hits", default=0),
+            bytes_saved=models.Sum(models.F("hits") * models.F("file_size"), default=0),
+        )
+        # every entry was created by a miss
+        lookups = stats["total_hits"] + stats["entries"]
+        stats["hit_rate"] = stats["total_hits"] / lookups if lookups else 0.0
+        return stats
@@ -1,15 +1,19 @@
 from django.db.models.signals import pre_delete, post_delete
 from django.dispatch import receiver
-from .models import ContextFile
+from .extraction import EXTRACTOR_VERSION, PDFExtraction
+from .models import ContextFile, ExtractionCache
 from services.llm_handler import get_markdown
+from services.tokenizer import count_page_tokens, count_tokens, get_encoder
 from chat.models import Message
-import fitz
-import pymupdf4llm
-import tiktoken
 import os
+import hashlib
 import logging
 import json
+from django.db import transaction
+from django.db.models import F
 from django.utils import timezone
+from jobs.models import Job
+from jobs.queue import UNFINISHED_STATUSES, enqueue, task
 
 logger = logging.getLogger("django.server")
 
@@ -25,80 +29,193 @@ def delete_empty_messages(sender, instance, **kwargs):
             message.delete()
 
 
-# add a queue for multiple files
-def process_pdf(file_bytes, model_name):
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
-
-    markdown_json = pymupdf4llm.to_markdown(doc, page_chunks=True, show_progress=False)
+def process_pdf(source, model_name, on_progress=None):
+    markdown_json = PDFExtraction(source).result(on_progress)
     full_text = "".join([chunk["text"] for chunk in markdown_json])
 
-    # Tokenize the extracted text
-    encoder = tiktoken.encoding_for_model(model_name)
-    tokenized_text = encoder.encode(full_text)
-
     return {
         "full_text": full_text,
         "markdown_json": markdown_json,
-        "token_amount": len(tokenized_text),
+        "token_amount": count_page_tokens(markdown_json, model_name),
     }
 
 
 def process_txt(file_bytes, model_name):
     full_text = file_bytes.decode("utf-8")
 
-    # Tokenize the extracted text
-    encoder = tiktoken.encoding_for_model(model_name)
-    tokenized_text = encoder.encode(full_text)
-
     return {
         "full_text": full_text,
         "markdown_json": None,  # No markdown for TXT
-        "token_amount": len(tokenized_text),
+        "token_amount": count_tokens(full_text, model_name),
     }
 
 
-def process_context_file(context_file: ContextFile, model_name: str):
-    file_path = context_file.file.path
-    ext = os.path.splitext(file_path)[1].lower()
-    file_bytes = context_file.file.read()
+def get_extension(context_file: ContextFile) -> str:
+    return os.path.splitext(context_file.file.name)[1].lower()
+
+
+def get_pdf_source(context_file: ContextFile) -> bytes | str:
+    """The path of the file if stored locally, so extraction workers open it."""
+    try:
+        return context_file.file.path
+    except NotImplementedError:
+        return context_file.file.read()
+
+
+def process_context_file(context_file: ContextFile, model_name: str, on_progress=None):
+    ext = get_extension(context_file)
     if ext == ".pdf":
-        data = process_pdf(file_bytes, model_name)
+        data = process_pdf(get_pdf_source(context_file), model_name, on_progress)
     elif ext == ".txt":
-        data = process_txt(file_bytes, model_name)
+        data = process_txt(context_file.file.read(), model_name)
     else:
         raise ValueError(f"Unsupported file type: {ext}")
-    data["html"] = get_markdown(data["full_text"])
+    data["html"] = get_markdown(data["full_text"], "document")
     return data
 
 
+def get_content_hash(file) -> str:
+    """SHA-256 of the content of a stored file."""
+    sha256 = hashlib.sha256()
+    file.open("rb")
+    for chunk in file.chunks():
+        sha256.update(chunk)
+    file.seek(0)
+    return sha256.hexdigest()
+
+
+def get_cached_extraction(context_file: ContextFile) -> ExtractionCache | None:
+    """The cached processing of a file with the same content, hashing it if needed."""
+    if not context_file.content_hash:
+        context_file.content_hash = get_content_hash(context_file.file)
+        context_file.save(update_fields=["content_hash"])
+    return ExtractionCache.objects.filter(
+        content_hash=context_file.content_hash, extractor_version=EXTRACTOR_VERSION
+    ).first()
+
+
+def load_cached_extraction(cached: ExtractionCache, model_name: str) -> dict:
+    markdown_json = cached.markdown_json
+    if cached.token_encoding == get_encoder(model_name).name:
+        token_amount = cached.token_amount
+    elif markdown_json:
+        token_amount = count_page_tokens(markdown_json, model_name)
+    else:
+        token_amount = count_tokens(cached.full_text or "", model_name)
+    ExtractionCache.objects.filter(id=cached.id).update(
+        hits=F("hits") + 1, last_hit_at=timezone.now()
+    )
+    return {
+        "full_text": cached.full_text,
+        "markdown_json": markdown_json,
+        "html": cached.html,
+        "token_amount": token_amount,
+    }
+
+
+def cache_extraction(context_file: ContextFile, processed_data: dict, model_name: str):
+    ExtractionCache.objects.get_or_create(
+        content_hash=context_file.content_hash,
+        extractor_version=EXTRACTOR_VERSION,
+        defaults={
+            "full_text": processed_data["full_text"],
+            "markdown_json": processed_data["markdown_json"],
+            "html": processed_data["html"],
+            "token_amount": processed_data["token_amount"],
+            "token_encoding": get_encoder(model_name).name,
+            "file_size": context_file.file.size,
+        },
+    )
+
+
 def handle_file_processing(context_file: ContextFile, model_name: str):
-    """Function to handle file processing in a separate thread."""
+    """Process `context_file` and store the results."""
     start_time = timezone.now()
     context_file.processing_status = "processing"
     context_file.save(update_fields=["processing_status"])
+
+    def report_progress(pages_done, page_count):
+        percent = pages_done * 100 // page_count
+        context_file.processing_status = f"processing {percent}%"
+        context_file.save(update_fields=["processing_status"])
+
     try:
-        processed_data = process_context_file(context_file, model_name)
-    except Exception as e:
-        logger.error(f"Error processing file {context_file.file.name}: {e}")
-        context_file.processing_status = "error"
-        raise e
-    else:
+        cached = get_cached_extraction(context_file)
+        if cached:
+            processed_data = load_cached_extraction(cached, model_name)
+        else:
+            processed_data = process_context_file(
+                context_file, model_name, report_progress
+            )
+            cache_extraction(context_file, processed_data, model_name)
         # Update the instance with processed data
         context_file.full_text = processed_data["full_text"]
         context_file.markdown_json = json.loads(
             json.dumps(processed_data["markdown_json"], ensure_ascii=False, default=str)
         )
         context_file.token_amount = processed_data["token_amount"]
-        context_file.processing_status = "complete"
         context_file.html = processed_data["html"]
-        context_file.processing_time = timezone.now() - start_time
-    context_file.save()
+        pages = context_file.build_pages()
+    except Exception as e:
+        logger.error(f"Error processing file {context_file.file.name}: {e}")
+        context_file.processing_status = "error"
+        context_file.save(update_fields=["processing_status"])
+        raise e
+    context_file.processing_status = "complete"
+    context_file.processing_time = timezone.now() - start_time
+    # a complete file always has its pages
+    with transaction.atomic():
+        context_file.save()
+        context_file.replace_pages(pages)
+
+
+@task("documents.process_file")
+def process_file(context_file_id: int, model_name: str):
+    context_file = ContextFile.objects.get(id=context_file_id)
+    if context_file.processing_status != "complete":
+        handle_file_processing(context_file, model_name)
+
+
+def processing_failed(context_files) -> bool:
+    """Whether processing of one of `context_files` failed without a retry left."""
+    failed_ids = {
+        context_file.id
+        for context_file in context_files
+        if context_file.processing_status == "error"
+    }
+    if not failed_ids:
+        return False
+    retried_ids = set(
+        Job.objects.filter(
+            task="documents.process_file",
+            status__in=["pending", "running"],
+            kwargs__context_file_id__in=failed_ids,
+        ).values_list("kwargs__context_file_id", flat=True)
+    )
+    return bool(failed_ids - retried_ids)
+
+
+def enqueue_file_processing(context_files, model_name: str) -> list[Job]:
+    """Queue one processing job per file for `manage.py run_workers`."""
+    return [
+        enqueue(
+            "documents.process_file",
+            context_file_id=context_file.id,
+            model_name=model_name,
+        )
+        for context_file in context_files
+    ]
 
 
-def process_files(context_files, model_name: str):
-    for context_file in context_files:
-        if context_file.processing_status == "pending":
-            handle_file_processing(context_file, model_name)
+def get_processing_jobs(context_files) -> list[Job]:
+    """The unfinished processing jobs of `context_files`, to depend on."""
+    return list(
+        Job.objects.filter(
+            task="documents.process_file",
+            status__in=UNFINISHED_STATUSES,
+            kwargs__context_file_id__in=[file.id for file in context_files],
+        )
+    )
 
 
 @receiver(post_delete, sender=ContextFile)
@@ -1,8 +1,22 @@
 import os
-from django.test import TestCase
+import tempfile
+from unittest.mock import patch
+import fitz
+import pymupdf4llm
+from django.test import TestCase, override_settings
 from django.contrib.auth.models import User
-from .models import ContextFile
+from jobs.models import Job
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from chat.models import Chat, Message
+from .models import TEXT_FIELDS, ContextFile, ContextFilePage, ExtractionCache
+from .extraction import PDFExtraction, shutdown_extraction_pool
+from .signals import handle_file_processing, processing_failed
 from django.core.files.uploadedfile import SimpleUploadedFile
+from services.llm_handler import MARKDOWN_RENDERER_VERSION
+from services.tests import byte_encoding, patch_encodings
 
 
 class DocumentsModelTests(TestCase):
@@ -31,6 +45,7 @@ class DocumentsModelTests(TestCase):
                 processing_status="complete",
                 file=self.file,
             )
+            self.addCleanup(self.context_file.file.delete, save=False)
 
     def test_context_file_creation(self):
         self.assertEqual(self.context_file.filename, "test_document.txt")
@@ -68,3 +83,307 @@ class DocumentsModelTests(TestCase):
         self.assertEqual(
             self.context_file.html, "<p>This is a test document in HTML format.</p>"
         )
+
+    def test_processing_failed_once_no_retry_is_queued(self):
+        self.context_file.processing_status = "error"
+        job = Job.objects.create(
+            task="documents.process_file",
+            kwargs={"context_file_id": self.context_file.id, "model_name": "gpt-4o"},
+        )
+        self.assertFalse(processing_failed([self.context_file]))
+        Job.objects.filter(id=job.id).update(status="failed")
+        self.assertTrue(processing_failed([self.context_file]))
+
+
+def make_pdf(page_count: int) -> bytes:
+    doc = fitz.open()
+    for number in range(page_count):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Chapter {number}", fontsize=20)
+        page.insert_text((72, 110), f"Text of page {number}.", fontsize=10)
+    return doc.tobytes()
+
+
+class PDFExtractionTests(TestCase):
+    def setUp(self):
+        self.file_bytes = make_pdf(5)
+        doc = fitz.open(stream=self.file_bytes, filetype="pdf")
+        self.expected = pymupdf4llm.to_markdown(
+            doc, page_chunks=True, show_progress=False
+        )
+
+    def assertMatchesSerialExtraction(self, chunks):
+        self.assertEqual(
+            [chunk["metadata"]["page"] for chunk in chunks], [1, 2, 3, 4, 5]
+        )
+        self.assertEqual(
+            [chunk["text"] for chunk in chunks],
+            [chunk["text"] for chunk in self.expected],
+        )
+
+    @override_settings(PDF_EXTRACTION_WORKERS=0)
+    def test_in_process_extraction(self):
+        progress = []
+        extraction = PDFExtraction(self.file_bytes, pages_per_shard=2)
+        self.assertEqual(extraction.shards, [[0, 1], [2, 3], [4]])
+        chunks = extraction.result(lambda done, total: progress.append((done, total)))
+        self.assertMatchesSerialExtraction(chunks)
+        self.assertEqual(progress, [(2, 5), (4, 5), (5, 5)])
+
+    @override_settings(PDF_EXTRACTION_WORKERS=2)
+    def test_pool_extraction_from_path(self):
+        self.addCleanup(shutdown_extraction_pool)
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as f:
+            f.write(self.file_bytes)
+            f.flush()
+            progress = []
+            extraction = PDFExtraction(f.name, pages_per_shard=1)
+            chunks = extraction.result(lambda done, total: progress.append(done))
+        # shards complete in any order, the chunks are merged in page order
+        self.assertMatchesSerialExtraction(chunks)
+        self.assertEqual(progress, [1, 2, 3, 4, 5])
+
+    @override_settings(PDF_EXTRACTION_WORKERS=0, PDF_PAGES_PER_SHARD=2)
+    def test_processing_reports_progress(self):
+        patch_encodings(self, {"gpt-4o": byte_encoding("o200k_base")})
+        user = User.objects.create_user(username="reader", password="password")
+        context_file = ContextFile.objects.create(
+            user=user, file=SimpleUploadedFile("book.pdf", self.file_bytes)
+        )
+        self.addCleanup(context_file.file.delete, save=False)
+        statuses = []
+        save = ContextFile.save
+
+        def record_status(instance, *args, **kwargs):
+            statuses.append(instance.processing_status)
+            save(instance, *args, **kwargs)
+
+        with patch.object(ContextFile, "save", record_status):
+            handle_file_processing(context_file, "gpt-4o")
+
+        self.assertEqual(
+            statuses,
+            [
+                "processing",
+                "processing",  # content hash
+                "processing 40%",
+                "processing 80%",
+                "processing 100%",
+                "complete",
+            ],
+        )
+        context_file.refresh_from_db()
+        self.assertEqual(
+            [chunk["metadata"]["page"] for chunk in context_file.markdown_json],
+            [1, 2, 3, 4, 5],
+        )
+        self.assertEqual(
+            context_file.token_amount,
+            sum(chunk["token_amount"] for chunk in context_file.markdown_json),
+        )
+
+
+class ExtractionCacheTests(TestCase):
+    def setUp(self):
+        patch_encodings(
+            self,
+            {
+                "gpt-4o": byte_encoding("o200k_base"),
+                "gpt-4": byte_encoding("cl100k_base", merges=[b"no"]),
+            },
+        )
+        self.content = b"Shared lecture notes."
+        self.users = [
+            User.objects.create_user(username=f"user{i}", password="password")
+            for i in range(2)
+        ]
+
+    def create_context_file(self, user):
+        context_file = ContextFile.objects.create(
+            user=user, file=SimpleUploadedFile("notes.txt", self.content)
+        )
+        self.addCleanup(context_file.file.delete, save=False)
+        return context_file
+
+    def test_duplicate_upload_reuses_extraction(self):
+        first = self.create_context_file(self.users[0])
+        handle_file_processing(first, "gpt-4o")
+
+        duplicate = self.create_context_file(self.users[1])
+        with patch("documents.signals.process_context_file") as process_context_file:
+            handle_file_processing(duplicate, "gpt-4o")
+        process_context_file.assert_not_called()
+
+        duplicate.refresh_from_db()
+        self.assertEqual(duplicate.content_hash, first.content_hash)
+        self.assertEqual(duplicate.processing_status, "complete")
+        self.assertEqual(duplicate.full_text, "Shared lecture notes.")
+        self.assertEqual(duplicate.html, first.html)
+        self.assertEqual(duplicate.token_amount, 21)
+        self.assertEqual(duplicate.pages.get().text, "Shared lecture notes.")
+        self.assertEqual(
+            ExtractionCache.get_stats(),
+            {
+                "entries": 1,
+                "total_hits": 1,
+                "bytes_saved": len(self.content),
+                "hit_rate": 0.5,
+            },
+        )
+
+    def test_tokens_are_recounted_for_another_encoding(self):
+        handle_file_processing(self.create_context_file(self.users[0]), "gpt-4o")
+        duplicate = self.create_context_file(self.users[1])
+        handle_file_processing(duplicate, "gpt-4")
+        self.assertEqual(duplicate.token_amount, 20)  # "no" is one token
+
+    def test_file_is_not_complete_without_its_pages(self):
+        context_file = self.create_context_file(self.users[0])
+        with patch("documents.models.get_markdown", side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                handle_file_processing(context_file, "gpt-4o")
+        context_file.refresh_from_db()
+        self.assertEqual(context_file.processing_status, "error")
+        self.assertFalse(context_file.pages.exists())
+
+    def test_admin_reports_dedup_stats(self):
+        admin = User.objects.create_superuser(username="admin", password="password")
+        self.client.force_login(admin)
+        response = self.client.get("/admin/documents/extractioncache/")
+        self.assertContains(response, "Hit rate")
+        self.assertContains(response, "Bytes saved")
+
+
+class ContextFilePageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="password")
+        self.context_file = ContextFile.objects.create(
+            user=self.user,
+            filename="book.pdf",
+            processing_status="complete",
+            markdown_json=[
+                {
+                    "metadata": {"page": page, "page_count": 5},
+                    "text": f"Text of page {page}.",
+                    "token_amount": 5,
+                }
+                for page in range(1, 6)
+            ],
+        )
+        self.context_file.store_pages()
+
+    def test_page_ranges_are_read_from_their_rows(self):
+        with self.assertNumQueries(1):
+            text = self.context_file.get_pages(2, 3)
+        self.assertEqual(
+            text,
+            "Pages 2 to 3 from book.pdf:\n"
+            "[Page 2]:\nText of page 2.[Page 3]:\nText of page 3.",
+        )
+        html = self.context_file.get_pages(2, 3, in_html=True)
+        self.assertIn("<p>[Page 3]:\nText of page 3.</p>", html)
+        self.assertNotIn("page 4", html)
+
+    def test_page_html_is_rendered_once(self):
+        self.assertEqual(
+            set(self.context_file.pages.values_list("html_version", flat=True)),
+            {MARKDOWN_RENDERER_VERSION},
+        )
+        with patch("documents.models.get_markdown", return_value="") as get_markdown:
+            with CaptureQueriesContext(connection) as queries:
+                self.context_file.get_pages(1, 5, in_html=True)
+        get_markdown.assert_called_once()  # the header
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('"documents_contextfilepage"."text"', queries[0]["sql"])
+
+    def test_pages_of_another_renderer_version_are_rendered_again(self):
+        self.context_file.pages.filter(page=2).update(
+            html="<p>old</p>", html_version="mistune-0.1"
+        )
+        # the pages, the text of the stale page, then its update
+        with self.assertNumQueries(3):
+            html = self.context_file.get_pages(1, 3, in_html=True)
+        self.assertNotIn("old", html)
+        page = self.context_file.pages.get(page=2)
+        self.assertEqual(page.html, "<p>[Page 2]:\nText of page 2.</p>\n")
+        self.assertEqual(page.html_version, MARKDOWN_RENDERER_VERSION)
+
+    def test_paginated_text(self):
+        text = self.context_file.get_paginated_text()
+        self.assertTrue(text.startswith("Filename: book.pdf, Total pages:(5)\n"))
+        self.assertTrue(text.endswith("[Page 5]:\nText of page 5."))
+
+    def test_text_files_are_one_page(self):
+        context_file = ContextFile.objects.create(
+            user=self.user, full_text="Plain notes.", token_amount=3
+        )
+        context_file.store_pages()
+        page = context_file.pages.get()
+        self.assertEqual(
+            (page.page, page.text, page.token_amount), (1, "Plain notes.", 3)
+        )
+
+    def test_command_stores_missing_pages(self):
+        ContextFilePage.objects.all().delete()
+        call_command("build_file_pages")
+        self.assertEqual(
+            list(self.context_file.pages.values_list("page", flat=True)),
+            [1, 2, 3, 4, 5],
+        )
+
+
+class ContextFileListTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="reader", password="password")
+        other_user = User.objects.create_user(username="other", password="password")
+        self.client.force_login(self.user)
+        self.context_file = self.create_context_file(self.user, "mine.txt")
+        self.create_context_file(other_user, "theirs.txt")
+        chat = Chat.objects.create(user=self.user, topic="Chat")
+        message = Message.objects.create(chat=chat, text="Files", sender="user")
+        message.context_files.add(self.context_file)
+        self.chat_url = reverse("chat", kwargs={"chat_id": chat.id})
+
+    def create_context_file(self, user, filename):
+        context_file = ContextFile.objects.create(
+            user=user,
+            filename=filename,
+            file=SimpleUploadedFile(filename, b"Notes."),
+            full_text="Notes.",
+            markdown_json=[{"metadata": {"page": 1}, "text": "Notes."}],
+            html="<p>Notes.</p>",
+            processing_status="complete",
+        )
+        self.addCleanup(context_file.file.delete, save=False)
+        return context_file
+
+    def get_loaded_columns(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        loaded = {
+            column
+            for column in TEXT_FIELDS
+            for query in queries
+            if f'"documents_contextfile"."{column}"' in query["sql"]
+        }
+        return response, loaded
+
+    def test_list_pages_do_not_load_the_text_columns(self):
+        for url in [
+            reverse("context_files"),
+            reverse("quizzes"),
+            reverse("summaries"),
+            reverse("plans"),
+        ]:
+            with self.subTest(url=url):
+                response, loaded = self.get_loaded_columns(url)
+                self.assertEqual(loaded, set())
+                self.assertContains(response, "mine.txt")
+                self.assertNotContains(response, "theirs.txt")
+
+    def test_chat_page_only_loads_the_html_of_its_files(self):
+        response, loaded = self.get_loaded_columns(self.chat_url)
+        self.assertEqual(loaded, {"html"})
+        self.assertContains(response, "<p>Notes.</p>")
+        self.assertNotContains(response, "theirs.txt")
@@ -1,4 +1,3 @@
-import threading
 from django.shortcuts import redirect, render
 from django.http import HttpResponseRedirect
 from chat.models import Chat, Message
@@ -8,7 +7,7 @@ import os
 from django_tables2 import SingleTableView
 from documents.tables import ContextFileTable
 from documents.forms import FileDeleteForm
-from .signals import process_files
+from .signals import enqueue_file_processing
 
 
 def upload_file(request, chat_id=None):
@@ -47,10 +46,7 @@ def upload_file(request, chat_id=None):
                     sender="user",
                 )
 
-            thread = threading.Thread(
-                target=process_files, args=(new_context_files, language_model.name)
-            )
-            thread.start()
+            enqueue_file_processing(new_context_files, language_model.name)
 
     # Redirect to the previous page
     if chat:
@@ -72,6 +68,9 @@ class ContextFileListView(SingleTableView):
     context_object_name = "context_files"
     table_pagination = {"per_page": 10}
 
+    def get_queryset(self):
+        return ContextFile.light.for_user(self.request.user)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["form"] = FileUploadForm()
@@ -0,0 +1,19 @@
+from django.contrib import admin
+from .models import Job
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = (
+        "task",
+        "status",
+        "attempts",
+        "worker",
+        "created_at",
+        "started_at",
+        "finished_at",
+    )
+    search_fields = ("task", "last_error")
+    list_filter = ("status", "task")
+
+
+admin.site.register(Job, JobAdmin)
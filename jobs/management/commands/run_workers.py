@@ -0,0 +1,50 @@
+import os
+import socket
+import threading
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from jobs.queue import run_worker, wake_workers
+
+
+class Command(BaseCommand):
+    help = "Runs a pool of workers processing the queued jobs (file processing, quizzes, summaries, plans)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.JOB_WORKERS,
+            help="Number of jobs processed concurrently.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.JOB_POLL_INTERVAL,
+            help="Seconds an idle worker waits before looking for new jobs.",
+        )
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+        prefix = f"{socket.gethostname()}-{os.getpid()}"
+        threads = [
+            threading.Thread(
+                target=run_worker,
+                args=(f"{prefix}-{i}", stop_event, options["poll_interval"]),
+                daemon=True,
+            )
+            for i in range(options["workers"])
+        ]
+        for thread in threads:
+            thread.start()
+        print(f"Started {len(threads)} workers, press Ctrl+C to stop.")
+
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            print("Stopping workers after their current job...")
+            stop_event.set()
+            wake_workers()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+
+def get_default_max_attempts():
+    return settings.JOB_MAX_ATTEMPTS
+
+
+class Job(models.Model):
+    STATUS_CHOICES = [
+        ("blocked", "Blocked"),  # waiting for the jobs it depends on
+        ("pending", "Pending"),
+        ("running", "Running"),
+        ("complete", "Complete"),
+        ("failed", "Failed"),
+    ]
+    task = models.CharField(max_length=100)
+    kwargs = models.JSONField(default=dict)
+    depends_on = models.ManyToManyField(
+        "self", symmetrical=False, related_name="dependents", blank=True
+    )
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=get_default_max_attempts)
+    run_after = models.DateTimeField(default=timezone.now)
+    lease_expires_at = models.DateTimeField(blank=True, null=True)
+    worker = models.CharField(max_length=100, blank=True, null=True)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ["run_after", "created_at"]
+        indexes = [models.Index(fields=["status", "run_after"])]
+
+    def __str__(self):
+        return f"{self.task} ({self.status})"
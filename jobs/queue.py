@@ -0,0 +1,234 @@
+import logging
+import threading
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import Job
+
+logger = logging.getLogger("django.server")
+
+TASKS = {}
+FAILURE_HANDLERS = {}
+UNFINISHED_STATUSES = ["blocked", "pending", "running"]
+
+# idle workers of this process wait on this condition, notified when a job
+# becomes runnable. Jobs queued by other processes are seen at the next poll.
+_job_available = threading.Condition()
+_notifications = 0
+
+
+class RetryLater(Exception):
+    """Raised by a task to run it again after `delay` seconds.
+
+    Does not count as a failed attempt, used to wait for other work.
+    """
+
+    def __init__(self, delay: float = 5):
+        super().__init__(f"Retry in {delay} seconds")
+        self.delay = delay
+
+
+def task(name: str, on_failure=None):
+    """Register the decorated function as the job task `name`.
+
+    `on_failure` is called with the kwargs of a job that failed its last
+    attempt, e.g. to mark what the job was producing as failed.
+    """
+
+    def decorator(function):
+        TASKS[name] = function
+        if on_failure is not None:
+            FAILURE_HANDLERS[name] = on_failure
+        return function
+
+    return decorator
+
+
+def wake_workers():
+    global _notifications
+    with _job_available:
+        _notifications += 1
+        _job_available.notify_all()
+
+
+def enqueue(task_name: str, depends_on=(), **kwargs) -> Job:
+    """Queue `task_name` to be run by `manage.py run_workers` with `kwargs`.
+
+    The job stays blocked until all the jobs of `depends_on` are finished,
+    complete or failed, the task checks their outcome itself.
+    """
+    if task_name not in TASKS:
+        raise ValueError(f"Unknown task: {task_name}")
+    if not depends_on:
+        job = Job.objects.create(task=task_name, kwargs=kwargs)
+        wake_workers()
+        return job
+    job = Job.objects.create(task=task_name, kwargs=kwargs, status="blocked")
+    job.depends_on.set(depends_on)
+    # the dependencies may have finished before they were added
+    release_job(job.id)
+    return job
+
+
+def release_job(job_id: int) -> bool:
+    """Make a blocked job runnable if all its dependencies are finished."""
+    if Job.objects.filter(
+        id=job_id, depends_on__status__in=UNFINISHED_STATUSES
+    ).exists():
+        return False
+    released = Job.objects.filter(id=job_id, status="blocked").update(
+        status="pending", run_after=timezone.now()
+    )
+    if released:
+        wake_workers()
+    return bool(released)
+
+
+def claim_job(worker: str) -> Job | None:
+    """Lease the next runnable job to `worker`.
+
+    A job is runnable when it is pending and due, or when the lease of the
+    worker running it expired (e.g. the process was killed). Claiming is a
+    conditional update, so two workers never get the same job.
+    """
+    now = timezone.now()
+    candidates = Job.objects.filter(
+        Q(status="pending", run_after__lte=now)
+        | Q(status="running", lease_expires_at__lt=now)
+    ).values_list("id", "status", "attempts")[:10]
+    for job_id, status, attempts in candidates:
+        claimed = Job.objects.filter(
+            id=job_id, status=status, attempts=attempts
+        ).update(
+            status="running",
+            attempts=F("attempts") + 1,
+            worker=worker,
+            started_at=now,
+            lease_expires_at=now + timedelta(seconds=settings.JOB_LEASE_TIMEOUT),
+        )
+        if claimed:
+            return Job.objects.get(id=job_id)
+    return None
+
+
+def renew_lease(job: Job) -> bool:
+    """Extend the lease of a running job, False if it was taken over meanwhile."""
+    return bool(
+        Job.objects.filter(
+            id=job.id, status="running", worker=job.worker, attempts=job.attempts
+        ).update(
+            lease_expires_at=timezone.now()
+            + timedelta(seconds=settings.JOB_LEASE_TIMEOUT)
+        )
+    )
+
+
+@contextmanager
+def lease_heartbeat(job: Job):
+    """Renew the lease of `job` every third of JOB_LEASE_TIMEOUT while it runs.
+
+    Tasks may run longer than the lease (e.g. summaries of large files), the
+    lease only expires once the worker running the job stopped.
+    """
+    stopped = threading.Event()
+
+    def beat():
+        try:
+            while not stopped.wait(settings.JOB_LEASE_TIMEOUT / 3):
+                try:
+                    if not renew_lease(job):
+                        return
+                except Exception:
+                    logger.error(
+                        f"Renewing the lease of job {job.id} failed:\n"
+                        f"{traceback.format_exc()}"
+                    )
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def run_job(job: Job):
+    """Run a claimed job and store its outcome."""
+    now = timezone.now()
+    update = {"lease_expires_at": None, "worker": None}
+    try:
+        if job.attempts > job.max_attempts:
+            raise RuntimeError("Lease expired on the last attempt")
+        with lease_heartbeat(job):
+            TASKS[job.task](**job.kwargs)
+    except RetryLater as e:
+        update.update(
+            status="pending",
+            attempts=job.attempts - 1,
+            run_after=now + timedelta(seconds=e.delay),
+        )
+    except Exception:
+        logger.error(f"Job {job.id} ({job.task}) failed:\n{traceback.format_exc()}")
+        update["last_error"] = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            backoff = settings.JOB_RETRY_BACKOFF * 2 ** (job.attempts - 1)
+            update.update(status="pending", run_after=now + timedelta(seconds=backoff))
+        else:
+            update.update(status="failed", finished_at=timezone.now())
+    else:
+        update.update(status="complete", finished_at=timezone.now())
+    # only store the outcome if the lease was not taken over meanwhile
+    stored = Job.objects.filter(
+        id=job.id, worker=job.worker, attempts=job.attempts
+    ).update(**update)
+    if stored and update["status"] == "failed" and job.task in FAILURE_HANDLERS:
+        try:
+            FAILURE_HANDLERS[job.task](**job.kwargs)
+        except Exception:
+            logger.error(
+                f"Failure handler of job {job.id} ({job.task}) failed:\n"
+                f"{traceback.format_exc()}"
+            )
+    if stored and update["status"] in ["complete", "failed"]:
+        for dependent_id in job.dependents.filter(status="blocked").values_list(
+            "id", flat=True
+        ):
+            release_job(dependent_id)
+
+
+def run_next_job(worker: str) -> bool:
+    """Claim and run one job, returns False if there was nothing to do."""
+    job = claim_job(worker)
+    if job is None:
+        return False
+    logger.info(f"{worker} running job {job.id} ({job.task})")
+    run_job(job)
+    return True
+
+
+def run_worker(worker: str, stop_event: threading.Event, poll_interval: float):
+    """Run jobs until `stop_event` is set, waiting while the queue is empty.
+
+    An idle worker is woken up as soon as a job of this process is queued or
+    released, otherwise it looks for jobs every `poll_interval` seconds.
+    """
+    while not stop_event.is_set():
+        close_old_connections()
+        seen_notifications = _notifications
+        try:
+            found_job = run_next_job(worker)
+        except Exception:
+            logger.error(f"{worker} crashed:\n{traceback.format_exc()}")
+            found_job = False
+        if not found_job:
+            with _job_available:
+                if _notifications == seen_notifications and not stop_event.is_set():
+                    _job_available.wait(poll_interval)
+    close_old_connections()
@@ -0,0 +1,164 @@
+from datetime import timedelta
+import threading
+import time
+from unittest.mock import MagicMock, patch
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from .models import Job
+from .queue import (
+    FAILURE_HANDLERS,
+    TASKS,
+    RetryLater,
+    claim_job,
+    enqueue,
+    run_next_job,
+    run_worker,
+)
+
+
+@override_settings(JOB_MAX_ATTEMPTS=2, JOB_RETRY_BACKOFF=10, JOB_LEASE_TIMEOUT=60)
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.function = MagicMock(return_value=None)
+        TASKS["tests.task"] = self.function
+        self.addCleanup(TASKS.pop, "tests.task")
+
+    def test_enqueue_and_run(self):
+        job = enqueue("tests.task", value=1)
+        self.assertTrue(run_next_job("worker-1"))
+        self.function.assert_called_once_with(value=1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "complete")
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNotNone(job.finished_at)
+        self.assertFalse(run_next_job("worker-1"))
+
+    def test_enqueue_unknown_task(self):
+        with self.assertRaises(ValueError):
+            enqueue("tests.unknown")
+
+    def test_job_is_claimed_once(self):
+        enqueue("tests.task")
+        self.assertIsNotNone(claim_job("worker-1"))
+        self.assertIsNone(claim_job("worker-2"))
+
+    def test_failed_job_is_retried_then_failed(self):
+        self.function.side_effect = ValueError("boom")
+        job = enqueue("tests.task")
+
+        run_next_job("worker-1")
+        job.refresh_from_db()
+        self.assertEqual(job.status, "pending")
+        self.assertIn("boom", job.last_error)
+        self.assertGreater(job.run_after, timezone.now())
+
+        Job.objects.filter(id=job.id).update(run_after=timezone.now())
+        run_next_job("worker-1")
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.attempts, 2)
+
+    def test_failure_handler_runs_after_the_last_attempt(self):
+        on_failure = MagicMock()
+        FAILURE_HANDLERS["tests.task"] = on_failure
+        self.addCleanup(FAILURE_HANDLERS.pop, "tests.task")
+        self.function.side_effect = ValueError("boom")
+        job = enqueue("tests.task", value=1)
+
+        run_next_job("worker-1")
+        on_failure.assert_not_called()
+        Job.objects.filter(id=job.id).update(run_after=timezone.now())
+        run_next_job("worker-1")
+        on_failure.assert_called_once_with(value=1)
+
+    def test_retry_later_does_not_count_as_attempt(self):
+        self.function.side_effect = RetryLater(30)
+        job = enqueue("tests.task")
+        run_next_job("worker-1")
+        job.refresh_from_db()
+        self.assertEqual(job.status, "pending")
+        self.assertEqual(job.attempts, 0)
+        self.assertFalse(run_next_job("worker-1"))
+
+    def test_expired_lease_is_picked_up_again(self):
+        job = enqueue("tests.task")
+        claim_job("worker-1")  # worker dies without finishing the job
+        self.assertIsNone(claim_job("worker-2"))
+        Job.objects.filter(id=job.id).update(
+            lease_expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertTrue(run_next_job("worker-2"))
+        job.refresh_from_db()
+        self.assertEqual(job.status, "complete")
+        self.assertEqual(job.attempts, 2)
+
+    def test_dependent_job_is_released_when_dependencies_finish(self):
+        self.function.side_effect = [None, ValueError("boom"), None]
+        first = enqueue("tests.task", value=1)
+        second = enqueue("tests.task", value=2)
+        Job.objects.filter(id=second.id).update(max_attempts=1)
+        dependent = enqueue("tests.task", depends_on=[first, second], value=3)
+        self.assertEqual(dependent.status, "blocked")
+
+        run_next_job("worker-1")
+        dependent.refresh_from_db()
+        self.assertEqual(dependent.status, "blocked")
+
+        # a failed dependency is finished too, the task checks the outcome
+        run_next_job("worker-1")
+        dependent.refresh_from_db()
+        self.assertEqual(dependent.status, "pending")
+        run_next_job("worker-1")
+        self.function.assert_called_with(value=3)
+
+    def test_dependencies_finished_before_enqueue(self):
+        first = enqueue("tests.task")
+        run_next_job("worker-1")
+        dependent = enqueue("tests.task", depends_on=[first])
+        dependent.refresh_from_db()
+        self.assertEqual(dependent.status, "pending")
+
+    def test_idle_worker_is_woken_up_by_released_job(self):
+        stop_event = threading.Event()
+        wait = MagicMock(side_effect=lambda timeout: stop_event.set())
+        with patch("jobs.queue._job_available.wait", wait), patch(
+            "jobs.queue.close_old_connections"
+        ):
+            run_worker("worker-1", stop_event, poll_interval=30)
+        wait.assert_called_once_with(30)
+
+        # a job released while the worker looked for work skips the wait
+        stop_event.clear()
+        wait.reset_mock()
+
+        def release_during_claim(worker):
+            enqueue("tests.task")
+            stop_event.set()
+            return False
+
+        with patch("jobs.queue.run_next_job", release_during_claim), patch(
+            "jobs.queue._job_available.wait", wait
+        ), patch("jobs.queue.close_old_connections"):
+            run_worker("worker-1", stop_event, poll_interval=30)
+        wait.assert_not_called()
+
+
+@override_settings(JOB_LEASE_TIMEOUT=0.3)
+class LeaseHeartbeatTests(TransactionTestCase):
+    def setUp(self):
+        self.claimed_meanwhile = []
+
+        def long_task():
+            # runs past the lease taken when the job was claimed
+            time.sleep(0.8)
+            self.claimed_meanwhile.append(claim_job("worker-2"))
+
+        TASKS["tests.long_task"] = long_task
+        self.addCleanup(TASKS.pop, "tests.long_task")
+
+    def test_running_job_is_not_claimed_by_another_worker(self):
+        job = enqueue("tests.long_task")
+        self.assertTrue(run_next_job("worker-1"))
+        self.assertEqual(self.claimed_meanwhile, [None])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("complete", 1))
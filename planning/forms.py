@@ -24,7 +24,7 @@ class CreatePlanForm(forms.ModelForm):
     plan_goal = forms.CharField()
     files = MultipleFileField(required=False)
     selected_files = forms.ModelMultipleChoiceField(
-        ContextFile.objects.all(), required=False
+        ContextFile.light.none(), required=False
     )
     language_model = forms.ModelChoiceField(
         queryset=LanguageModel.objects.all(), initial=0
@@ -43,8 +43,9 @@ class CreatePlanForm(forms.ModelForm):
             "language_model",
         ]
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, user=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.fields["selected_files"].queryset = ContextFile.light.for_user(user)
         self.helper = FormHelper()
         self.helper.layout = Layout(
             Field("plan_goal"),  # Plan goal field
@@ -1,35 +1,92 @@
 from datetime import datetime, timedelta
+from django.db import transaction
 from django.dispatch import Signal, receiver
+from django.utils import timezone
 from documents.models import ContextFile, FileReference
-from services.llm_handler import call_api, handle_tools_calls
+from documents.signals import get_processing_jobs, processing_failed
+from jobs.queue import RetryLater, enqueue, task
+from services.llm_handler import ToolCallSink, call_api
 from services.models import get_default_request_config
 from .models import Plan, Session
+import logging
+
+logger = logging.getLogger("django.server")
 
 plan_files_processed = Signal()
 
 
+def parse_duration(duration: str) -> timedelta:
+    t = datetime.strptime(duration, "%H:%M:%S")
+    return timedelta(hours=t.hour, minutes=t.minute, seconds=t.second)
+
+
+def create_sessions(plan: Plan, sessions: list[dict]) -> list[Session]:
+    """Save the create_session tool call arguments `sessions` of `plan`.
+
+    File references, sessions and their links are inserted with one
+    `bulk_create` each. Sessions referencing an unknown file are skipped.
+    """
+    file_ids = {str(arguments["file_id"]) for arguments in sessions}
+    context_files = {
+        str(pk): context_file
+        for pk, context_file in ContextFile.objects.in_bulk(
+            [file_id for file_id in file_ids if file_id.isdigit()]
+        ).items()
+    }
+    valid_sessions = []
+    for arguments in sessions:
+        if str(arguments["file_id"]) in context_files:
+            valid_sessions.append(arguments)
+        else:
+            logger.error(f"Unknown file {arguments['file_id']} for plan {plan.id}")
+    sessions = valid_sessions
+
+    with transaction.atomic():
+        file_references = FileReference.objects.bulk_create(
+            [
+                FileReference(
+                    context_file=context_files[str(arguments["file_id"])],
+                    start_page_index=arguments["start_page_index"],
+                    end_page_index=arguments["end_page_index"],
+                )
+                for arguments in sessions
+            ]
+        )
+        created = Session.objects.bulk_create(
+            [
+                Session(
+                    plan=plan,
+                    session_goal=arguments["session_goal"],
+                    date=datetime.strptime(arguments["date"], "%Y-%m-%d"),
+                    duration=parse_duration(arguments["duration"]),
+                )
+                for arguments in sessions
+            ]
+        )
+        Session.file_references.through.objects.bulk_create(
+            [
+                Session.file_references.through(
+                    session=session, filereference=file_reference
+                )
+                for session, file_reference in zip(created, file_references)
+            ]
+        )
+    return created
+
+
 def create_session(
     plan_id, date, duration, session_goal, file_id, start_page_index, end_page_index
 ):
-
-    date = datetime.strptime(date, "%Y-%m-%d")
-    t = datetime.strptime(duration, "%H:%M:%S")
-    duration = timedelta(hours=t.hour, minutes=t.minute, seconds=t.second)
     plan = Plan.objects.get(id=plan_id)
-    file_ref = FileReference.objects.create(
-        context_file=ContextFile.objects.get(id=file_id),
-        start_page_index=start_page_index,
-        end_page_index=end_page_index,
-    )
-
-    session = Session.objects.create(
-        plan=plan,
-        session_goal=session_goal,
-        date=date,
-        duration=duration,
-    )
-    session.file_references.add(file_ref)
-    return session
+    arguments = {
+        "date": date,
+        "duration": duration,
+        "session_goal": session_goal,
+        "file_id": file_id,
+        "start_page_index": start_page_index,
+        "end_page_index": end_page_index,
+    }
+    return create_sessions(plan, [arguments])[0]
 
 
 def add_plan_details(plan_id: str, topic: str, description: str, explanation=None):
@@ -122,17 +179,24 @@ PLAN_TOOLS = [
 ]
 
 
-def generate_sessions(messages, user, model):
+def generate_sessions(messages, plan: Plan):
     response = call_api(
-        model=model, messages=messages, user=user, tools=PLAN_TOOLS, force_tool=True
+        model=plan.request_config.language_model,
+        messages=messages,
+        user=plan.user,
+        tools=PLAN_TOOLS,
+        force_tool=True,
     )
-    tool_functions = {
-        "create_session": create_session,
-        "add_plan_details": add_plan_details,
-    }
-    for choice in response.choices:
-        for i, tool_call in enumerate(choice.message.tool_calls):
-            handle_tools_calls({i: tool_call.model_dump()}, tool_functions)
+    sink = ToolCallSink(
+        {
+            "create_session": lambda sessions: create_sessions(plan, sessions),
+            "add_plan_details": lambda calls: [
+                add_plan_details(**arguments) for arguments in calls
+            ],
+        }
+    )
+    sink.add_response(response)
+    sink.flush()
 
 
 @receiver(plan_files_processed)
@@ -158,33 +222,30 @@ def create_plan_sessions(sender, **kwargs):
     if not plan.request_config:
         plan.request_config = get_default_request_config()
         plan.save()
-    generate_sessions(
-        [{"role": "system", "content": prompt}],
-        plan.user,
-        plan.request_config.language_model,
-    )
+    generate_sessions([{"role": "system", "content": prompt}], plan)
 
     sessions = Session.objects.filter(plan=plan)
     session_goals = "\n".join([f"{session.session_goal}" for session in sessions])
     prompt = f"""The following sessions have been created for the plan (plan_id = {plan.id}):
     {session_goals}
     Now, add some details to the plan by calling the 'add_plan_details' function."""
-    generate_sessions(
-        [{"role": "system", "content": prompt}],
-        plan.user,
-        plan.request_config.language_model,
-    )
+    generate_sessions([{"role": "system", "content": prompt}], plan)
 
 
 def check_files_ready_signal(context_files, instance):
-    while True:
-        if all(
-            [
-                context_file.processing_status == "complete"
-                for context_file in context_files
-            ]
-        ):
-            break
+    """Send `plan_files_processed` once all `context_files` are processed.
+
+    Run as a job depending on the processing jobs of the files, so the files
+    are normally processed already. Raises `RetryLater` for files still being
+    processed outside of the job queue.
+    """
+    if processing_failed(context_files):
+        logger.error(f"Files of plan {instance.id} could not be processed.")
+        instance.processing_status = "error"
+        instance.save(update_fields=["processing_status"])
+        return
+    if any(file.processing_status != "complete" for file in context_files):
+        raise RetryLater(5)
 
     if context_files:
         kwargs = {
@@ -192,4 +253,23 @@ def check_files_ready_signal(context_files, instance):
             "context_files": context_files,
             "plan": instance,
         }
+        started_at = timezone.now()
         plan_files_processed.send(**kwargs)
+        instance.record_stage_timings(context_files, started_at, timezone.now())
+
+
+@task("planning.check_files_ready")
+def check_files_ready(plan_id: str, context_file_ids: list[int]):
+    plan = Plan.objects.get(id=plan_id)
+    context_files = list(ContextFile.objects.filter(id__in=context_file_ids))
+    check_files_ready_signal(context_files, plan)
+
+
+def enqueue_files_ready(context_files, plan):
+    """Queue the session generation of `plan`, run when its files are processed."""
+    enqueue(
+        "planning.check_files_ready",
+        depends_on=get_processing_jobs(context_files),
+        plan_id=str(plan.id),
+        context_file_ids=[context_file.id for context_file in context_files],
+    )
@@ -1,10 +1,19 @@
 import os
 from datetime import datetime, timedelta, date
+import json
+from types import SimpleNamespace
+from unittest.mock import patch
 from django.test import TestCase
 from django.contrib.auth.models import User
 from .models import Plan, Session
+from .signals import generate_sessions
+from .views import process_uploaded_files
 from documents.models import ContextFile, FileReference
 from django.core.files.uploadedfile import SimpleUploadedFile
+from jobs.models import Job
+from jobs.queue import run_next_job
+from services.models import LanguageModel, RequestConfiguration
+from services.tests import byte_encoding, patch_encodings
 
 
 class PlanningModelTests(TestCase):
@@ -33,6 +42,7 @@ class PlanningModelTests(TestCase):
                 processing_status="completed",
                 file=self.file,
             )
+            self.addCleanup(self.context_file.file.delete, save=False)
             self.file_reference = FileReference.objects.create(
                 context_file=self.context_file, start_page_index=0, end_page_index=0
             )
@@ -104,3 +114,120 @@ class PlanningModelTests(TestCase):
         self.assertFalse(
             self.plan.processing_done
         )  # Only validates if there is still a session that isn't done
+
+
+class PlanReadinessTests(TestCase):
+    def setUp(self):
+        patch_encodings(self, {"gpt-4o-mini": byte_encoding("o200k_base")})
+        self.user = User.objects.create_user(username="planner", password="password")
+        self.plan = Plan.objects.create(
+            plan_goal="Pass the exam",
+            user=self.user,
+            start_date=date(2024, 1, 1),
+            end_date=date(2024, 2, 1),
+        )
+
+    def upload_files(self, count):
+        process_uploaded_files(
+            [
+                SimpleUploadedFile(f"chapter{i}.txt", f"Chapter {i}".encode())
+                for i in range(count)
+            ],
+            self.plan,
+        )
+        for context_file in self.plan.context_files.all():
+            self.addCleanup(context_file.file.delete, save=False)
+
+    @patch("planning.signals.plan_files_processed.send")
+    def test_plan_starts_when_last_file_is_processed(self, send):
+        self.upload_files(3)
+        plan_job = Job.objects.get(task="planning.check_files_ready")
+        self.assertEqual(plan_job.status, "blocked")
+        self.assertEqual(plan_job.depends_on.count(), 3)
+
+        while run_next_job("worker"):
+            pass
+
+        send.assert_called_once()
+        plan_job.refresh_from_db()
+        last_file_done = Job.objects.filter(task="documents.process_file").latest(
+            "finished_at"
+        )
+        self.assertEqual(plan_job.status, "complete")
+        self.assertLess(
+            plan_job.started_at - last_file_done.finished_at,
+            timedelta(milliseconds=100),
+        )
+
+    @patch("planning.signals.plan_files_processed.send")
+    @patch("documents.signals.process_context_file", side_effect=ValueError)
+    def test_plan_fails_when_a_file_fails(self, process_context_file, send):
+        self.upload_files(1)
+        Job.objects.update(max_attempts=1)
+        while run_next_job("worker"):
+            pass
+
+        send.assert_not_called()
+        self.plan.refresh_from_db()
+        self.assertEqual(self.plan.processing_status, "error")
+
+
+def tool_call(name, **arguments):
+    return SimpleNamespace(
+        function=SimpleNamespace(name=name, arguments=json.dumps(arguments))
+    )
+
+
+class GenerateSessionsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="planner", password="password")
+        self.plan = Plan.objects.create(
+            plan_goal="Pass the exam",
+            user=self.user,
+            start_date=date(2024, 1, 1),
+            end_date=date(2024, 2, 1),
+            request_config=RequestConfiguration.objects.get_for(
+                LanguageModel.objects.get(name="gpt-4o-mini")
+            ),
+        )
+        self.context_file = ContextFile.objects.create(user=self.user)
+
+    @patch("planning.signals.call_api")
+    def test_sessions_are_bulk_inserted(self, call_api):
+        tool_calls = [
+            tool_call(
+                "create_session",
+                plan_id="ignored",
+                date=f"2024-01-{day:02d}",
+                duration="01:30:00",
+                session_goal=f"Chapter {day}",
+                file_id=str(self.context_file.id if day < 10 else 999),
+                start_page_index=day,
+                end_page_index=day + 2,
+            )
+            for day in range(1, 11)
+        ]
+        tool_calls.append(
+            tool_call(
+                "add_plan_details",
+                plan_id=str(self.plan.id),
+                topic="Exam",
+                description="Ten chapters",
+            )
+        )
+        call_api.return_value = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(tool_calls=tool_calls))]
+        )
+        # files, the three inserts, plan details (a get and one update per
+        # inherited table) and the savepoints
+        with self.assertNumQueries(12):
+            generate_sessions([], self.plan)
+
+        sessions = self.plan.session_set.order_by("date")
+        self.assertEqual(sessions.count(), 9)  # the unknown file is skipped
+        self.assertEqual(sessions[0].duration, timedelta(hours=1, minutes=30))
+        reference = sessions[2].file_references.get()
+        self.assertEqual(reference.context_file, self.context_file)
+        self.assertEqual(reference.start_page_index, 3)
+        self.plan.refresh_from_db()
+        self.assertEqual(self.plan.topic, "Exam")
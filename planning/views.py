@@ -1,11 +1,11 @@
-import threading
 from django.http import HttpResponseRedirect
 from django.shortcuts import redirect, render
 from django_tables2 import SingleTableView
 from content.models import BaseProcessModel
-from documents.models import ContextFile
-from documents.signals import process_files
-from planning.signals import check_files_ready_signal
+from django.db.models import Prefetch
+from documents.models import ContextFile, FileReference
+from documents.signals import enqueue_file_processing
+from planning.signals import enqueue_files_ready
 from services.models import get_default_request_config
 from .forms import CreatePlanForm, DeletePlanForm, DeleteSessionForm
 from .models import Plan, Session
@@ -21,11 +21,6 @@ def plan_details(request, plan_id):
     return render(request, "planning/plan_details.html", {"plan_id": plan_id})
 
 
-def signal_files_ready(context_files, instance):
-    process_files(context_files, instance.request_config.language_model.name)
-    check_files_ready_signal(context_files, instance)
-
-
 def add_to_context_files(context_file, instance: Plan):
     instance.materials_used.add(context_file)
     instance.save()
@@ -43,24 +38,20 @@ def process_uploaded_files(uploaded_files, instance: BaseProcessModel):
     if not instance.request_config:
         instance.request_config = get_default_request_config()
         instance.save()
-    thread = threading.Thread(
-        target=signal_files_ready,
-        args=(new_context_files, instance),
+    enqueue_file_processing(
+        new_context_files, instance.request_config.language_model.name
     )
-    thread.start()
+    enqueue_files_ready(new_context_files, instance)
 
 
 def process_selected_files(selected_files, instance: BaseProcessModel):
     instance.context_files.set(selected_files)
-    thread = threading.Thread(
-        target=check_files_ready_signal, args=(selected_files, instance)
-    )
-    thread.start()
+    enqueue_files_ready(selected_files, instance)
 
 
 def create_plan(request):
     if request.method == "POST":
-        form = CreatePlanForm(request.POST, request.FILES)
+        form = CreatePlanForm(request.POST, request.FILES, user=request.user)
         if form.is_valid():
             form.instance.user = request.user
             uploaded_files = form.cleaned_data["files"]
@@ -106,7 +97,7 @@ class PlanListView(SingleTableView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["create_form"] = CreatePlanForm()
+        context["create_form"] = CreatePlanForm(user=self.request.user)
         if context["plans"]:
             context["delete_forms"] = [
                 DeletePlanForm(instance=plan) for plan in context["plans"]
@@ -131,7 +122,22 @@ class SessionListView(SingleTableView):
     table_pagination = {"per_page": 10}
 
     def get_queryset(self):
-        return Session.objects.filter(plan=self.kwargs["plan_id"]).order_by("date")
+        # the pages of the references are read from their rows when rendered
+        return (
+            Session.objects.filter(plan=self.kwargs["plan_id"])
+            .prefetch_related(
+                Prefetch(
+                    "file_references",
+                    queryset=FileReference.objects.select_related("context_file").only(
+                        "start_page_index",
+                        "end_page_index",
+                        "context_file__id",
+                        "context_file__filename",
+                    ),
+                )
+            )
+            .order_by("date")
+        )
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -63,6 +63,8 @@ class RequestConfigurationAdmin(admin.ModelAdmin):
     )
     search_fields = ("params",)
     list_filter = ("params",)
+    # shared by every chat and message with the same values
+    readonly_fields = ("params", "system_prompt", "language_model", "fingerprint")
 
 
 admin.site.register(RequestConfiguration, RequestConfigurationAdmin)
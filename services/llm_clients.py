@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+import httpx
+from django.conf import settings
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+logger = logging.getLogger("django.server")
+
+
+def get_key_fingerprint(api_key: str) -> str:
+    """Identify an API key without keeping the plain key as a dictionary key."""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+class ClientRegistry:
+    """Process-wide cache of OpenAI clients, one per (base_url, API key).
+
+    Every client keeps its own keep-alive connection pool, so repeated calls
+    (and tool-call round trips) reuse open TLS connections. The registry also
+    counts requests and newly opened connections to report the reuse ratio.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        # async connection pools are bound to the event loop they run in
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def get_limits(self) -> httpx.Limits:
+        return httpx.Limits(**settings.LLM_CLIENT_POOL_LIMITS)
+
+    def get(self, base_url: str, api_key: str) -> OpenAI:
+        cache_key = (base_url, get_key_fingerprint(api_key))
+        with self._lock:
+            client = self._clients.get(cache_key)
+            if client is None:
+                client = OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    http_client=DefaultHttpxClient(
+                        limits=self.get_limits(),
+                        event_hooks={"request": [self._on_request]},
+                    ),
+                )
+                self._clients[cache_key] = client
+        return client
+
+    def get_async(self, base_url: str, api_key: str) -> AsyncOpenAI:
+        """Like `get`, for an AsyncOpenAI client of the running event loop."""
+        cache_key = (base_url, get_key_fingerprint(api_key))
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(cache_key)
+            if client is None:
+                client = AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    http_client=DefaultAsyncHttpxClient(
+                        limits=self.get_limits(),
+                        event_hooks={"request": [self._on_async_request]},
+                    ),
+                )
+                clients[cache_key] = client
+        return client
+
+    def invalidate(self, base_url: str = None, api_key: str = None) -> int:
+        """Drop the clients matching `base_url` and/or `api_key`.
+
+        In-flight requests keep their client, it is only no longer handed out.
+        """
+        fingerprint = get_key_fingerprint(api_key) if api_key else None
+        with self._lock:
+            stale = []
+            for clients in [self._clients, *self._async_clients.values()]:
+                for cache_key in list(clients):
+                    if (base_url is None or cache_key[0] == base_url) and (
+                        fingerprint is None or cache_key[1] == fingerprint
+                    ):
+                        del clients[cache_key]
+                        stale.append(cache_key)
+        if stale:
+            logger.info(f"Invalidated {len(stale)} API client(s)")
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+            self._async_clients.clear()
+            self.requests = 0
+            self.new_connections = 0
+
+    def _on_request(self, request: httpx.Request):
+        with self._lock:
+            self.requests += 1
+        # httpcore reports connection setup through the trace extension
+        request.extensions["trace"] = self._trace
+
+    def _trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.new_connections += 1
+
+    async def _on_async_request(self, request: httpx.Request):
+        with self._lock:
+            self.requests += 1
+        request.extensions["trace"] = self._async_trace
+
+    async def _async_trace(self, event_name: str, info: dict):
+        self._trace(event_name, info)
+
+    @property
+    def reuse_ratio(self) -> float:
+        if not self.requests:
+            return 0.0
+        return 1 - self.new_connections / self.requests
+
+    def get_stats(self) -> dict:
+        return {
+            "clients": len(self._clients),
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reuse_ratio": self.reuse_ratio,
+        }
+
+
+client_registry = ClientRegistry()
+
+
+def get_client(base_url: str, api_key: str) -> OpenAI:
+    return client_registry.get(base_url, api_key)
+
+
+def get_async_client(base_url: str, api_key: str) -> AsyncOpenAI:
+    return client_registry.get_async(base_url, api_key)
+
+
+class APIKeyCache:
+    """Bounded LRU cache of decrypted API keys with a time to live.
+
+    Saves the UserAPIKey query and the decryption on every LLM call. Entries
+    are keyed by (user id, api identifier) and dropped by the UserAPIKey
+    signals when a key changes.
+    """
+
+    def __init__(self, max_size: int = None, ttl: float = None):
+        self.max_size = max_size or settings.LLM_API_KEY_CACHE["max_size"]
+        self.ttl = ttl if ttl is not None else settings.LLM_API_KEY_CACHE["ttl"]
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cache_key: tuple) -> str | None:
+        """Return the cached key, None (counted as a miss) if absent or expired."""
+        with self._lock:
+            entry = self._keys.get(cache_key)
+            if entry and entry[1] > time.monotonic():
+                self._keys.move_to_end(cache_key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        return None
+
+    def set(self, cache_key: tuple, api_key: str):
+        with self._lock:
+            self._keys[cache_key] = (api_key, time.monotonic() + self.ttl)
+            self._keys.move_to_end(cache_key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def get_or_load(self, cache_key: tuple, load_key) -> str:
+        """Return the cached key for `cache_key`, calling `load_key()` on a miss."""
+        api_key = self.get(cache_key)
+        if api_key is None:
+            api_key = load_key()
+            self.set(cache_key, api_key)
+        return api_key
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for cache_key in [k for k in self._keys if k[0] == user_id]:
+                del self._keys[cache_key]
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self) -> dict:
+        return {"size": len(self._keys), "hits": self.hits, "misses": self.misses}
+
+
+api_key_cache = APIKeyCache()
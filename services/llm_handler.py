@@ -1,5 +1,8 @@
-from openai import OpenAI
+from collections import defaultdict
+from functools import lru_cache
 import json
+import re
+import threading
 from services.models import (
     LanguageModel,
     PayloadSent,
@@ -7,24 +10,43 @@ from services.models import (
     UserAPIKey,
     _get_default_params,
 )
+from services.llm_clients import (
+    api_key_cache,
+    client_registry,
+    get_async_client,
+    get_client,
+)
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
 import mistune
 from pygments.formatters import html
 import logging
 from django.contrib.auth.models import User
+from django.db import transaction
 from mistune.directives import RSTDirective, TableOfContents
 from mistune.toc import render_toc_ul
 
 logger = logging.getLogger("django.server")
 
 
+HTML_FORMATTER = html.HtmlFormatter()
+
+
+@lru_cache(maxsize=128)
+def get_lexer(language: str):
+    """Return the cached Pygments lexer for `language`, None if it is unknown."""
+    try:
+        return get_lexer_by_name(language, stripall=True)
+    except ClassNotFound:
+        # unknown or partially streamed language name
+        return None
+
+
 class HighlightRenderer(mistune.HTMLRenderer):
     def block_code(self, code, info=None):
-        if info:
-            lexer = get_lexer_by_name(info, stripall=True)
-            formatter = html.HtmlFormatter()
-            return highlight(code, lexer, formatter)
+        if info and (lexer := get_lexer(info.strip().lower())):
+            return highlight(code, lexer, HTML_FORMATTER)
         return "<pre><code>" + mistune.escape(code) + "</code></pre>"
 
 
@@ -49,39 +71,164 @@ class MyTableOfContents(TableOfContents):
             md.renderer.register("toc", render_html_toc)
 
 
-def get_markdown(text):
-    markdown = mistune.create_markdown(
-        renderer=HighlightRenderer(),
-        plugins=[
-            "strikethrough",
-            "footnotes",
-            "table",
-            "url",
-            "task_lists",
-            "def_list",
-            "abbr",
-            "mark",
-            "insert",
-            "superscript",
-            "subscript",
-            "math",
-            "spoiler",
-            RSTDirective([MyTableOfContents()]),
-        ],
+MARKDOWN_PLUGINS = [
+    "strikethrough",
+    "footnotes",
+    "table",
+    "url",
+    "task_lists",
+    "def_list",
+    "abbr",
+    "mark",
+    "insert",
+    "superscript",
+    "subscript",
+    "math",
+    "spoiler",
+]
+
+# Plugin profile per use case, the summary profile also renders `.. toc::`.
+MARKDOWN_PROFILES = {
+    "chat": lambda: MARKDOWN_PLUGINS,
+    "document": lambda: MARKDOWN_PLUGINS,
+    "summary": lambda: MARKDOWN_PLUGINS + [RSTDirective([MyTableOfContents()])],
+}
+DEFAULT_MARKDOWN_PROFILE = "summary"
+# Stored with html rendered ahead of time (e.g. the pages of files), html of
+# another version is rendered again. Bump it when the renderer, plugins or
+# profiles change the output.
+MARKDOWN_RENDERER_VERSION = f"mistune-{mistune.__version__}.1"
+
+_markdown_parsers = threading.local()
+
+
+def create_markdown_parser(profile: str = DEFAULT_MARKDOWN_PROFILE):
+    return mistune.create_markdown(
+        renderer=HighlightRenderer(), plugins=MARKDOWN_PROFILES[profile]()
     )
-    return markdown(text)
 
 
-def call_api(
+def get_markdown_parser(profile: str = DEFAULT_MARKDOWN_PROFILE):
+    """Return the parser for `profile`, built once per thread and then reused."""
+    parsers = getattr(_markdown_parsers, "parsers", None)
+    if parsers is None:
+        parsers = _markdown_parsers.parsers = {}
+    if profile not in parsers:
+        parsers[profile] = create_markdown_parser(profile)
+    return parsers[profile]
+
+
+def get_markdown(text, profile: str = DEFAULT_MARKDOWN_PROFILE):
+    return get_markdown_parser(profile)(text)
+
+
+_FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+
+
+def find_block_boundary(text: str) -> int:
+    """Return the offset up to which `text` only contains finished blocks.
+
+    A block is finished once it is followed by a blank line and a new,
+    non-indented line outside of a code fence.
+    """
+    boundary = 0
+    offset = 0
+    in_fence = False
+    previous_blank = False
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if previous_blank and stripped and line[0] not in " \t":
+            boundary = offset
+        if _FENCE_RE.match(line):
+            in_fence = not in_fence
+        previous_blank = not stripped and not in_fence
+        offset += len(line)
+    return boundary
+
+
+_CODE_SPAN_RE = re.compile(r"`+[^`]*`+")
+_DEFINITION_RE = re.compile(r"^ {0,3}\[(\^?[^\]]+)\]:")
+_REFERENCE_RE = re.compile(r"\[(\^[^\]\s]+)\](?!:)|\[([^\]]+)\]\[([^\]]*)\]")
+
+
+def normalize_label(label: str) -> str:
+    return " ".join(label.split()).lower()
+
+
+def find_unresolved_reference(text: str) -> int | None:
+    """Return the offset of the first footnote (`[^x]`) or reference link
+    (`[text][x]`) in `text` whose definition is not in `text`, if any.
+
+    Code fences and code spans are skipped.
+    """
+    definitions = set()
+    references = []
+    offset = 0
+    in_fence = False
+    for line in text.splitlines(keepends=True):
+        if _FENCE_RE.match(line):
+            in_fence = not in_fence
+        elif not in_fence:
+            if match := _DEFINITION_RE.match(line):
+                definitions.add(normalize_label(match.group(1)))
+                line = line[match.end() :]
+                offset += match.end()
+            # blank out code spans, keeping the offsets of the line
+            line_text = _CODE_SPAN_RE.sub(lambda code: " " * len(code[0]), line)
+            for match in _REFERENCE_RE.finditer(line_text):
+                label = match.group(1) or match.group(3) or match.group(2)
+                references.append((offset + match.start(), normalize_label(label)))
+        offset += len(line)
+    for reference_offset, label in references:
+        if label not in definitions:
+            return reference_offset
+    return None
+
+
+class StreamingMarkdown:
+    """Incrementally render a markdown document that arrives in chunks.
+
+    Finished blocks are rendered once and kept in `closed_html`, only the
+    trailing open block is re-rendered on every `feed`. A block with a
+    footnote or reference link stays open until its definition arrives, so
+    both are rendered together.
+    """
+
+    def __init__(self, profile: str = "chat"):
+        self.profile = profile
+        self.closed_html = ""
+        self.tail_html = ""
+        self.open_text = ""
+
+    @property
+    def html(self):
+        return self.closed_html + self.tail_html
+
+    def feed(self, text: str) -> tuple[str, str]:
+        """Add `text` and return the newly closed html and the open tail html."""
+        self.open_text += text
+        appended_html = ""
+        boundary = find_block_boundary(self.open_text)
+        reference = find_unresolved_reference(self.open_text[:boundary])
+        if reference is not None:
+            boundary = find_block_boundary(self.open_text[: reference + 1])
+        if boundary:
+            closed_text = self.open_text[:boundary]
+            self.open_text = self.open_text[boundary:]
+            appended_html = get_markdown(closed_text, self.profile)
+            self.closed_html += appended_html
+        self.tail_html = get_markdown(self.open_text, self.profile)
+        return appended_html, self.tail_html
+
+
+def get_request_kwargs(
     model: LanguageModel,
     messages: list[dict],
-    user: User,
-    stream_flag: bool = False,
-    force_tool: bool = False,
-    params: dict = _get_default_params(),
-    tools: list[dict] = None,
-):
-    logger.warning(f"Calling API for model: {model.name}")
+    stream_flag: bool,
+    force_tool: bool,
+    params: dict,
+    tools: list[dict],
+) -> dict:
     api_identifier = model.api.identifier
     kwargs = {
         "model": model.name,
@@ -97,13 +244,59 @@ def call_api(
         kwargs["tool_choice"] = "auto"
     if force_tool:
         kwargs["tool_choice"] = "any" if api_identifier == "mistral" else "required"
+    return kwargs
 
-    api_key = UserAPIKey.objects.get(user=user, api__identifier=api_identifier).key
-    response = OpenAI(
-        api_key=api_key,
-        base_url=model.api.base_url,
-    ).chat.completions.create(**kwargs)
-    logger.warning("API responded")
+
+def call_api(
+    model: LanguageModel,
+    messages: list[dict],
+    user: User,
+    stream_flag: bool = False,
+    force_tool: bool = False,
+    params: dict = _get_default_params(),
+    tools: list[dict] = None,
+):
+    logger.warning(f"Calling API for model: {model.name}")
+    api_identifier = model.api.identifier
+    kwargs = get_request_kwargs(model, messages, stream_flag, force_tool, params, tools)
+    api_key = api_key_cache.get_or_load(
+        (user.pk, api_identifier),
+        lambda: UserAPIKey.objects.get(user=user, api__identifier=api_identifier).key,
+    )
+    client = get_client(model.api.base_url, api_key)
+    response = client.chat.completions.create(**kwargs)
+    logger.warning(
+        f"API responded (connection reuse: {client_registry.reuse_ratio:.0%})"
+    )
+    return response
+
+
+async def acall_api(
+    model: LanguageModel,
+    messages: list[dict],
+    user: User,
+    stream_flag: bool = False,
+    force_tool: bool = False,
+    params: dict = _get_default_params(),
+    tools: list[dict] = None,
+):
+    """Async version of `call_api`, `model.api` has to be loaded already."""
+    logger.warning(f"Calling API for model: {model.name}")
+    api_identifier = model.api.identifier
+    kwargs = get_request_kwargs(model, messages, stream_flag, force_tool, params, tools)
+    cache_key = (user.pk, api_identifier)
+    api_key = api_key_cache.get(cache_key)
+    if api_key is None:
+        user_api_key = await UserAPIKey.objects.aget(
+            user=user, api__identifier=api_identifier
+        )
+        api_key = user_api_key.key
+        api_key_cache.set(cache_key, api_key)
+    client = get_async_client(model.api.base_url, api_key)
+    response = await client.chat.completions.create(**kwargs)
+    logger.warning(
+        f"API responded (connection reuse: {client_registry.reuse_ratio:.0%})"
+    )
     return response
 
 
@@ -124,28 +317,66 @@ def update_tool_calls(tool_call, tool_calls):
     return tool_calls
 
 
-def process_chunk(chunk, raw_text_generated, tool_calls):
-    """Process each chunk to extract text and tool call information."""
+def process_chunk(
+    chunk,
+    raw_text_generated,
+    tool_calls,
+    renderer: StreamingMarkdown,
+    html_delta: bool = False,
+):
+    """Process each chunk to extract text and tool call information.
+
+    With `html_delta` the json only carries the html closed by this chunk
+    (`append`) and the re-rendered open block (`tail`), otherwise the whole
+    rendered document (`text`).
+    """
     generated_text_json = None  # Initialize data to None
     if chunk.choices:
         delta = chunk.choices[0].delta
         if delta and delta.content:
+            first_content = not raw_text_generated
             raw_text_generated += delta.content
-            marked = get_markdown(raw_text_generated)
-            generated_text_json = json.dumps({"text": marked})
+            appended_html, tail_html = renderer.feed(delta.content)
+            if html_delta:
+                data = {"append": appended_html, "tail": tail_html}
+                if first_content:
+                    data["reset"] = True
+            else:
+                data = {"text": renderer.html}
+            generated_text_json = json.dumps(data)
         if delta and delta.tool_calls:
             tool_calls = update_tool_calls(delta.tool_calls[0], tool_calls)
 
     return raw_text_generated, generated_text_json, tool_calls
 
 
-def process_response(response):
-    """Process the response stream, yielding text and tool calls."""
+def process_response(
+    response, html_delta: bool = False, renderer: StreamingMarkdown = None
+):
+    """Process the response stream, yielding text and tool calls.
+
+    Pass a `renderer` to render another profile or read its whole html.
+    """
     raw_text_generated = ""
     tool_calls = {}
+    renderer = renderer or StreamingMarkdown()
     for chunk in response:
         raw_text_generated, generated_text_json, tool_calls = process_chunk(
-            chunk, raw_text_generated, tool_calls
+            chunk, raw_text_generated, tool_calls, renderer, html_delta
+        )
+        yield chunk, generated_text_json, tool_calls, raw_text_generated
+
+
+async def aprocess_response(
+    response, html_delta: bool = False, renderer: StreamingMarkdown = None
+):
+    """Async version of `process_response` for AsyncOpenAI streams."""
+    raw_text_generated = ""
+    tool_calls = {}
+    renderer = renderer or StreamingMarkdown()
+    async for chunk in response:
+        raw_text_generated, generated_text_json, tool_calls = process_chunk(
+            chunk, raw_text_generated, tool_calls, renderer, html_delta
         )
         yield chunk, generated_text_json, tool_calls, raw_text_generated
 
@@ -169,8 +400,56 @@ def handle_tools_calls(tools_calls: dict, tool_functions: list[dict]) -> str:
     return None
 
 
-def store_payload_and_usage(messages, chunk_responses, request_config, user):
-    """Handle the payload and log the response."""
+def get_tool_call_arguments(response, function_name: str) -> list[dict]:
+    """The parsed arguments of every `function_name` call of a completion."""
+    arguments = []
+    for choice in response.choices:
+        for tool_call in choice.message.tool_calls or []:
+            if tool_call.function.name != function_name:
+                continue
+            try:
+                arguments.append(json.loads(tool_call.function.arguments))
+            except json.JSONDecodeError:
+                logger.warning(f"Invalid arguments for {function_name}, call skipped")
+    return arguments
+
+
+class ToolCallSink:
+    """Collects the tool calls of responses to write them in one go.
+
+    `batch_functions` maps a tool name to a function taking the list of the
+    arguments of all its calls, e.g. to save them with `bulk_create`. `flush`
+    runs them in a single transaction.
+    """
+
+    def __init__(self, batch_functions: dict):
+        self.batch_functions = batch_functions
+        self.calls = defaultdict(list)
+
+    def add_response(self, response):
+        for function_name in self.batch_functions:
+            self.calls[function_name] += get_tool_call_arguments(
+                response, function_name
+            )
+
+    def flush(self) -> dict:
+        """Run every batch function once, returns their results by tool name."""
+        results = {}
+        with transaction.atomic():
+            for function_name, arguments in self.calls.items():
+                if arguments:
+                    logger.warning(f"Calling {function_name} {len(arguments)} time(s)")
+                    results[function_name] = self.batch_functions[function_name](
+                        arguments
+                    )
+        self.calls.clear()
+        return results
+
+
+def store_payload_and_usage(
+    messages, chunk_responses, request_config, user
+) -> TokenUsage:
+    """Handle the payload and log the response, returns the token usage."""
     payload_sent = PayloadSent.objects.create(
         request_config=request_config,
         payload=messages,
@@ -178,4 +457,18 @@ def store_payload_and_usage(messages, chunk_responses, request_config, user):
         response=chunk_responses,
     )
     usage_data = chunk_responses[-1]["usage"]
-    TokenUsage.objects.create(payload_sent=payload_sent, **usage_data)
+    return TokenUsage.objects.create(payload_sent=payload_sent, **usage_data)
+
+
+async def astore_payload_and_usage(
+    messages, chunk_responses, request_config, user
+) -> TokenUsage:
+    """Async version of `store_payload_and_usage`."""
+    payload_sent = await PayloadSent.objects.acreate(
+        request_config=request_config,
+        payload=messages,
+        user=user,
+        response=chunk_responses,
+    )
+    usage_data = chunk_responses[-1]["usage"]
+    return await TokenUsage.objects.acreate(payload_sent=payload_sent, **usage_data)
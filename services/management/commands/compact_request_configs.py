@@ -0,0 +1,63 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from services.models import RequestConfiguration, get_config_fingerprint
+
+
+class Command(BaseCommand):
+    help = "Merges request configurations with the same values and fills in their fingerprints."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report how many configurations would be removed.",
+        )
+
+    def handle(self, *args, **options):
+        # only the ids and stored fingerprints are kept, per computed fingerprint
+        groups = defaultdict(list)
+        for config_id, params, system_prompt, language_model_id, stored in (
+            RequestConfiguration.objects.values_list(
+                "id", "params", "system_prompt", "language_model_id", "fingerprint"
+            )
+            .order_by("id")
+            .iterator()
+        ):
+            fingerprint = get_config_fingerprint(
+                params, system_prompt, language_model_id
+            )
+            groups[fingerprint].append((config_id, stored))
+
+        duplicates = sum(len(configs) - 1 for configs in groups.values())
+        print(
+            f"{len(groups)} distinct configurations, {duplicates} duplicates "
+            f"out of {sum(len(configs) for configs in groups.values())} rows."
+        )
+        if options["dry_run"]:
+            return
+
+        # every model pointing to a configuration (chats, messages, contents, payloads)
+        relations = [
+            relation
+            for relation in RequestConfiguration._meta.related_objects
+            if relation.one_to_many
+        ]
+        for fingerprint, configs in groups.items():
+            # the row with the fingerprint is the one get_for() returns (and
+            # processes may have cached), the others are merged into it
+            configs.sort(key=lambda config: (config[1] != fingerprint, config[0]))
+            (kept_id, kept_fingerprint), *duplicated = configs
+            with transaction.atomic():
+                if duplicated:
+                    duplicated_ids = [config_id for config_id, _ in duplicated]
+                    for relation in relations:
+                        relation.related_model._base_manager.filter(
+                            **{f"{relation.field.name}__in": duplicated_ids}
+                        ).update(**{relation.field.name: kept_id})
+                    RequestConfiguration.objects.filter(id__in=duplicated_ids).delete()
+                if kept_fingerprint != fingerprint:
+                    RequestConfiguration.objects.filter(id=kept_id).update(
+                        fingerprint=fingerprint
+                    )
+        print(f"Removed {duplicates} duplicate configurations.")
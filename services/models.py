@@ -1,8 +1,18 @@
-from django.db import models
+import copy
+import hashlib
+import json
+import time
+from functools import lru_cache
+from django.conf import settings
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from cryptography.fernet import Fernet
 from config.settings import ENCRYPTION_KEY
-from django.db.models import Q
+
+
+@lru_cache(maxsize=1)
+def get_cipher_suite():
+    return Fernet(ENCRYPTION_KEY)
 
 
 def _get_default_params():
@@ -36,40 +46,123 @@ class LanguageModel(models.Model):
         return self.name
 
 
+def get_config_fingerprint(params: dict, system_prompt: str, language_model_id: int):
+    """Hash identifying the request configuration with these values."""
+    content = json.dumps(
+        [params, system_prompt, language_model_id], sort_keys=True, default=str
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class RequestConfigurationManager(models.Manager):
+    def get_for(self, language_model, params: dict = None, system_prompt: str = None):
+        """The configuration with these values, created if it does not exist yet.
+
+        Missing `params` and `system_prompt` are the defaults.
+        """
+        params = _get_default_params() if params is None else params
+        if system_prompt is None:
+            system_prompt = get_default_system_prompt()
+        language_model_id = getattr(language_model, "pk", language_model)
+        request_config, created = self.get_or_create(
+            fingerprint=get_config_fingerprint(
+                params, system_prompt, language_model_id
+            ),
+            defaults={
+                "params": params,
+                "system_prompt": system_prompt,
+                "language_model_id": language_model_id,
+            },
+        )
+        if isinstance(language_model, LanguageModel):
+            request_config.language_model = language_model  # saves a query
+        return request_config
+
+
 class RequestConfiguration(models.Model):
+    """Parameters, system prompt and model of requests.
+
+    Configurations are immutable and shared by every chat, message and
+    content using the same values, identified by their `fingerprint`. Use
+    `derive` to get the configuration with other values.
+    """
+
     params = models.JSONField(default=_get_default_params)
     system_prompt = models.TextField(default=get_default_system_prompt)
     language_model = models.ForeignKey(
         LanguageModel, on_delete=models.CASCADE, default=get_default_language_model
     )
+    # null for rows created before fingerprints, see `compact_request_configs`
+    fingerprint = models.CharField(
+        max_length=64, unique=True, null=True, editable=False
+    )
+
+    objects = RequestConfigurationManager()
 
     def __str__(self):
         return self.language_model.name
 
+    def get_fingerprint(self) -> str:
+        return get_config_fingerprint(
+            self.params, self.system_prompt, self.language_model_id
+        )
+
+    def derive(self, **values) -> "RequestConfiguration":
+        """The configuration with `values` replacing those of this one."""
+        return RequestConfiguration.objects.get_for(
+            **{
+                "params": self.params,
+                "system_prompt": self.system_prompt,
+                "language_model": self.language_model_id,
+                **values,
+            }
+        )
+
+    def save(self, *args, **kwargs):
+        fingerprint = self.get_fingerprint()
+        if self.fingerprint and self.fingerprint != fingerprint:
+            raise ValueError(
+                "Request configurations are shared and can't be changed, "
+                "use derive() to get one with other values"
+            )
+        self.fingerprint = fingerprint
+        super().save(*args, **kwargs)
+
+
+# process-local cache of the default configuration, cleared by services.signals
+_default_request_config = {}
+
 
 def get_default_request_config():
-    # Define default values for comparison
-    default_params = _get_default_params()
-    default_system_prompt = get_default_system_prompt()
-    default_language_model = get_default_language_model()
-
-    # Check for an existing config that matches these defaults
-    existing_config = RequestConfiguration.objects.filter(
-        Q(params=default_params)
-        & Q(system_prompt=default_system_prompt)
-        & Q(language_model=default_language_model)
-    ).first()
-
-    # Return the existing default config, or create a new one if none exists
-    if existing_config:
-        return existing_config
-    else:
-        return RequestConfiguration.objects.create(
-            params=default_params,
-            system_prompt=default_system_prompt,
-            language_model=default_language_model,
+    """The configuration with the default values, cached for this process.
+
+    Used as the default of every new chat. The configuration is only cached
+    once committed, so a rolled back transaction can't leave a missing row,
+    and the cached row is checked to still exist, as another process may
+    have deleted it without this one being signaled.
+    """
+    cached = _default_request_config.get("config")
+    if (
+        cached is not None
+        and _default_request_config["expires_at"] > time.monotonic()
+        and RequestConfiguration.objects.filter(id=cached.id).exists()
+    ):
+        return copy.copy(cached)
+    request_config = RequestConfiguration.objects.get_for(get_default_language_model())
+
+    def store():
+        _default_request_config.update(
+            config=copy.copy(request_config),
+            expires_at=time.monotonic() + settings.DEFAULT_REQUEST_CONFIG_TTL,
         )
 
+    transaction.on_commit(store)
+    return request_config
+
+
+def clear_default_request_config():
+    _default_request_config.clear()
+
 
 class PayloadSent(models.Model):
     request_config = models.ForeignKey(RequestConfiguration, on_delete=models.CASCADE)
@@ -105,14 +198,12 @@ class UserAPIKey(models.Model):
 
     @property
     def key(self):
-        cipher_suite = Fernet(ENCRYPTION_KEY)
         return (
-            cipher_suite.decrypt(self.encrypted_key).decode()
+            get_cipher_suite().decrypt(bytes(self.encrypted_key)).decode()
             if self.encrypted_key
             else None
         )
 
     @key.setter
     def key(self, value):
-        cipher_suite = Fernet(ENCRYPTION_KEY)
-        self.encrypted_key = cipher_suite.encrypt(value.encode())
+        self.encrypted_key = get_cipher_suite().encrypt(value.encode())
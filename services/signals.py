@@ -1,7 +1,14 @@
-from django.db.models.signals import post_migrate
+from django.db.models.signals import post_migrate, pre_save, post_save, post_delete
 from django.contrib.auth.signals import user_logged_in
 from django.dispatch import receiver
-from .models import UserAPIKey, ModelAPI, LanguageModel
+from .llm_clients import api_key_cache, client_registry
+from .models import (
+    UserAPIKey,
+    ModelAPI,
+    LanguageModel,
+    RequestConfiguration,
+    clear_default_request_config,
+)
 from dotenv import load_dotenv
 import os
 
@@ -31,3 +38,47 @@ def load_api_keys_on_first_login(sender, request, user, **kwargs):
     ) and not UserAPIKey.objects.filter(user=user, api__identifier="mistral").exists():
         mistral_api = ModelAPI.objects.get(identifier="mistral")
         UserAPIKey.objects.create(api=mistral_api, key=MISTRAL_API_KEY, user=user)
+
+
+@receiver(pre_save, sender=UserAPIKey)
+def invalidate_clients_on_key_change(sender, instance, **kwargs):
+    if not instance.pk:
+        return
+    previous = UserAPIKey.objects.filter(pk=instance.pk).first()
+    if previous and previous.encrypted_key:
+        client_registry.invalidate(api_key=previous.key)
+
+
+@receiver(post_delete, sender=UserAPIKey)
+def invalidate_clients_on_key_delete(sender, instance, **kwargs):
+    if instance.encrypted_key:
+        client_registry.invalidate(api_key=instance.key)
+
+
+@receiver(post_save, sender=UserAPIKey)
+@receiver(post_delete, sender=UserAPIKey)
+def invalidate_cached_api_keys(sender, instance, **kwargs):
+    api_key_cache.invalidate_user(instance.user_id)
+
+
+@receiver(pre_save, sender=ModelAPI)
+def invalidate_clients_on_api_change(sender, instance, **kwargs):
+    if not instance.pk:
+        return
+    previous = ModelAPI.objects.filter(pk=instance.pk).first()
+    if previous:
+        client_registry.invalidate(base_url=previous.base_url)
+        if previous.identifier != instance.identifier:
+            api_key_cache.clear()
+
+
+@receiver(post_delete, sender=ModelAPI)
+def invalidate_clients_on_api_delete(sender, instance, **kwargs):
+    client_registry.invalidate(base_url=instance.base_url)
+
+
+@receiver(post_save, sender=LanguageModel)
+@receiver(post_delete, sender=LanguageModel)
+@receiver(post_delete, sender=RequestConfiguration)
+def invalidate_default_request_config(sender, instance, **kwargs):
+    clear_default_request_config()
@@ -1,15 +1,48 @@
 import json
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch, MagicMock
+import tiktoken
+from cryptography.fernet import Fernet
 from django.contrib.auth.models import User
-from services.models import LanguageModel
-from services.llm_handler import call_api, get_markdown, handle_tools_calls
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from services.models import (
+    LanguageModel,
+    ModelAPI,
+    PayloadSent,
+    RequestConfiguration,
+    UserAPIKey,
+    clear_default_request_config,
+    get_cipher_suite,
+    get_default_request_config,
+)
+from services.llm_clients import APIKeyCache, ClientRegistry, api_key_cache
+from services.llm_handler import (
+    StreamingMarkdown,
+    call_api,
+    find_block_boundary,
+    find_unresolved_reference,
+    get_lexer,
+    get_markdown,
+    get_markdown_parser,
+    ToolCallSink,
+    handle_tools_calls,
+)
+from services.tokenizer import (
+    count_page_tokens,
+    count_tokens,
+    get_encoder,
+    iter_blocks,
+)
 
 
 class TestCallAPI(unittest.TestCase):
-    @patch("services.llm_handler.OpenAI")
+    @patch("services.llm_handler.get_client")
     @patch("services.llm_handler.UserAPIKey")
-    def test_call_api(self, mock_user_api_key, mock_openai):
+    def test_call_api(self, mock_user_api_key, mock_get_client):
         # Setup mock objects
         mock_model = MagicMock(spec=LanguageModel)
         mock_model.api.identifier = "openai"
@@ -20,7 +53,9 @@ class TestCallAPI(unittest.TestCase):
         mock_user_api_key.objects.get.return_value.key = "test-api-key"
 
         mock_response = MagicMock()
-        mock_openai.return_value.chat.completions.create.return_value = mock_response
+        mock_get_client.return_value.chat.completions.create.return_value = (
+            mock_response
+        )
 
         messages = [{"role": "user", "content": "Hello"}]
         params = {"temperature": 0.7}
@@ -42,10 +77,10 @@ class TestCallAPI(unittest.TestCase):
         mock_user_api_key.objects.get.assert_called_once_with(
             user=mock_user, api__identifier="openai"
         )
-        mock_openai.assert_called_once_with(
-            api_key="test-api-key", base_url="https://api.openai.com"
+        mock_get_client.assert_called_once_with(
+            "https://api.openai.com", "test-api-key"
         )
-        mock_openai.return_value.chat.completions.create.assert_called_once_with(
+        mock_get_client.return_value.chat.completions.create.assert_called_once_with(
             model="test-model",
             messages=messages,
             stream=True,
@@ -56,6 +91,127 @@ class TestCallAPI(unittest.TestCase):
         )
 
 
+class ChatCompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps(
+            {
+                "id": "test",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "test-model",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": "Hi"},
+                    }
+                ],
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestClientRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = ClientRegistry()
+
+    def test_client_is_reused_per_base_url_and_key(self):
+        client = self.registry.get("https://api.test.com/", "key-1")
+        self.assertIs(client, self.registry.get("https://api.test.com/", "key-1"))
+        self.assertIsNot(client, self.registry.get("https://api.test.com/", "key-2"))
+        self.assertIsNot(client, self.registry.get("https://other.test.com/", "key-1"))
+
+    def test_invalidate(self):
+        client = self.registry.get("https://api.test.com/", "key-1")
+        self.registry.get("https://api.test.com/", "key-2")
+        self.assertEqual(self.registry.invalidate(api_key="key-1"), 1)
+        self.assertIsNot(client, self.registry.get("https://api.test.com/", "key-1"))
+        self.assertEqual(self.registry.invalidate(base_url="https://api.test.com/"), 2)
+        self.assertEqual(self.registry.get_stats()["clients"], 0)
+
+    def test_connection_reuse_ratio(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), ChatCompletionHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base_url = f"http://127.0.0.1:{server.server_port}/v1/"
+
+        for _ in range(4):
+            client = self.registry.get(base_url, "key")
+            client.chat.completions.create(model="test-model", messages=[])
+
+        stats = self.registry.get_stats()
+        self.assertEqual(stats["requests"], 4)
+        self.assertEqual(stats["new_connections"], 1)
+        self.assertEqual(stats["reuse_ratio"], 0.75)
+
+
+class TestAPIKeyCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = APIKeyCache(max_size=10, ttl=60)
+        load_key = MagicMock(return_value="secret")
+        self.assertEqual(cache.get_or_load((1, "openai"), load_key), "secret")
+        self.assertEqual(cache.get_or_load((1, "openai"), load_key), "secret")
+        load_key.assert_called_once()
+        self.assertEqual(cache.get_stats(), {"size": 1, "hits": 1, "misses": 1})
+
+    @patch("services.llm_clients.time.monotonic")
+    def test_entries_expire(self, mock_monotonic):
+        cache = APIKeyCache(max_size=10, ttl=60)
+        mock_monotonic.return_value = 0
+        cache.get_or_load((1, "openai"), lambda: "old")
+        mock_monotonic.return_value = 61
+        self.assertEqual(cache.get_or_load((1, "openai"), lambda: "new"), "new")
+
+    def test_least_recently_used_is_evicted(self):
+        cache = APIKeyCache(max_size=2, ttl=60)
+        cache.get_or_load((1, "openai"), lambda: "a")
+        cache.get_or_load((2, "openai"), lambda: "b")
+        cache.get_or_load((1, "openai"), lambda: "a")
+        cache.get_or_load((3, "openai"), lambda: "c")
+        self.assertEqual(cache.get_or_load((1, "openai"), lambda: "reloaded"), "a")
+        self.assertEqual(
+            cache.get_or_load((2, "openai"), lambda: "reloaded"), "reloaded"
+        )
+
+
+class APIKeySignalTests(TestCase):
+    def setUp(self):
+        patcher = patch("services.models.ENCRYPTION_KEY", Fernet.generate_key())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        get_cipher_suite.cache_clear()
+        self.addCleanup(get_cipher_suite.cache_clear)
+        self.user = User.objects.create_user(username="testuser")
+        self.api = ModelAPI.objects.create(identifier="test_api", name="Test API")
+        self.api_key = UserAPIKey.objects.create(
+            api=self.api, user=self.user, key="old-key"
+        )
+
+    def load_key(self):
+        return UserAPIKey.objects.get(user=self.user, api=self.api).key
+
+    def test_key_round_trip(self):
+        self.assertEqual(UserAPIKey.objects.get(pk=self.api_key.pk).key, "old-key")
+
+    def test_saving_key_invalidates_cache(self):
+        cache_key = (self.user.pk, "test_api")
+        self.assertEqual(api_key_cache.get_or_load(cache_key, self.load_key), "old-key")
+        self.api_key.key = "new-key"
+        self.api_key.save()
+        self.assertEqual(api_key_cache.get_or_load(cache_key, self.load_key), "new-key")
+
+
 class TestHandleToolsCalls(unittest.TestCase):
     def setUp(self):
         self.tool_functions = {
@@ -149,3 +305,293 @@ class TestGetMarkdown(unittest.TestCase):
             '<p>Here is a footnote reference<sup class="footnote-ref" id="fnref-1"><a href="#fn-1">1</a></sup></p>\n<section class="footnotes">\n<ol>\n<li id="fn-1"><p>Here is the footnote.<a href="#fnref-1" class="footnote">&#8617;</a></p></li>\n</ol>\n</section>\n',
             result,
         )
+
+
+class TestStreamingMarkdown(unittest.TestCase):
+    def feed_in_chunks(self, text, size=3):
+        renderer = StreamingMarkdown()
+        for i in range(0, len(text), size):
+            renderer.feed(text[i : i + size])
+        return renderer
+
+    def test_paragraphs_match_full_render(self):
+        text = "First **paragraph**.\n\nSecond paragraph.\n\n# Title\n\nLast one."
+        renderer = self.feed_in_chunks(text)
+        self.assertEqual(renderer.html, get_markdown(text, "chat"))
+        self.assertEqual(renderer.open_text, "Last one.")
+
+    def test_code_fence_is_not_split(self):
+        text = "Intro\n\n```python\na = 1\n\nb = 2\n```\n\nOutro"
+        renderer = self.feed_in_chunks(text)
+        self.assertEqual(renderer.html, get_markdown(text, "chat"))
+
+    def test_open_block_is_not_closed(self):
+        self.assertEqual(find_block_boundary("One paragraph\nstill open"), 0)
+        self.assertEqual(find_block_boundary("```\ncode\n\nmore"), 0)
+        self.assertEqual(find_block_boundary("Done\n\nOpen"), len("Done\n\n"))
+
+    def test_feed_returns_delta(self):
+        renderer = StreamingMarkdown()
+        appended, tail = renderer.feed("Hello")
+        self.assertEqual((appended, tail), ("", "<p>Hello</p>\n"))
+        appended, tail = renderer.feed("\n\nWorld")
+        self.assertEqual((appended, tail), ("<p>Hello</p>\n", "<p>World</p>\n"))
+
+    def test_footnote_is_resolved_while_streaming(self):
+        closed = "See note[^1].\n\nMore text.\n\n[^1]: The note.\n\n"
+        text = closed + "After."
+        renderer = StreamingMarkdown()
+        streamed = []
+        for i in range(0, len(text), 3):
+            appended, _ = renderer.feed(text[i : i + 3])
+            streamed.append(appended)
+        self.assertEqual("".join(streamed), get_markdown(closed, "chat"))
+        self.assertNotIn("[^1]", renderer.closed_html)
+        self.assertIn("The note.", renderer.closed_html)
+        self.assertEqual(renderer.tail_html, "<p>After.</p>\n")
+
+    def test_reference_link_keeps_block_open(self):
+        text = "A [link][docs].\n\nOpen"
+        self.assertEqual(find_unresolved_reference(text), text.index("[link]"))
+        self.assertIsNone(find_unresolved_reference(text + "\n\n[Docs]: /docs"))
+        self.assertIsNone(find_unresolved_reference("`a[i][j]`\n```\nb[^1]\n```"))
+        renderer = StreamingMarkdown()
+        renderer.feed(text)
+        self.assertEqual(renderer.closed_html, "")
+
+
+class TestMarkdownParserCache(unittest.TestCase):
+    def test_parser_is_reused_per_profile(self):
+        self.assertIs(get_markdown_parser("chat"), get_markdown_parser("chat"))
+        self.assertIsNot(get_markdown_parser("chat"), get_markdown_parser("summary"))
+
+    def test_parser_is_per_thread(self):
+        parsers = []
+        thread = threading.Thread(
+            target=lambda: parsers.append(get_markdown_parser("chat"))
+        )
+        thread.start()
+        thread.join()
+        self.assertIsNot(parsers[0], get_markdown_parser("chat"))
+
+    def test_reused_parser_does_not_leak_state(self):
+        text = "Reference[^1]\n\n[^1]: The footnote."
+        self.assertEqual(get_markdown(text), get_markdown(text))
+        self.assertNotIn("footnotes", get_markdown("No footnote here."))
+
+    def test_toc_only_in_summary_profile(self):
+        text = ".. toc::\n\n# Title"
+        self.assertIn('<div class="toc"', get_markdown(text, "summary"))
+        self.assertNotIn('<div class="toc"', get_markdown(text, "document"))
+
+    def test_lexer_cache(self):
+        self.assertIs(get_lexer("python"), get_lexer("python"))
+        self.assertIsNone(get_lexer("not-a-language"))
+
+
+def byte_encoding(name: str, merges: list[bytes] = ()) -> tiktoken.Encoding:
+    """One token per byte plus `merges`, tiktoken files can't be downloaded in tests."""
+    ranks = {bytes([i]): i for i in range(256)}
+    for merge in merges:
+        ranks[merge] = len(ranks)
+    return tiktoken.Encoding(
+        name=name, pat_str=r"\S+|\s+", mergeable_ranks=ranks, special_tokens={}
+    )
+
+
+def patch_encodings(test_case, encodings: dict[str, tiktoken.Encoding]):
+    """Serve `encodings` by name (and model name) to `services.tokenizer`."""
+
+    def encoding_for_model(model_name):
+        if model_name not in encodings:
+            raise KeyError(model_name)
+        return encodings[model_name]
+
+    get_encoder.cache_clear()
+    test_case.addCleanup(get_encoder.cache_clear)
+    for name, function in [
+        ("encoding_for_model", encoding_for_model),
+        ("get_encoding", encodings.__getitem__),
+    ]:
+        patcher = patch(f"services.tokenizer.tiktoken.{name}", side_effect=function)
+        patcher.start()
+        test_case.addCleanup(patcher.stop)
+
+
+class TestTokenizer(unittest.TestCase):
+    def setUp(self):
+        self.encoding = byte_encoding("o200k_base")
+        patch_encodings(self, {"gpt-4o": self.encoding, "o200k_base": self.encoding})
+
+    def test_encoder_is_cached(self):
+        self.assertIs(get_encoder("gpt-4o"), get_encoder("gpt-4o"))
+        self.assertEqual(get_encoder.cache_info().hits, 1)
+
+    def test_unknown_model_uses_fallback_encoding(self):
+        self.assertIs(get_encoder("pixtral-12b"), self.encoding)
+
+    def test_count_tokens_in_blocks(self):
+        text = "line of text\n" * 20000
+        blocks = list(iter_blocks(text, block_size=1000))
+        self.assertEqual("".join(blocks), text)
+        self.assertTrue(all(block.endswith("\n") for block in blocks))
+        self.assertEqual(count_tokens(text, "gpt-4o"), len(text))
+
+    def test_special_tokens_are_counted_as_text(self):
+        self.assertEqual(count_tokens("<|endoftext|>", "gpt-4o"), 13)
+
+    def test_count_page_tokens(self):
+        pages = [{"text": "abc"}, {"text": "de"}]
+        self.assertEqual(count_page_tokens(pages, "pixtral-12b"), 5)
+        self.assertEqual([page["token_amount"] for page in pages], [3, 2])
+
+
+class TestToolCallSink(unittest.TestCase):
+    def test_calls_are_flushed_in_batches(self):
+        def call(name, arguments):
+            return MagicMock(
+                function=MagicMock(arguments=arguments), **{"function.name": name}
+            )
+
+        response = MagicMock()
+        response.choices = [
+            MagicMock(
+                message=MagicMock(
+                    tool_calls=[
+                        call("save", '{"value": 1}'),
+                        call("other", '{"value": 2}'),
+                        call("save", "{invalid"),
+                        call("save", '{"value": 3}'),
+                    ]
+                )
+            )
+        ]
+        save = MagicMock(return_value="saved")
+        sink = ToolCallSink({"save": save})
+        sink.add_response(response)
+        sink.add_response(response)
+        with patch("services.llm_handler.transaction.atomic") as atomic:
+            self.assertEqual(sink.flush(), {"save": "saved"})
+        atomic.assert_called_once()
+        save.assert_called_once_with([{"value": 1}, {"value": 3}] * 2)
+        self.assertEqual(sink.flush(), {})
+
+
+class RequestConfigurationTests(TestCase):
+    def setUp(self):
+        self.language_model = LanguageModel.objects.get(name="gpt-4o-mini")
+        # the cached default would outlive the rolled back test transaction
+        clear_default_request_config()
+        self.addCleanup(clear_default_request_config)
+
+    def test_identical_configurations_are_shared(self):
+        request_config = RequestConfiguration.objects.get_for(
+            self.language_model, params={"temperature": 0.5}
+        )
+        self.assertEqual(
+            RequestConfiguration.objects.get_for(
+                self.language_model.id, params={"temperature": 0.5}
+            ),
+            request_config,
+        )
+        derived = request_config.derive(system_prompt="Be brief.")
+        self.assertNotEqual(derived, request_config)
+        self.assertEqual(derived.params, {"temperature": 0.5})
+        self.assertEqual(
+            derived.derive(system_prompt=request_config.system_prompt), request_config
+        )
+
+    def test_configurations_are_immutable(self):
+        request_config = get_default_request_config()
+        request_config.system_prompt = "Changed for everyone"
+        with self.assertRaises(ValueError):
+            request_config.save()
+
+    def test_compact_request_configs(self):
+        user = User.objects.create_user(username="testuser")
+        default = get_default_request_config()
+        # rows saved before fingerprints, one copy per message
+        copies = RequestConfiguration.objects.bulk_create(
+            [
+                RequestConfiguration(
+                    params=default.params,
+                    system_prompt=default.system_prompt,
+                    language_model=self.language_model,
+                )
+                for _ in range(3)
+            ]
+        )
+        other = RequestConfiguration.objects.bulk_create(
+            [
+                RequestConfiguration(
+                    params={"temperature": 0.2},
+                    language_model=self.language_model,
+                )
+            ]
+        )[0]
+        payload = PayloadSent.objects.create(
+            request_config=copies[1], payload={}, response={}, user=user
+        )
+
+        call_command("compact_request_configs")
+
+        self.assertEqual(
+            set(RequestConfiguration.objects.values_list("id", flat=True)),
+            {default.id, other.id},
+        )
+        payload.refresh_from_db()
+        self.assertEqual(payload.request_config_id, default.id)
+        other.refresh_from_db()
+        self.assertEqual(other.fingerprint, other.get_fingerprint())
+
+    def test_compaction_keeps_the_row_with_the_fingerprint(self):
+        # saved before fingerprints, older than the row get_for() creates
+        copy = RequestConfiguration.objects.bulk_create(
+            [RequestConfiguration(language_model=self.language_model)]
+        )[0]
+        default = get_default_request_config()
+        self.assertGreater(default.id, copy.id)
+
+        call_command("compact_request_configs")
+
+        self.assertEqual(
+            list(RequestConfiguration.objects.values_list("id", flat=True)),
+            [default.id],
+        )
+        self.assertEqual(get_default_request_config(), default)
+
+    def test_default_configuration_is_cached_once_committed(self):
+        default = get_default_request_config()
+        with self.assertNumQueries(2):  # not committed, not cached
+            self.assertEqual(get_default_request_config(), default)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            get_default_request_config()
+        with self.assertNumQueries(1):  # the cached row still exists
+            self.assertEqual(get_default_request_config(), default)
+
+    def test_default_configuration_deleted_elsewhere_is_not_used(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            default = get_default_request_config()
+        # deleted by another process, this one gets no post_delete signal
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {RequestConfiguration._meta.db_table} WHERE id = %s",
+                [default.id],
+            )
+
+        request_config = get_default_request_config()
+        self.assertNotEqual(request_config.id, default.id)
+        self.assertTrue(
+            RequestConfiguration.objects.filter(id=request_config.id).exists()
+        )
+
+    def test_default_configuration_cache_is_invalidated(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            default = get_default_request_config()
+        self.language_model.context_window = 64000
+        self.language_model.save()
+        with self.assertNumQueries(2):
+            request_config = get_default_request_config()
+        self.assertEqual(request_config, default)
+        self.assertEqual(request_config.language_model.context_window, 64000)
@@ -0,0 +1,52 @@
+import functools
+import logging
+from collections.abc import Iterable
+import tiktoken
+from django.conf import settings
+
+logger = logging.getLogger("django.server")
+
+# texts are encoded in blocks of about this many characters, so counting the
+# tokens of a long text never holds all of its tokens at once
+BLOCK_SIZE = 64 * 1024
+
+
+@functools.lru_cache(maxsize=64)
+def get_encoder(model_name: str) -> tiktoken.Encoding:
+    """Tokenizer of `model_name`, the fallback encoding for unknown models."""
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        logger.info(
+            f"No tiktoken encoding for {model_name}, "
+            f"counting with {settings.TOKEN_FALLBACK_ENCODING}"
+        )
+        return tiktoken.get_encoding(settings.TOKEN_FALLBACK_ENCODING)
+
+
+def iter_blocks(text: str, block_size: int = BLOCK_SIZE) -> Iterable[str]:
+    """Split `text` in blocks of about `block_size` characters at line ends."""
+    start = 0
+    while start < len(text):
+        end = start + block_size
+        if end < len(text):
+            newline = text.rfind("\n", start, end)
+            if newline > start:
+                end = newline + 1
+        yield text[start:end]
+        start = end
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    # special tokens (e.g. <|endoftext|>) in documents are counted as plain text
+    encoder = get_encoder(model_name)
+    return sum(len(encoder.encode_ordinary(block)) for block in iter_blocks(text))
+
+
+def count_page_tokens(markdown_json: list[dict], model_name: str) -> int:
+    """Store the token count of every page chunk as `token_amount`, returns the total."""
+    total = 0
+    for page in markdown_json:
+        page["token_amount"] = count_tokens(page["text"], model_name)
+        total += page["token_amount"]
+    return total
@@ -28,14 +28,4 @@ urlpatterns = [
     path("api_keys/", views.api_keys, name="api_keys"),
     path("create_api_key/", views.create_api_key, name="create_api_key"),
     path("delete_api_key/<int:key_id>", views.delete_api_key, name="delete_api_key"),
-    path(
-        "update_params/<int:request_config_id>",
-        views.update_params,
-        name="update_params",
-    ),
-    path(
-        "update_system_prompt/<int:request_config_id>",
-        views.update_system_prompt,
-        name="update_system_prompt",
-    ),
 ]
@@ -3,9 +3,7 @@ from django.views.generic import ListView
 from django.http import HttpResponseRedirect
 from .forms import (
     DeleteAPIKeyForm,
-    ParamsForm,
     RegisterLanguageModelForm,
-    SystemPromptForm,
     UpdateModelAPIForm,
     CreateAPIKeyForm,
     RegisterModelAPIForm,
@@ -14,7 +12,6 @@ from .forms import (
     DeleteLanguageModelForm,
 )
 from .models import (
-    RequestConfiguration,
     UserAPIKey,
     LanguageModel,
     ModelAPI,
@@ -124,26 +121,6 @@ def delete_language_model(request, language_model_id):
     return HttpResponseRedirect(request.META.get("HTTP_REFERER"))
 
 
-def update_params(request, request_config_id):
-    request_config = RequestConfiguration.objects.get(pk=request_config_id)
-    if request.method == "POST":
-        form = ParamsForm(request.POST, instance=request_config)
-        if form.is_valid():
-            form.save()
-            django_messages.success(request, "Parameters updated successfully.")
-    return HttpResponseRedirect(request.META.get("HTTP_REFERER"))
-
-
-def update_system_prompt(request, request_config_id):
-    request_config = RequestConfiguration.objects.get(pk=request_config_id)
-    if request.method == "POST":
-        form = SystemPromptForm(request.POST, instance=request_config)
-        if form.is_valid():
-            form.save()
-            django_messages.success(request, "System prompt updated successfully.")
-    return HttpResponseRedirect(request.META.get("HTTP_REFERER"))
-
-
 class LanguageModelListView(ListView):
     model = LanguageModel
     template_name = "apis/language_models.html"